@@ -27,7 +27,7 @@ class AdminEventForm(forms.ModelForm):
         expires_datetime = (
             datetime.combine(expires_date, expires_time) if expires_date and expires_time else datetime.max)
         context = {'text': self.cleaned_data['text']}
-        event = Event.objects.create(
+        event = Event.objects.create_event(
             source=self.cleaned_data['source'],
             context=context,
             time_expires=expires_datetime,
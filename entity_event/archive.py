@@ -0,0 +1,296 @@
+"""
+Archiving of old events to compressed files, for events that must be
+kept but are no longer needed in the database.
+
+Events are archived to a directory of segments, each a gzipped file of
+newline delimited JSON with one event per line, along with its actors
+and the mediums it was seen on. Each segment has a sidecar file of the
+uuids of its events, and the directory has an index of the segments,
+with the range of times and uuids of the events in each, so events can
+be found without decompressing the segments that cannot hold them.
+"""
+import gzip
+import io
+import json
+import os
+import tempfile
+
+from django.db import connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from entity_event.models import Event, EventActor, EventSeen, _chunked, _delete_events
+
+
+INDEX_FILE_NAME = 'index.ndjson'
+
+# The format of the times stored in the archive.
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def archive_events(directory, before, segment_size=64 * 1024 * 1024, batch_size=1000):
+    """Archive the events that occurred before a time to a directory, and
+    delete them, with the rows that refer to them, from the database.
+
+    Events are written to a segment in order of id, until the segment
+    reaches about ``segment_size`` compressed bytes. Once a segment and
+    its uuids have been written and synced to disk, and added to the
+    index, its events are deleted in a single transaction, so an
+    interrupted archive leaves no events that are neither archived nor
+    in the database. Events of an interrupted archive may be both,
+    and are archived again by the next archive.
+
+    .. code-block:: python
+
+        archived, segments = archive_events('/archive/events', datetime.utcnow() - timedelta(days=365))
+
+    :type directory: str
+    :param directory: The directory to add the segments to, which is
+        created if it does not exist.
+
+    :type before: datetime
+    :param before: Events that occurred before this time are archived.
+
+    :type segment_size: int (optional)
+    :param segment_size: The compressed size, in bytes, after which a
+        segment is closed and another started.
+
+    :type batch_size: int (optional)
+    :param batch_size: The number of events read from the database at
+        a time.
+
+    :rtype: Tuple
+    :returns: A tuple in the form ``(archived, segments)``, with the
+        number of events archived and the names of the segments
+        written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    archive = EventArchive(directory)
+    indexed_segments = set(segment['segment'] for segment in archive.segments())
+
+    archived = 0
+    segment_names = []
+    events = Event.objects.filter(time__lt=before).select_related('source').order_by('id')
+    last_id = 0
+    while True:
+        segment = _SegmentWriter(directory)
+        for batch in _event_batches(events.filter(id__gt=last_id), batch_size):
+            for record in _event_records(batch):
+                segment.write(record)
+            last_id = batch[-1].id
+            if segment.size >= segment_size:
+                break
+        if not segment.count:
+            segment.discard()
+            return archived, segment_names
+
+        entry = segment.close()
+        if entry['segment'] not in indexed_segments:
+            _append_line(os.path.join(directory, INDEX_FILE_NAME), entry)
+        with transaction.atomic():
+            for chunk in _chunked(segment.event_ids):
+                _delete_events(connections[Event.objects.db], chunk)
+        archived += segment.count
+        segment_names.append(entry['segment'])
+
+
+class EventArchive(object):
+    """A reader of the events archived to a directory by
+    ``archive_events``.
+
+    Archived events are dictionaries with the ``id``, ``uuid``,
+    ``source_id``, ``source`` name, ``time``, ``time_expires`` and
+    ``context`` of the event, the entity ids of its ``actors``, and
+    the mediums it was ``seen`` on, as a list of dictionaries with a
+    ``medium_id`` and ``time_seen``. Times are naive UTC datetimes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        """Return the index entries of the segments of the archive.
+
+        :rtype: List of dicts
+        :returns: A dictionary for each segment, in the order they were
+            archived, with the ``segment`` and ``uuids`` file names, the
+            ``count`` of events, and the ``min_time``, ``max_time``,
+            ``min_uuid`` and ``max_uuid`` of its events.
+        """
+        index_path = os.path.join(self.directory, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            return []
+        with io.open(index_path, encoding='utf-8') as index_file:
+            segments = [json.loads(line) for line in index_file if line.strip()]
+        for segment in segments:
+            segment['min_time'] = parse_datetime(segment['min_time'])
+            segment['max_time'] = parse_datetime(segment['max_time'])
+        return segments
+
+    def iter_events(self, start_time=None, end_time=None):
+        """Stream the archived events that occurred within a range of
+        times, only reading the segments that contain events in the
+        range.
+
+        :type start_time: datetime (optional)
+        :param start_time: Only return events that occurred at or after
+            this time.
+
+        :type end_time: datetime (optional)
+        :param end_time: Only return events that occurred at or before
+            this time.
+
+        :rtype: Generator of dicts
+        """
+        for segment in self.segments():
+            if start_time is not None and segment['max_time'] < start_time:
+                continue
+            if end_time is not None and segment['min_time'] > end_time:
+                continue
+            for event in self._read_segment(segment):
+                if (start_time is None or event['time'] >= start_time) and (
+                        end_time is None or event['time'] <= end_time):
+                    yield event
+
+    def get(self, uuid):
+        """Return the archived event with a uuid, or ``None`` if there is
+        none. Only segments whose uuid files contain the uuid are read.
+
+        :rtype: Dictionary
+        """
+        for segment in self.segments():
+            if not segment['min_uuid'] <= uuid <= segment['max_uuid']:
+                continue
+            with io.open(os.path.join(self.directory, segment['uuids']), encoding='utf-8') as uuids_file:
+                if not any(line.rstrip('\n') == uuid for line in uuids_file):
+                    continue
+            return next((event for event in self._read_segment(segment) if event['uuid'] == uuid), None)
+        return None
+
+    def _read_segment(self, segment):
+        """Stream the events of a segment.
+        """
+        with gzip.open(os.path.join(self.directory, segment['segment']), 'rb') as segment_file:
+            for line in segment_file:
+                event = json.loads(line.decode('utf-8'))
+                event['time'] = parse_datetime(event['time'])
+                event['time_expires'] = parse_datetime(event['time_expires'])
+                for seen in event['seen']:
+                    seen['time_seen'] = parse_datetime(seen['time_seen'])
+                yield event
+
+
+class _SegmentWriter(object):
+    """Writes the events of a segment to a temporary file, which is
+    renamed to the name of the segment once it is complete.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = 0
+        self.event_ids = []
+        self.uuids = []
+        self.min_time = self.max_time = None
+        # Each segment has its own temporary file, so archives run at the
+        # same time on a directory do not write to each other's segments
+        descriptor, self._path = tempfile.mkstemp(prefix='.segment-', suffix='.tmp', dir=directory)
+        self._raw_file = os.fdopen(descriptor, 'wb')
+        self._file = gzip.GzipFile(fileobj=self._raw_file, mode='wb')
+
+    @property
+    def size(self):
+        """The compressed bytes written so far.
+        """
+        return self._raw_file.tell()
+
+    def write(self, record):
+        self._file.write(json.dumps(record, sort_keys=True).encode('utf-8') + b'\n')
+        self.count += 1
+        self.event_ids.append(record['id'])
+        self.uuids.append(record['uuid'])
+        if self.min_time is None or record['time'] < self.min_time:
+            self.min_time = record['time']
+        if self.max_time is None or record['time'] > self.max_time:
+            self.max_time = record['time']
+
+    def close(self):
+        """Finish the segment and its uuid file, and return its index
+        entry.
+        """
+        self._file.close()
+        _sync(self._raw_file)
+        self._raw_file.close()
+
+        name = 'events-{0:012d}-{1:012d}'.format(self.event_ids[0], self.event_ids[-1])
+        with io.open(os.path.join(self.directory, name + '.uuids'), 'w', encoding='utf-8') as uuids_file:
+            uuids_file.writelines(u'{0}\n'.format(uuid) for uuid in sorted(self.uuids))
+            _sync(uuids_file)
+        os.rename(self._path, os.path.join(self.directory, name + '.ndjson.gz'))
+
+        return {
+            'segment': name + '.ndjson.gz',
+            'uuids': name + '.uuids',
+            'count': self.count,
+            'min_time': self.min_time,
+            'max_time': self.max_time,
+            'min_uuid': min(self.uuids),
+            'max_uuid': max(self.uuids),
+        }
+
+    def discard(self):
+        self._file.close()
+        self._raw_file.close()
+        os.remove(self._path)
+
+
+def _event_batches(events, batch_size):
+    """Return lists of events from a queryset ordered by id, reading at
+    most ``batch_size`` events at a time.
+    """
+    last_id = 0
+    while True:
+        batch = list(events.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+def _event_records(events):
+    """Return the archive records of a batch of events.
+    """
+    actors = {}
+    seen = {}
+    for event_ids in _chunked([event.id for event in events]):
+        for event_id, entity_id in EventActor.objects.filter(event__in=event_ids).values_list('event', 'entity'):
+            actors.setdefault(event_id, []).append(entity_id)
+        for event_id, medium_id, time_seen in EventSeen.objects.filter(
+                event__in=event_ids).values_list('event', 'medium', 'time_seen'):
+            seen.setdefault(event_id, []).append({'medium_id': medium_id, 'time_seen': _format_time(time_seen)})
+
+    return [{
+        'id': event.id,
+        'uuid': event.uuid,
+        'source_id': event.source_id,
+        'source': event.source.name,
+        'time': _format_time(event.time),
+        'time_expires': _format_time(event.time_expires),
+        'context': event.context,
+        'actors': sorted(actors.get(event.id, [])),
+        'seen': sorted(seen.get(event.id, []), key=lambda s: s['medium_id']),
+    } for event in events]
+
+
+def _append_line(path, entry):
+    """Append a line of JSON to a file, and sync it to disk.
+    """
+    with io.open(path, 'a', encoding='utf-8') as index_file:
+        index_file.write(u'{0}\n'.format(json.dumps(entry, sort_keys=True)))
+        _sync(index_file)
+
+
+def _sync(open_file):
+    open_file.flush()
+    os.fsync(open_file.fileno())
+
+
+def _format_time(time):
+    return time.strftime(_TIME_FORMAT)
@@ -0,0 +1,188 @@
+"""
+Buffered creation of events, so code that handles requests does not
+wait for events to be written.
+"""
+import atexit
+import logging
+from threading import Condition, Thread
+from weakref import WeakSet
+
+from django.core.signals import request_finished
+from django.db import connections
+
+from entity_event.models import Event
+
+
+logger = logging.getLogger(__name__)
+
+# The buffers to close when the process exits
+_open_buffers = WeakSet()
+
+
+class EventBuffer(object):
+    """A buffer of events waiting to be created.
+
+    Events added to the buffer are created in batches with
+    ``Event.objects.bulk_create_events``. Each batch is created in a
+    single transaction, so either all of its events and their actors
+    are created, or none of them are. A batch is written when the
+    buffer holds ``max_size`` events, and, if a background thread is
+    used, at least every ``max_delay`` seconds.
+
+    .. code-block:: python
+
+        event_buffer = EventBuffer(max_size=200, max_delay=2)
+
+        def tag_photo(request, photo_id):
+            ...
+            event_buffer.add(source=photo_tag_source, context={'photo_id': photo_id},
+                             uuid='tag-{0}'.format(tag.id), actors=[tagged_entity])
+
+    Since events are written after they are added, the following must
+    be considered before buffering events:
+
+    - Events that have not been written are lost if the process is
+      killed. With a background thread, at most ``max_size`` events,
+      added within the last ``max_delay`` seconds, can be lost. Events
+      are written when the process exits normally, and after every
+      request if ``flush_on_request_finished`` is set.
+    - Buffered events are written outside of the transaction they
+      were added in, so they are created even if that transaction is
+      rolled back, and are not visible to it.
+    - If a batch fails to be written by the background thread, the
+      error is logged to the ``entity_event.buffer`` logger and the
+      events of the batch are discarded. Errors raised by ``flush``
+      are raised to its caller, and its events are also discarded.
+
+    :type max_size: int (optional)
+    :param max_size: The number of events that causes the buffer to
+        be written.
+
+    :type max_delay: float (optional)
+    :param max_delay: The most seconds an event waits in the buffer
+        before the background thread writes it.
+
+    :type background: Boolean (optional)
+    :param background: If ``False``, no background thread is used, and
+        events are only written by the thread that adds them, when the
+        buffer is full, when it is flushed, or at the end of a
+        request.
+
+    :type flush_on_request_finished: Boolean (optional)
+    :param flush_on_request_finished: If ``True``, the buffer is
+        flushed whenever a request finishes, which is after its
+        response has been sent.
+
+    :type ignore_duplicates: Boolean (optional)
+    :param ignore_duplicates: Passed to ``bulk_create_events`` to skip
+        events with the ``uuid`` of an existing event.
+    """
+    def __init__(
+            self, max_size=500, max_delay=1.0, background=True, flush_on_request_finished=False,
+            ignore_duplicates=False):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.background = background
+        self.ignore_duplicates = ignore_duplicates
+        self._events = []
+        self._condition = Condition()
+        self._thread = None
+        self._closed = False
+
+        if flush_on_request_finished:
+            request_finished.connect(self._flush_on_request_finished, weak=False)
+        _open_buffers.add(self)
+
+    def add(self, **event_kwargs):
+        """Add an event to be created, with the same keyword arguments
+        taken by ``Event.objects.create_event``.
+
+        :raises RuntimeError: If the buffer has been closed.
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Events cannot be added to a closed buffer')
+            self._events.append(event_kwargs)
+            full = len(self._events) >= self.max_size
+            if self.background:
+                self._start_thread()
+                if full:
+                    self._condition.notify()
+
+        if full and not self.background:
+            self.flush()
+
+    def flush(self):
+        """Write all of the buffered events in the calling thread.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(created, skipped)`` as returned
+            by ``bulk_create_events``.
+        """
+        with self._condition:
+            events, self._events = self._events, []
+        return self._write(events)
+
+    def close(self):
+        """Stop the background thread, and write all of the buffered
+        events. No more events can be added once the buffer is closed.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        request_finished.disconnect(self._flush_on_request_finished)
+        _open_buffers.discard(self)
+        self.flush()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._events)
+
+    def _write(self, events):
+        if not events:
+            return 0, 0
+        return Event.objects.bulk_create_events(
+            events, batch_size=len(events), ignore_duplicates=self.ignore_duplicates)
+
+    def _flush_on_request_finished(self, sender, **kwargs):
+        self.flush()
+
+    def _start_thread(self):
+        """Start the background thread, if it is not running. Must be
+        called with the buffer's lock held.
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='entity-event-buffer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        """Write the buffered events whenever the buffer is full or has
+        waited ``max_delay`` seconds, until the buffer is closed.
+        """
+        while True:
+            with self._condition:
+                if not self._closed and len(self._events) < self.max_size:
+                    self._condition.wait(self.max_delay)
+                closed = self._closed
+                events, self._events = self._events, []
+
+            try:
+                self._write(events)
+            except Exception:
+                logger.exception('Failed to write {0} buffered events'.format(len(events)))
+            finally:
+                # The connections of this thread are not closed at the end of requests
+                for connection in connections.all():
+                    connection.close()
+
+            if closed:
+                return
+
+
+@atexit.register
+def _close_open_buffers():
+    for event_buffer in list(_open_buffers):
+        event_buffer.close()
@@ -0,0 +1,721 @@
+"""
+In-process caches of the rows used to route events to mediums and
+entities and to load their contexts, of loaded contexts, and of the
+uuids of recently created events.
+
+The caches are shared by every ``Medium`` instance in the process, and
+are kept coherent between processes with a version number stored in
+Django's default cache. Changing a cached row bumps the version
+through the signal handlers connected in ``entity_event.models``, and
+every process rebuilds its copy the next time it sees a new version.
+
+The signals are sent before a change is committed, so a process that
+loads the rows again before the change is rolled back keeps the rolled
+back rows until they reach their maximum age. ``clear_local_caches``
+discards them at once, and should be called after rolling back a
+transaction that changed any of the cached rows.
+"""
+from collections import Mapping, OrderedDict
+from random import randint
+from threading import Lock
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_by_path
+
+
+class SubscriptionIndex(object):
+    """An index of every subscription, keyed on medium and source.
+
+    The index is built with a single query the first time it is used,
+    and is then used in place of querying the subscriptions of a
+    medium, until a subscription, source or medium is changed.
+    Subscriptions are loaded with their sources and mediums, so the
+    source and medium of a subscription from the index can be used
+    without a further query.
+
+    The index can be disabled with the
+    ``ENTITY_EVENT_SUBSCRIPTION_INDEX`` setting, in which case the
+    subscriptions are queried every time they are needed.
+
+    Since the signals used to invalidate the index are sent before
+    the change is committed, another process may rebuild its index
+    before the change is visible to it. Each index is rebuilt after
+    at most ``ENTITY_EVENT_SUBSCRIPTION_INDEX_MAX_AGE`` seconds
+    (defaulting to 300) to bound how long such a race can leave it
+    out of date, and is the only bound if no shared cache is
+    configured. Changes made with ``QuerySet.update`` do not send
+    signals, so ``invalidate`` must be called after them, and the
+    index rebuilt within a transaction that is then rolled back is
+    kept until ``clear`` or ``clear_local_caches`` is called.
+
+    The subscriptions returned are shared, and should not be
+    modified.
+    """
+    version_key = 'entity_event.subscription_index.version'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._index = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ENTITY_EVENT_SUBSCRIPTION_INDEX', True)
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'ENTITY_EVENT_SUBSCRIPTION_INDEX_MAX_AGE', 300)
+
+    def get(self, medium_id, source_id):
+        """Return the subscriptions of a medium to a source.
+
+        :rtype: Tuple
+        :returns: The subscriptions, in order of id.
+        """
+        if not self.enabled:
+            return tuple(self._load(medium_id=medium_id, source_id=source_id))
+        return self._get_index()[0].get((medium_id, source_id), ())
+
+    def get_many(self, medium_id, source_ids):
+        """Return the subscriptions of a medium to each of the given
+        sources, with a single lookup of the index's version.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{source_id:
+            subscriptions}``, with the subscriptions in order of id.
+        """
+        if not self.enabled:
+            subscriptions = dict((source_id, []) for source_id in source_ids)
+            for sub in self._load(medium_id=medium_id, source_id__in=list(subscriptions)):
+                subscriptions[sub.source_id].append(sub)
+            return dict((source_id, tuple(subs)) for source_id, subs in subscriptions.items())
+        index = self._get_index()[0]
+        return dict((source_id, index.get((medium_id, source_id), ())) for source_id in source_ids)
+
+    def for_medium(self, medium_id):
+        """Return all of the subscriptions of a medium.
+
+        :rtype: Tuple
+        :returns: The subscriptions, in order of id.
+        """
+        if not self.enabled:
+            return tuple(self._load(medium_id=medium_id))
+        return self._get_index()[1].get(medium_id, ())
+
+    def for_source(self, source_id):
+        """Return the subscriptions of every medium to a source.
+
+        :rtype: Tuple
+        :returns: The subscriptions, in order of id.
+        """
+        if not self.enabled:
+            return tuple(self._load(source_id=source_id))
+        return self._get_index()[2].get(source_id, ())
+
+    def invalidate(self):
+        """Discard the index in this and every other process.
+        """
+        _bump_version(self.version_key)
+        self._index = None
+
+    def clear(self):
+        """Discard the index built by this process.
+        """
+        self._index = None
+
+    def stats(self):
+        """Return the number of lookups that were served by the built
+        index, and the number that had to build it first.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{'hits': hits, 'misses':
+            misses}``.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get_index(self):
+        """Return the current index, building it if it is missing, too
+        old or has been invalidated by any process.
+        """
+        version = _get_version(self.version_key)
+        index = self._index
+        if index is not None and index[0] == version and time.time() - index[1] < self.max_age:
+            self.hits += 1
+            return index[2]
+
+        with self._lock:
+            self.misses += 1
+            by_medium_source = {}
+            by_medium = {}
+            by_source = {}
+            for sub in self._load():
+                by_medium_source.setdefault((sub.medium_id, sub.source_id), []).append(sub)
+                by_medium.setdefault(sub.medium_id, []).append(sub)
+                by_source.setdefault(sub.source_id, []).append(sub)
+            lookups = (
+                dict((key, tuple(subs)) for key, subs in by_medium_source.items()),
+                dict((key, tuple(subs)) for key, subs in by_medium.items()),
+                dict((key, tuple(subs)) for key, subs in by_source.items()),
+            )
+            self._index = (version, time.time(), lookups)
+        return lookups
+
+    def _load(self, **filters):
+        """Query the subscriptions with the given filters.
+        """
+        from entity_event.models import Subscription
+        return Subscription.objects.filter(**filters).select_related('source', 'medium').order_by('id')
+
+
+class UnsubscriptionCache(object):
+    """A cache of the entities unsubscribed from each source of each
+    medium.
+
+    The unsubscribed entity ids of a medium and source are loaded the
+    first time they are needed, and are kept as a frozenset, so
+    checking whether an entity is unsubscribed does not depend on how
+    many entities are. Saving or deleting an unsubscription discards
+    the cached unsubscriptions of its medium in every process, using a
+    version number per medium stored in Django's default cache.
+
+    As with the ``SubscriptionIndex``, a process may load the
+    unsubscriptions before a change is committed, so they are reloaded
+    after at most ``ENTITY_EVENT_UNSUBSCRIPTION_CACHE_MAX_AGE`` seconds
+    (defaulting to 300).
+
+    Setting ``ENTITY_EVENT_UNSUBSCRIPTION_CACHE_SIZE`` bounds the
+    number of medium and source pairs kept, discarding the least
+    recently used first. Without it, every pair that is used is kept.
+    The cache can be disabled with the
+    ``ENTITY_EVENT_UNSUBSCRIPTION_CACHE`` setting, in which case the
+    unsubscriptions are queried every time they are needed.
+    """
+    version_key = 'entity_event.unsubscription_cache.version.{0}'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ENTITY_EVENT_UNSUBSCRIPTION_CACHE', True)
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'ENTITY_EVENT_UNSUBSCRIPTION_CACHE_MAX_AGE', 300)
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'ENTITY_EVENT_UNSUBSCRIPTION_CACHE_SIZE', None)
+
+    def for_medium(self, medium_id):
+        """Return the unsubscriptions of a medium, keyed on source id.
+
+        The version of the medium's unsubscriptions is read once, when
+        the mapping is created, and the unsubscriptions of each source
+        are kept by the mapping once they have been looked up, so a
+        mapping can be used for many lookups while processing a batch
+        of events.
+
+        :rtype: MediumUnsubscriptions
+        """
+        return MediumUnsubscriptions(self, medium_id)
+
+    def get_many(self, medium_id, source_ids, version=None):
+        """Return the unsubscribed entity ids of a medium for each of
+        the given sources, loading any that are not cached with a
+        single query.
+
+        :type version: int (optional)
+        :param version: The version of the medium's unsubscriptions
+            to use, if it has already been read.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{source_id:
+            entity_ids}``, where ``entity_ids`` is a frozenset.
+        """
+        if not self.enabled:
+            return self._load(medium_id, source_ids)
+        if version is None:
+            version = self.get_version(medium_id)
+
+        unsubscriptions = {}
+        oldest = time.time() - self.max_age
+        with self._lock:
+            for source_id in source_ids:
+                entry = self._entries.pop((medium_id, source_id), None)
+                if entry is not None and entry[0] == version and entry[1] > oldest:
+                    # Reinsert the entry to mark it as the most recently used
+                    self._entries[(medium_id, source_id)] = entry
+                    unsubscriptions[source_id] = entry[2]
+        self.hits += len(unsubscriptions)
+
+        missing_source_ids = [source_id for source_id in source_ids if source_id not in unsubscriptions]
+        if not missing_source_ids:
+            return unsubscriptions
+        self.misses += len(missing_source_ids)
+        loaded = self._load(medium_id, missing_source_ids)
+
+        with self._lock:
+            for source_id, entity_ids in loaded.items():
+                self._entries[(medium_id, source_id)] = (version, time.time(), entity_ids)
+            while self.max_size is not None and len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        unsubscriptions.update(loaded)
+        return unsubscriptions
+
+    def get_version(self, medium_id):
+        """Return the current version of a medium's unsubscriptions.
+        """
+        return _get_version(self.version_key.format(medium_id))
+
+    def invalidate(self, medium_id):
+        """Discard the unsubscriptions of a medium in this and every
+        other process.
+        """
+        _bump_version(self.version_key.format(medium_id))
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == medium_id]:
+                del self._entries[key]
+
+    def clear(self):
+        """Discard the unsubscriptions cached by this process.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the number of source lookups that were served from
+        the cache, and the number that had to be loaded.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{'hits': hits, 'misses':
+            misses}``.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _load(self, medium_id, source_ids):
+        """Query the unsubscribed entity ids of a medium for each of
+        the given sources.
+        """
+        from entity_event.models import Unsubscription
+        entity_ids = dict((source_id, set()) for source_id in source_ids)
+        unsubscriptions = Unsubscription.objects.filter(
+            medium_id=medium_id, source_id__in=source_ids).values_list('source', 'entity')
+        for source_id, entity_id in unsubscriptions:
+            entity_ids[source_id].add(entity_id)
+        return dict((source_id, frozenset(ids)) for source_id, ids in entity_ids.items())
+
+
+class MediumUnsubscriptions(Mapping):
+    """The unsubscribed entity ids of a medium, keyed on source id,
+    as returned by ``UnsubscriptionCache.for_medium``.
+
+    Looking up a source that has no unsubscriptions returns an empty
+    frozenset, as it did from the ``defaultdict`` previously returned
+    by ``Medium.unsubscriptions``. Only the sources with
+    unsubscriptions are contained in the mapping, and ``get`` returns
+    the default for the others. Iterating over the mapping, or taking
+    its length, loads the unsubscriptions of every source of the
+    medium.
+    """
+    def __init__(self, unsubscription_cache, medium_id):
+        self._cache = unsubscription_cache
+        self._medium_id = medium_id
+        self._version = unsubscription_cache.get_version(medium_id) if unsubscription_cache.enabled else None
+        self._unsubscriptions = {}
+        self._source_ids = None
+
+    def __getitem__(self, source_id):
+        if source_id not in self._unsubscriptions:
+            self.preload([source_id])
+        return self._unsubscriptions[source_id]
+
+    def __contains__(self, source_id):
+        return bool(self[source_id])
+
+    def get(self, source_id, default=None):
+        return self[source_id] or default
+
+    def __iter__(self):
+        if self._source_ids is None:
+            from entity_event.models import Unsubscription
+            self._source_ids = sorted(set(
+                Unsubscription.objects.filter(medium_id=self._medium_id).values_list('source', flat=True)))
+            self.preload(self._source_ids)
+        return iter([source_id for source_id in self._source_ids if self[source_id]])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def preload(self, source_ids):
+        """Look up the unsubscriptions of all of the given sources at
+        once.
+        """
+        source_ids = [source_id for source_id in set(source_ids) if source_id not in self._unsubscriptions]
+        if source_ids:
+            self._unsubscriptions.update(self._cache.get_many(self._medium_id, source_ids, self._version))
+
+
+class SourceCache(object):
+    """A cache of every source, keyed on id, used to look up the source
+    of an event without querying it.
+
+    The sources are loaded with a single query the first time one is
+    needed, and are reloaded when a source is saved or deleted in any
+    process, using a version number stored in Django's default cache,
+    or after at most ``ENTITY_EVENT_SOURCE_CACHE_MAX_AGE`` seconds
+    (defaulting to 300). The cache can be disabled with the
+    ``ENTITY_EVENT_SOURCE_CACHE`` setting, in which case each source is
+    queried when it is needed.
+
+    The sources returned are shared, and should not be modified.
+    """
+    version_key = 'entity_event.source_cache.version'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._sources = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ENTITY_EVENT_SOURCE_CACHE', True)
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'ENTITY_EVENT_SOURCE_CACHE_MAX_AGE', 300)
+
+    def get(self, source_id):
+        """Return the source with the given id.
+
+        :rtype: Source
+        :raises Source.DoesNotExist: If there is no such source.
+        """
+        from entity_event.models import Source
+        if not self.enabled:
+            return Source.objects.get(id=source_id)
+        try:
+            return self._get_sources()[source_id]
+        except KeyError:
+            raise Source.DoesNotExist('Source matching query does not exist.')
+
+    def invalidate(self):
+        """Discard the cached sources in this and every other process.
+        """
+        _bump_version(self.version_key)
+        self._sources = None
+
+    def clear(self):
+        """Discard the sources cached by this process.
+        """
+        self._sources = None
+
+    def stats(self):
+        """Return the number of lookups that were served by the cached
+        sources, and the number that had to load them first.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{'hits': hits, 'misses':
+            misses}``.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get_sources(self):
+        """Return the cached sources, loading them if they are missing,
+        too old or have been invalidated by any process.
+        """
+        from entity_event.models import Source
+        version = _get_version(self.version_key)
+        sources = self._sources
+        if sources is not None and sources[0] == version and time.time() - sources[1] < self.max_age:
+            self.hits += 1
+            return sources[2]
+
+        with self._lock:
+            self.misses += 1
+            by_id = dict((source.id, source) for source in Source.objects.all())
+            self._sources = (version, time.time(), by_id)
+        return by_id
+
+
+class ContextCache(object):
+    """A cache of the contexts loaded by the context loaders of sources,
+    keyed on event id.
+
+    Contexts are only cached for sources with a context loader and a
+    ``context_cache_ttl``, for that many seconds. They are stored in
+    Django's default cache, and in a local tier in each process of up
+    to ``ENTITY_EVENT_CONTEXT_CACHE_LOCAL_SIZE`` contexts (defaulting
+    to 1000), which discards the least recently used first, and can be
+    disabled by setting the size to ``0``. The whole cache can be
+    disabled with the ``ENTITY_EVENT_CONTEXT_CACHE`` setting.
+
+    Each source has a version stored in the default cache, which is
+    part of the key of its contexts, so all of the contexts of a
+    source are discarded in every process by ``invalidate``, which is
+    called whenever the source is saved or deleted. The contexts of
+    particular events can be discarded with ``invalidate_events``,
+    for instance when the data they were loaded from changes,
+    although they remain in the local tiers of other processes until
+    they expire.
+
+    The contexts returned are shared, and should not be modified.
+    """
+    version_key = 'entity_event.context_cache.version.{0}'
+    context_key = 'entity_event.context_cache.{0}.{1}.{2}'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ENTITY_EVENT_CONTEXT_CACHE', True)
+
+    @property
+    def local_size(self):
+        return getattr(settings, 'ENTITY_EVENT_CONTEXT_CACHE_LOCAL_SIZE', 1000)
+
+    def caches(self, source):
+        """Return whether the contexts of a source are cached.
+        """
+        return self.enabled and bool(source.context_loader) and bool(source.context_cache_ttl)
+
+    def get_many(self, source, event_ids, version=None):
+        """Return the cached contexts of events from a source.
+
+        :type version: int (optional)
+        :param version: The version of the source's contexts to use,
+            if it has already been read.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{event_id: context}``,
+            with the events whose contexts are cached.
+        """
+        if version is None:
+            version = self.get_version(source.id)
+
+        contexts = {}
+        now = time.time()
+        with self._lock:
+            for event_id in event_ids:
+                entry = self._entries.pop((source.id, version, event_id), None)
+                if entry is not None and entry[0] > now:
+                    # Reinsert the entry to mark it as the most recently used
+                    self._entries[(source.id, version, event_id)] = entry
+                    contexts[event_id] = entry[1]
+
+        keys = dict(
+            (self.context_key.format(source.id, version, event_id), event_id)
+            for event_id in event_ids if event_id not in contexts
+        )
+        if keys:
+            shared = dict((keys[key], entry) for key, entry in cache.get_many(list(keys)).items())
+            self._set_local(source.id, version, shared)
+            contexts.update((event_id, entry[1]) for event_id, entry in shared.items())
+
+        self.hits += len(contexts)
+        self.misses += len(set(event_ids)) - len(contexts)
+        return contexts
+
+    def set_many(self, source, contexts, version=None):
+        """Cache the loaded contexts of events from a source for the
+        source's ``context_cache_ttl``.
+
+        :type contexts: Dictionary
+        :param contexts: A dictionary of the form ``{event_id:
+            context}``.
+
+        :type version: int (optional)
+        :param version: The version of the source's contexts read
+            before the contexts were loaded, so contexts loaded before
+            the source was invalidated are not cached as current.
+        """
+        if version is None:
+            version = self.get_version(source.id)
+        expires = time.time() + source.context_cache_ttl
+        entries = dict((event_id, (expires, context)) for event_id, context in contexts.items())
+        cache.set_many(
+            dict((self.context_key.format(source.id, version, event_id), entry) for event_id, entry in entries.items()),
+            source.context_cache_ttl)
+        self._set_local(source.id, version, entries)
+
+    def get_version(self, source_id):
+        """Return the current version of a source's contexts.
+        """
+        return _get_version(self.version_key.format(source_id))
+
+    def invalidate(self, source_id):
+        """Discard the cached contexts of a source in this and every
+        other process.
+        """
+        _bump_version(self.version_key.format(source_id))
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == source_id]:
+                del self._entries[key]
+
+    def clear(self):
+        """Discard the contexts cached by this process, leaving those
+        in the shared cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate_events(self, source_id, event_ids):
+        """Discard the cached contexts of events from a source from the
+        shared cache and from this process.
+        """
+        version = self.get_version(source_id)
+        cache.delete_many([self.context_key.format(source_id, version, event_id) for event_id in event_ids])
+        with self._lock:
+            for event_id in event_ids:
+                self._entries.pop((source_id, version, event_id), None)
+
+    def stats(self):
+        """Return the number of contexts that were served from the
+        cache, and the number that had to be loaded.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{'hits': hits, 'misses':
+            misses}``.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _set_local(self, source_id, version, entries):
+        """Add entries of the form ``(expires, context)``, keyed on event
+        id, to the local tier.
+        """
+        local_size = self.local_size
+        if not local_size:
+            return
+        with self._lock:
+            for event_id, entry in entries.items():
+                self._entries.pop((source_id, version, event_id), None)
+                self._entries[(source_id, version, event_id)] = entry
+            while len(self._entries) > local_size:
+                self._entries.popitem(last=False)
+
+
+class ContextLoaders(object):
+    """A registry of context loader functions, keyed on their import
+    path, so each path is only imported and resolved once per process.
+    """
+    def __init__(self):
+        self._loaders = {}
+
+    def get(self, path):
+        """Return the function with the given import path.
+
+        :raises ImproperlyConfigured: If the path cannot be imported.
+        """
+        loader = self._loaders.get(path)
+        if loader is None:
+            loader = self._loaders[path] = import_by_path(path)
+        return loader
+
+
+class RecentEventUuids(object):
+    """A bounded set of the uuids of events known to exist, used by
+    ``Event.objects.create_event`` to skip creating obvious duplicates
+    without querying the database.
+
+    Its size is set with ``ENTITY_EVENT_RECENT_UUIDS_SIZE``, discarding
+    the least recently used uuids first, and it is disabled when the
+    size is ``0``, which is the default. Uuids are only added once the
+    event is committed, but deleting an event does not remove its uuid,
+    so the set should not be enabled if events are deleted and then
+    created again with the same uuid.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._uuids = OrderedDict()
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'ENTITY_EVENT_RECENT_UUIDS_SIZE', 0)
+
+    def __contains__(self, uuid):
+        with self._lock:
+            if self._uuids.pop(uuid, None) is None:
+                return False
+            self._uuids[uuid] = True
+            return True
+
+    def add(self, uuid):
+        """Record that an event with the given uuid exists.
+        """
+        max_size = self.max_size
+        with self._lock:
+            self._uuids.pop(uuid, None)
+            if max_size:
+                self._uuids[uuid] = True
+            while len(self._uuids) > max_size:
+                self._uuids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._uuids.clear()
+
+
+def clear_local_caches():
+    """Discard the subscriptions, unsubscriptions, sources and contexts
+    cached by this process, so they are loaded again the next time they
+    are needed.
+
+    This does not change the versions shared with other processes, so
+    it only affects the process it is called in, where a transaction
+    that changed the cached rows was rolled back.
+    """
+    subscription_index.clear()
+    unsubscription_cache.clear()
+    source_cache.clear()
+    context_cache.clear()
+
+
+def _get_version(version_key):
+    """Return the current version stored under the given key, setting
+    one if there is none.
+    """
+    version = cache.get(version_key)
+    if version is None:
+        version = _add_version(version_key)
+    return version
+
+
+def _bump_version(version_key):
+    """Change the version stored under the given key.
+    """
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # The version has not been set, or has been evicted
+        _add_version(version_key)
+
+
+def _add_version(version_key):
+    """Set a version number that has not been used before, unless
+    another process has just set one, and return the version.
+
+    A random starting version is used so that a process that cached
+    data before the version was evicted does not mistake a restarted
+    count for the version it cached.
+    """
+    cache.add(version_key, randint(1, 2 ** 30), None)
+    return cache.get(version_key)
+
+
+subscription_index = SubscriptionIndex()
+unsubscription_cache = UnsubscriptionCache()
+source_cache = SourceCache()
+context_cache = ContextCache()
+context_loaders = ContextLoaders()
+recent_event_uuids = RecentEventUuids()
@@ -0,0 +1,172 @@
+"""
+Streaming import of large numbers of events.
+
+On PostgreSQL, events are copied into a temporary staging table with
+``COPY FROM STDIN``, which is much faster than inserting them, and are
+then merged into the event and actor tables with a single statement
+that skips events with the uuid of an existing event. On other
+databases, events are imported with ``Event.objects.bulk_create_events``.
+"""
+from io import BytesIO
+from itertools import islice
+import json
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils.dateparse import parse_datetime
+import six
+
+from entity_event.models import Event, EventActor, Source, _chunked
+
+
+def import_events(event_specs, batch_size=10000, using=DEFAULT_DB_ALIAS):
+    """Import events, with their actors, skipping events with the same
+    uuid as an existing event or an earlier imported event.
+
+    .. code-block:: python
+
+        with open('events.ndjson') as events_file:
+            created, skipped = import_events(read_ndjson(events_file))
+
+    :type event_specs: iterable of dicts
+    :param event_specs: The events to import, in the same form as
+        those taken by ``Event.objects.bulk_create_events``. The
+        iterable is consumed one batch at a time, so it can be a
+        generator over more events than fit in memory.
+
+    :type batch_size: int (optional)
+    :param batch_size: The number of events imported at a time. Each
+        batch is imported in its own transaction.
+
+    :type using: str (optional)
+    :param using: The alias of the database to import the events to.
+
+    :rtype: Tuple
+    :returns: A tuple in the form ``(created, skipped)``, with the
+        number of events created and the number skipped as duplicates.
+    """
+    events = Event.objects.db_manager(using)
+    if connections[using].vendor != 'postgresql':
+        return events.bulk_create_events(event_specs, batch_size=batch_size, ignore_duplicates=True)
+
+    created = skipped = 0
+    event_specs = iter(event_specs)
+    while True:
+        batch = list(islice(event_specs, batch_size))
+        if not batch:
+            return created, skipped
+        batch_created = _copy_batch(events, batch)
+        created += batch_created
+        skipped += len(batch) - batch_created
+
+
+def read_ndjson(lines):
+    """Read event specs from newline delimited JSON, with one event per
+    line, for ``import_events``.
+
+    Each line is an object with the keyword arguments taken by
+    ``Event.objects.create_event``, except that the source is given by
+    its name as ``source``, or its id as ``source_id``, actors are
+    given as entity ids, and ``time_expires`` is given as an ISO 8601
+    string. Blank lines are skipped. For example::
+
+        {"source": "photo_tag", "context": {"photo_id": 1}, "uuid": "tag-1", "actors": [3, 4]}
+
+    :type lines: iterable of str
+    :param lines: The lines to read, such as an open file.
+
+    :rtype: Generator of dicts
+    :raises ValueError: If a line is not valid JSON or names a source
+        that does not exist.
+    """
+    source_ids = {}
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            spec = json.loads(line)
+        except ValueError as error:
+            raise ValueError('Invalid JSON on line {0}: {1}'.format(line_number, error))
+
+        if 'source' in spec:
+            name = spec.pop('source')
+            if name not in source_ids:
+                try:
+                    source_ids[name] = Source.objects.get(name=name).id
+                except Source.DoesNotExist:
+                    raise ValueError('Unknown source {0!r} on line {1}'.format(name, line_number))
+            spec['source_id'] = source_ids[name]
+        if spec.get('time_expires') is not None:
+            spec['time_expires'] = parse_datetime(spec['time_expires'])
+        yield spec
+
+
+@transaction.atomic
+def _copy_batch(events, event_specs):
+    """Copy a batch of events into a staging table and merge them into
+    the event and actor tables, returning the number of events created.
+    """
+    connection = connections[events.db]
+    quote_name = connection.ops.quote_name
+    new_events, actors = events._events_from_specs(event_specs, ignore_duplicates=True)
+    fields = [field for field in Event._meta.local_fields if field is not Event._meta.pk]
+    columns = [quote_name(field.column) for field in fields]
+
+    rows = (
+        [field.get_db_prep_save(field.pre_save(event, True), connection=connection) for field in fields] +
+        ['{{{0}}}'.format(','.join(str(actor) for actor in actors[event.uuid]))]
+        for event in new_events
+    )
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'CREATE TEMPORARY TABLE entity_event_staging ('
+        'ordinal serial, {columns}, actors integer[])'.format(columns=', '.join(
+            '{0} {1}'.format(column, field.db_type(connection)) for column, field in zip(columns, fields))))
+    cursor.copy_expert(
+        'COPY entity_event_staging ({columns}, actors) FROM STDIN WITH CSV'.format(columns=', '.join(columns)),
+        _csv_file(rows))
+
+    # Events are inserted in the order they were given, and the first of
+    # any events sharing a uuid is kept
+    uuid_column = quote_name(Event._meta.get_field('uuid').column)
+    cursor.execute(
+        'WITH staged AS ('
+        '    SELECT DISTINCT ON ({uuid}) * FROM entity_event_staging ORDER BY {uuid}, ordinal'
+        '), inserted AS ('
+        '    INSERT INTO {event_table} ({columns})'
+        '    SELECT {columns} FROM staged ORDER BY ordinal'
+        '    ON CONFLICT ({uuid}) DO NOTHING RETURNING {id}, {uuid}'
+        '), inserted_actors AS ('
+        '    INSERT INTO {actor_table} ({actor_event}, {actor_entity})'
+        '    SELECT inserted.{id}, unnest(staged.actors) FROM inserted JOIN staged USING ({uuid})'
+        ') SELECT {id} FROM inserted'.format(
+            uuid=uuid_column,
+            id=quote_name(Event._meta.pk.column),
+            columns=', '.join(columns),
+            event_table=quote_name(Event._meta.db_table),
+            actor_table=quote_name(EventActor._meta.db_table),
+            actor_event=quote_name(EventActor._meta.get_field('event').column),
+            actor_entity=quote_name(EventActor._meta.get_field('entity').column),
+        ))
+    event_ids = [event_id for event_id, in cursor.fetchall()]
+    cursor.execute('DROP TABLE entity_event_staging')
+
+    for chunk in _chunked(event_ids):
+        events._fan_out(list(events.filter(id__in=chunk)))
+    return len(event_ids)
+
+
+def _csv_file(rows):
+    """Return a UTF-8 encoded file of the given rows in CSV format, as
+    read by ``COPY``. Every value is quoted, so empty strings are not
+    read as nulls, which none of the copied columns allow.
+
+    The rows are formatted directly, rather than with the ``csv``
+    module, which reads and writes bytes on Python 2 and text on
+    Python 3.
+    """
+    return BytesIO(u''.join(
+        u'{0}\n'.format(u','.join(
+            u'"{0}"'.format(six.text_type(value).replace(u'"', u'""')) for value in row
+        )) for row in rows
+    ).encode('utf-8'))
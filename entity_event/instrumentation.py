@@ -0,0 +1,286 @@
+"""
+Measurements of the time, queries and results of retrieving and
+creating events, to find which part of a slow call is slow.
+
+The public methods of ``Medium`` that retrieve events and
+``EventManager.create_event`` each record a ``Measurement`` when they
+are called, with the time and number of queries of the call and of each
+phase of the work it does, and pass it to every sink. A sink is any
+callable that takes a measurement, such as ``log_sink`` or a
+``StatsdSink``, and is added with ``add_sink``. Receivers of the
+``measured`` signal are also sent every measurement.
+
+Nothing is measured while there are no sinks and no receivers of the
+signal, so the methods only check whether there are any when they are
+called.
+"""
+from collections import OrderedDict
+from functools import wraps
+import logging
+from threading import local
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.dispatch import Signal
+
+
+logger = logging.getLogger(__name__)
+
+# Sent with every measurement, once the measured call has returned
+measured = Signal(providing_args=['measurement'])
+
+_sinks = []
+
+
+class _Local(local):
+    """The measurements of the calls in progress on each thread,
+    outermost first, and the phase being measured, if any.
+    """
+    measurements = ()
+    phase = None
+    logging_connections = ()
+
+
+_local = _Local()
+
+
+class Measurement(object):
+    """The measurement of a call of an instrumented method.
+
+    :ivar name: The name of the method, such as
+        ``medium.events_targets`` or ``event_manager.create_event``.
+    :ivar medium: The name of the medium the method was called on, or
+        ``None`` for methods not called on a medium.
+    :ivar duration: The seconds the call took.
+    :ivar queries: The number of queries made during the call.
+    :ivar rows: The number of events returned, or ``None`` if the
+        method returns a queryset that is evaluated after the call.
+    :ivar targets: The total number of targets returned with the
+        events, or ``None`` for methods that do not return targets.
+    :ivar phases: The ``duration`` and ``queries`` of each phase of the
+        call, keyed on phase name, in the order the phases started. A
+        phase entered several times, such as the subscription load for
+        each event, is totalled.
+    :ivar error: The exception raised by the call, if any.
+    """
+    def __init__(self, name, medium=None):
+        self.name = name
+        self.medium = medium
+        self.duration = None
+        self.queries = 0
+        self.rows = None
+        self.targets = None
+        self.phases = OrderedDict()
+        self.error = None
+
+    def __str__(self):
+        description = '{0}{1} took {2:.1f}ms with {3} queries'.format(
+            self.name, '' if self.medium is None else ' on {0}'.format(self.medium),
+            self.duration * 1000, self.queries)
+        if self.rows is not None:
+            description += ', {0} rows'.format(self.rows)
+        if self.targets is not None:
+            description += ', {0} targets'.format(self.targets)
+        if self.phases:
+            description += ' ({0})'.format(', '.join(
+                '{0} {1:.1f}ms with {2} queries'.format(name, phase['duration'] * 1000, phase['queries'])
+                for name, phase in self.phases.items()
+            ))
+        if self.error is not None:
+            description += ' and raised {0!r}'.format(self.error)
+        return description
+
+
+def add_sink(sink):
+    """Send every measurement to a sink.
+
+    :type sink: callable
+    :param sink: A function taking a ``Measurement``. Errors raised by
+        the sink are logged, and do not affect the measured call.
+    """
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """Stop sending measurements to a sink added with ``add_sink``.
+    """
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def log_sink(measurement):
+    """A sink that logs each measurement on a line to the
+    ``entity_event.instrumentation`` logger, at ``INFO`` level.
+    """
+    logger.info('%s', measurement)
+
+
+class StatsdSink(object):
+    """A sink that sends measurements to a statsd style client, with
+    ``timing(stat, milliseconds)`` and ``incr(stat, count)`` methods.
+
+    The time of each call is sent as ``<prefix>.<name>``, and that of
+    each of its phases as ``<prefix>.<name>.<phase>``. The numbers of
+    queries, rows and targets are counted in
+    ``<prefix>.<name>.queries``, ``<prefix>.<name>.rows`` and
+    ``<prefix>.<name>.targets``.
+
+    .. code-block:: python
+
+        add_sink(StatsdSink(statsd.StatsClient()))
+    """
+    def __init__(self, client, prefix='entity_event'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, measurement):
+        stat = '{0}.{1}'.format(self.prefix, measurement.name)
+        self.client.timing(stat, measurement.duration * 1000)
+        for name, phase in measurement.phases.items():
+            self.client.timing('{0}.{1}'.format(stat, name), phase['duration'] * 1000)
+        self.client.incr('{0}.queries'.format(stat), measurement.queries)
+        if measurement.rows is not None:
+            self.client.incr('{0}.rows'.format(stat), measurement.rows)
+        if measurement.targets is not None:
+            self.client.incr('{0}.targets'.format(stat), measurement.targets)
+
+
+def instrumented(name, summarize=None, medium=False):
+    """Decorate a method to record a measurement of each call, if there
+    are any sinks or receivers of ``measured``.
+
+    :type name: str
+    :param name: The name of the measurements.
+
+    :type summarize: callable (optional)
+    :param summarize: A function called with the measurement and the
+        method's result, to set the ``rows`` and ``targets`` of the
+        measurement.
+
+    :type medium: Boolean (optional)
+    :param medium: If ``True``, the method is a method of ``Medium``,
+        and the measurements record the medium's name.
+    """
+    def decorator(method):
+        @wraps(method)
+        def instrumented_method(self, *args, **kwargs):
+            if not _sinks and not measured.receivers:
+                return method(self, *args, **kwargs)
+
+            measurement = Measurement(name, self.name if medium else None)
+            with _Measuring(measurement):
+                result = method(self, *args, **kwargs)
+                if summarize is not None:
+                    summarize(measurement, result)
+            return result
+        return instrumented_method
+    return decorator
+
+
+def phase(name):
+    """Return a context manager measuring a phase of the calls being
+    measured on this thread.
+
+    Every measurement in progress on the thread records the phase, so
+    the phases of a measured method called by another are also
+    recorded for the outer call. Phases do not nest: the time spent in
+    a phase entered while another is being measured is only counted
+    in the outer phase.
+
+    .. code-block:: python
+
+        with phase('subscription_load'):
+            subscriptions = subscription_index.for_medium(self.id)
+    """
+    if not _local.measurements or _local.phase is not None:
+        return _NO_PHASE
+    return _Phase(name)
+
+
+class _Measuring(object):
+    """Measures the time and queries of a call, and sends the
+    measurement to the sinks when it ends.
+
+    While any call is being measured on a thread, queries are logged
+    to the ``queries`` of the thread's connections, as they are when
+    ``DEBUG`` is set, so they can be counted. The queries logged only
+    for the measurement are removed once the outermost measurement
+    ends.
+    """
+    def __init__(self, measurement):
+        self.measurement = measurement
+
+    def __enter__(self):
+        if not _local.measurements:
+            _local.measurements = []
+            _local.logging_connections = [
+                (connection, connection.use_debug_cursor, len(connection.queries))
+                for connection in connections.all()
+            ]
+            for connection in connections.all():
+                connection.use_debug_cursor = True
+        _local.measurements.append(self.measurement)
+        self.start_queries = _query_count()
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        measurement = self.measurement
+        measurement.duration = time.time() - self.start
+        measurement.queries = _query_count() - self.start_queries
+        measurement.error = exc_value
+
+        _local.measurements.pop()
+        if not _local.measurements:
+            for connection, use_debug_cursor, start_queries in _local.logging_connections:
+                connection.use_debug_cursor = use_debug_cursor
+                if not (use_debug_cursor or (use_debug_cursor is None and settings.DEBUG)):
+                    del connection.queries[start_queries:]
+            _local.logging_connections = ()
+
+        for sink in list(_sinks):
+            try:
+                sink(measurement)
+            except Exception:
+                logger.exception('Failed to send the measurement of {0} to {1!r}'.format(measurement.name, sink))
+        for receiver, response in measured.send_robust(sender=Measurement, measurement=measurement):
+            if isinstance(response, Exception):
+                logger.error('Failed to send the measurement of {0} to {1!r}: {2!r}'.format(
+                    measurement.name, receiver, response))
+
+
+class _Phase(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _local.phase = self
+        self.start_queries = _query_count()
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        queries = _query_count() - self.start_queries
+        _local.phase = None
+        for measurement in _local.measurements:
+            totals = measurement.phases.setdefault(self.name, {'duration': 0, 'queries': 0})
+            totals['duration'] += duration
+            totals['queries'] += queries
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def _query_count():
+    """Return the number of queries logged on the thread's connections.
+    """
+    return sum(len(connection.queries) for connection in connections.all())
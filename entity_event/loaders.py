@@ -0,0 +1,32 @@
+"""
+Helpers for writing context loaders.
+"""
+from functools import wraps
+
+
+def batch_context_loader(load_contexts):
+    """Make a context loader from a function that loads many contexts
+    at once.
+
+    The decorated function takes a list of contexts and returns a list
+    of the loaded contexts, in the same order. It can still be used as
+    the ``context_loader`` of a source, and is called with a single
+    context by ``Event.get_context``, but ``Source.get_contexts`` and
+    ``EventQuerySet.load_contexts`` call it once with every context of
+    the source, so it can load the data for all of them together.
+
+    .. code-block:: python
+
+        @batch_context_loader
+        def load_photo_contexts(contexts):
+            photos = Photo.objects.in_bulk([context['photo_id'] for context in contexts])
+            for context in contexts:
+                context['photo_path'] = photos[context['photo_id']].path
+            return contexts
+    """
+    @wraps(load_contexts)
+    def load_context(context):
+        return load_contexts([context])[0]
+
+    load_context.load_many = load_contexts
+    return load_context
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from entity_event.archive import archive_events
+
+
+class Command(BaseCommand):
+    """Archive old events to compressed segments in a directory, and
+    delete them from the database, using
+    ``entity_event.archive.archive_events``.
+    """
+    args = '<directory>'
+    help = 'Archive events older than a number of days to a directory, and delete them from the database.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--older-than-days', action='store', dest='older_than_days', type='int', default=None,
+            help='Archive events that occurred more than this many days ago.'),
+        make_option(
+            '--segment-size', action='store', dest='segment_size', type='int', default=64,
+            help='The compressed size of each segment, in megabytes.'),
+        make_option(
+            '--batch-size', action='store', dest='batch_size', type='int', default=1000,
+            help='The number of events to read from the database at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('An archive directory must be given')
+        if options['older_than_days'] is None:
+            raise CommandError('--older-than-days must be given')
+
+        archived, segments = archive_events(
+            args[0], datetime.utcnow() - timedelta(days=options['older_than_days']),
+            segment_size=options['segment_size'] * 1024 * 1024, batch_size=options['batch_size'])
+        for segment in segments:
+            self.stdout.write('Wrote {0}'.format(segment))
+        self.stdout.write('Archived {0} events in {1} segments'.format(archived, len(segments)))
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from entity_event.models import Medium
+
+
+class Command(BaseCommand):
+    """Rebuild the inboxes of mediums that fan out events on write.
+
+    By default every medium with ``fan_out_on_write`` set is rebuilt.
+    Mediums can be chosen by name instead, by passing their names as
+    arguments.
+    """
+    args = '[medium_name ...]'
+    help = 'Rebuild the inboxes of mediums that fan out events when they are created.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--chunk-size', action='store', dest='chunk_size', type='int', default=500,
+            help='The number of events to resolve targets for at a time.'),
+    )
+
+    def handle(self, *medium_names, **options):
+        if medium_names:
+            mediums = Medium.objects.filter(name__in=medium_names)
+            missing = set(medium_names) - set(medium.name for medium in mediums)
+            if missing:
+                raise CommandError('Unknown mediums: {0}'.format(', '.join(sorted(missing))))
+        else:
+            mediums = Medium.objects.filter(fan_out_on_write=True)
+
+        for medium in mediums:
+            medium.backfill_inbox(chunk_size=options['chunk_size'])
+            self.stdout.write('Rebuilt inboxes for {0}'.format(medium.name))
@@ -0,0 +1,94 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+from entity.models import Entity
+from six import text_type
+
+from entity_event.models import EventSeen, Medium
+
+
+class Command(BaseCommand):
+    """Print the database's query plans for the queries of the first
+    page of a medium's events, to check which indexes they use.
+
+    Running the command before and after changing indexes, against a
+    copy of production data, shows how the change affects each query.
+    With ``--analyze`` on PostgreSQL the queries are also run, and the
+    plans include their actual row counts and times.
+    """
+    args = '<medium name>'
+    help = 'Print the query plans of the event queries of a medium.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--entity', type='int', dest='entity_id', default=None,
+            help='The id of an entity to explain the entity event queries of.'),
+        make_option(
+            '--page-size', type='int', dest='page_size', default=20,
+            help='The number of events on the page of each query.'),
+        make_option(
+            '--analyze', action='store_true', dest='analyze', default=False,
+            help='Run the queries and include their actual times, on PostgreSQL.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('A medium name must be given')
+        try:
+            medium = Medium.objects.get(name=args[0])
+        except Medium.DoesNotExist:
+            raise CommandError('Unknown medium {0!r}'.format(args[0]))
+
+        entity = None
+        if options['entity_id'] is not None:
+            try:
+                entity = Entity.objects.get(id=options['entity_id'])
+            except Entity.DoesNotExist:
+                raise CommandError('Unknown entity {0}'.format(options['entity_id']))
+
+        # Feeds show the first page of events, newest first
+        page_size = options['page_size']
+        queries = [
+            ('Events', medium.events()),
+            ('Unseen events', medium.events(seen=False)),
+        ]
+        if entity is not None:
+            queries += [
+                ('Entity events', medium.entity_events(entity)),
+                ('Actor events', medium.events(actor=entity)),
+            ]
+        queries = [(name, events.order_by('-time', '-id')[:page_size]) for name, events in queries]
+
+        page_event_ids = [event.id for event in queries[0][1]]
+        queries.append(('Seen event probe', EventSeen.objects.filter(medium=medium, event__in=page_event_ids)))
+
+        for name, queryset in queries:
+            self.stdout.write('{0}:'.format(name))
+            for line in _explain(queryset, options['analyze']):
+                self.stdout.write('    {0}'.format(line))
+
+
+# The statement prefixing a query to explain it, keyed on database
+# vendor, or on vendor and whether to analyze it, for databases that
+# explain queries differently to the default ``EXPLAIN``
+_EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN',
+    ('postgresql', True): 'EXPLAIN ANALYZE',
+}
+
+
+def _explain(queryset, analyze):
+    """Return the lines of the database's plan for a queryset.
+    """
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return ['No query is made, as there can be no results']
+
+    connection = connections[queryset.db]
+    explain = _EXPLAIN.get((connection.vendor, analyze), _EXPLAIN.get(connection.vendor, 'EXPLAIN'))
+
+    cursor = connection.cursor()
+    cursor.execute('{0} {1}'.format(explain, sql), params)
+    return [' | '.join(text_type(value) for value in row) for row in cursor.fetchall()]
@@ -0,0 +1,39 @@
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from entity_event.ingest import import_events, read_ndjson
+
+
+class Command(BaseCommand):
+    """Import events from newline delimited JSON files.
+
+    Each line of the files is read as an event by
+    ``entity_event.ingest.read_ndjson``, and the events are imported
+    with ``entity_event.ingest.import_events``, skipping duplicates. A
+    file name of ``-`` reads events from standard input.
+    """
+    args = 'file [file ...]'
+    help = 'Import events from newline delimited JSON files, skipping events that already exist.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', action='store', dest='batch_size', type='int', default=10000,
+            help='The number of events to import in each transaction.'),
+    )
+
+    def handle(self, *file_names, **options):
+        if not file_names:
+            raise CommandError('At least one file must be given')
+
+        for file_name in file_names:
+            try:
+                if file_name == '-':
+                    created, skipped = import_events(read_ndjson(sys.stdin), batch_size=options['batch_size'])
+                else:
+                    with open(file_name) as events_file:
+                        created, skipped = import_events(read_ndjson(events_file), batch_size=options['batch_size'])
+            except (IOError, ValueError) as error:
+                raise CommandError('Could not import {0}: {1}'.format(file_name, error))
+            self.stdout.write('Created {0} events and skipped {1} duplicates from {2}'.format(
+                created, skipped, file_name))
@@ -0,0 +1,47 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from entity_event.models import Event
+
+
+class Command(BaseCommand):
+    """Delete expired events, with the rows that refer to them, in
+    batches, using ``Event.objects.purge_expired_events``.
+
+    With ``--older-than-days``, events that occurred more than that
+    many days ago are also deleted. With ``--dry-run``, the events
+    that would be deleted are counted, and nothing is deleted.
+    """
+    help = 'Delete expired events, and the actors, seen events and inbox events that refer to them.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--older-than-days', action='store', dest='older_than_days', type='int', default=None,
+            help='Also delete events that occurred more than this many days ago.'),
+        make_option(
+            '--batch-size', action='store', dest='batch_size', type='int', default=1000,
+            help='The number of events to delete in each transaction.'),
+        make_option(
+            '--sleep', action='store', dest='sleep', type='float', default=0,
+            help='The seconds to wait between batches.'),
+        make_option(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Count the events that would be deleted, without deleting them.'),
+    )
+
+    def handle(self, *args, **options):
+        older_than = None
+        if options['older_than_days'] is not None:
+            older_than = timedelta(days=options['older_than_days'])
+
+        purged = Event.objects.purge_expired_events(
+            older_than=older_than, batch_size=options['batch_size'], sleep=options['sleep'],
+            dry_run=options['dry_run'], progress=self.report_progress)
+        if options['dry_run']:
+            self.stdout.write('{0} events would be deleted'.format(purged))
+        else:
+            self.stdout.write('Deleted {0} events'.format(purged))
+
+    def report_progress(self, deleted):
+        self.stdout.write('Deleted {0} events so far'.format(deleted))
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from entity_event.models import Subscription, SubscriptionMember
+
+
+class Command(BaseCommand):
+    """Rebuild the stored members of every subscription.
+
+    With ``--verify``, the stored members are compared with the
+    current members of the subscriptions instead, without changing
+    them, and the command fails if they differ.
+    """
+    help = 'Rebuild, or verify, the stored members of every subscription.'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--verify', action='store_true', dest='verify', default=False,
+            help='Check that the stored members are up to date, without changing them.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            missing, extra = SubscriptionMember.objects.diff(Subscription.objects.all())
+            if missing or extra:
+                raise CommandError('{0} subscription members are missing and {1} should not be stored'.format(
+                    len(missing), len(extra)))
+            self.stdout.write('Subscription members are up to date')
+        else:
+            with transaction.atomic():
+                created, deleted = SubscriptionMember.objects.rebuild()
+            self.stdout.write('Created {0} and deleted {1} subscription members'.format(created, deleted))
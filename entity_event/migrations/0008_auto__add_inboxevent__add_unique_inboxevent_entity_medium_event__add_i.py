@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'InboxEvent'
+        db.create_table(u'entity_event_inboxevent', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['entity.Entity'])),
+            ('medium', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['entity_event.Medium'])),
+            ('event', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['entity_event.Event'])),
+            ('time', self.gf('django.db.models.fields.DateTimeField')()),
+        ))
+        db.send_create_signal(u'entity_event', ['InboxEvent'])
+
+        # Adding unique constraint on 'InboxEvent', fields ['entity', 'medium', 'event']
+        db.create_unique(u'entity_event_inboxevent', ['entity_id', 'medium_id', 'event_id'])
+
+        # Adding index on 'InboxEvent', fields ['entity', 'medium', 'time']
+        db.create_index(u'entity_event_inboxevent', ['entity_id', 'medium_id', 'time'])
+
+        # Adding field 'Medium.fan_out_on_write'
+        db.add_column(u'entity_event_medium', 'fan_out_on_write',
+                      self.gf('django.db.models.fields.BooleanField')(default=False),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Removing index on 'InboxEvent', fields ['entity', 'medium', 'time']
+        db.delete_index(u'entity_event_inboxevent', ['entity_id', 'medium_id', 'time'])
+
+        # Removing unique constraint on 'InboxEvent', fields ['entity', 'medium', 'event']
+        db.delete_unique(u'entity_event_inboxevent', ['entity_id', 'medium_id', 'event_id'])
+
+        # Deleting model 'InboxEvent'
+        db.delete_table(u'entity_event_inboxevent')
+
+        # Deleting field 'Medium.fan_out_on_write'
+        db.delete_column(u'entity_event_medium', 'fan_out_on_write')
+
+
+    models = {
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'entity.entity': {
+            'Meta': {'unique_together': "(('entity_id', 'entity_type', 'entity_kind'),)", 'object_name': 'Entity'},
+            'display_name': ('django.db.models.fields.TextField', [], {'db_index': 'True', 'blank': 'True'}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'entity_kind': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity.EntityKind']", 'on_delete': 'models.PROTECT'}),
+            'entity_meta': ('jsonfield.fields.JSONField', [], {'null': 'True'}),
+            'entity_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']", 'on_delete': 'models.PROTECT'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'db_index': 'True'})
+        },
+        u'entity.entitykind': {
+            'Meta': {'object_name': 'EntityKind'},
+            'display_name': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '256', 'db_index': 'True'})
+        },
+        u'entity_event.event': {
+            'Meta': {'object_name': 'Event'},
+            'context': ('jsonfield.fields.JSONField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Source']"}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'time_expires': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(9999, 12, 31, 0, 0)', 'db_index': 'True'}),
+            'uuid': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '128'})
+        },
+        u'entity_event.eventactor': {
+            'Meta': {'object_name': 'EventActor'},
+            'entity': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity.Entity']"}),
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Event']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'entity_event.eventlease': {
+            'Meta': {'unique_together': "(('event', 'medium'),)", 'object_name': 'EventLease'},
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Event']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'medium': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Medium']"}),
+            'time_expires': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'token': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'})
+        },
+        u'entity_event.eventseen': {
+            'Meta': {'unique_together': "(('event', 'medium'),)", 'object_name': 'EventSeen'},
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Event']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'medium': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Medium']"}),
+            'time_seen': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.utcnow'})
+        },
+        u'entity_event.inboxevent': {
+            'Meta': {'unique_together': "(('entity', 'medium', 'event'),)", 'object_name': 'InboxEvent', 'index_together': "[('entity', 'medium', 'time')]"},
+            'entity': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': u"orm['entity.Entity']"}),
+            'event': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Event']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'medium': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Medium']"}),
+            'time': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'entity_event.medium': {
+            'Meta': {'object_name': 'Medium'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'fan_out_on_write': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'seen_watermark': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'use_seen_watermark': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'entity_event.source': {
+            'Meta': {'object_name': 'Source'},
+            'context_loader': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '256', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'group': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.SourceGroup']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'})
+        },
+        u'entity_event.sourcegroup': {
+            'Meta': {'object_name': 'SourceGroup'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'})
+        },
+        u'entity_event.subscription': {
+            'Meta': {'object_name': 'Subscription'},
+            'entity': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': u"orm['entity.Entity']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'medium': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Medium']"}),
+            'only_following': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Source']"}),
+            'sub_entity_kind': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'related_name': "'+'", 'null': 'True', 'to': u"orm['entity.EntityKind']"})
+        },
+        u'entity_event.unsubscription': {
+            'Meta': {'object_name': 'Unsubscription'},
+            'entity': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity.Entity']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'medium': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Medium']"}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['entity_event.Source']"})
+        }
+    }
+
+    complete_apps = ['entity_event']
\ No newline at end of file
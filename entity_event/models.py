@@ -1,19 +1,80 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import chain, islice
 from operator import or_
+import time
+from uuid import uuid4
 
-from cached_property import cached_property
+from django.conf import settings
 from django.core.exceptions import ValidationError, ImproperlyConfigured
-from django.db import models, transaction
-from django.db.models import Q
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Max, Q
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
-from django.utils.module_loading import import_by_path
 import jsonfield
+from manager_utils import post_bulk_operation
+from six import get_unbound_function
 from six.moves import reduce
 
 from entity.models import Entity, EntityKind, EntityRelationship
 
+from entity_event.cache import (
+    context_cache, context_loaders, recent_event_uuids, source_cache, subscription_index, unsubscription_cache
+)
+from entity_event.instrumentation import instrumented, phase
+
+
+# The most ids sent to the database in a single ``IN`` clause, which
+# keeps queries for large collections under SQLite's parameter limit.
+_ID_CHUNK_SIZE = 500
+
+# The format of the event times stored in pagination cursors.
+_CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# The most events marked as seen by a single ``INSERT`` statement.
+_MARK_SEEN_CHUNK_SIZE = 10000
+
+# The number of events inserted at a time by ``bulk_create_events``.
+_BULK_CREATE_BATCH_SIZE = 1000
+
+# The number of events deleted at a time by ``purge_expired_events``.
+_PURGE_BATCH_SIZE = 1000
+
+# The ``INSERT`` statement, and the clause to add after it, that skip
+# rows conflicting with a unique constraint for each database vendor.
+_INSERT_IGNORING_CONFLICTS = {
+    'postgresql': ('INSERT', ' ON CONFLICT (event_id, medium_id) DO NOTHING'),
+    'sqlite': ('INSERT OR IGNORE', ''),
+    'mysql': ('INSERT IGNORE', ''),
+}
+
+
+# The functions setting the rows and targets of the measurements of
+# each instrumented method, from the method's result.
+def _summarize_events_by_entity(measurement, events_by_entity):
+    measurement.rows = sum(len(events) for events in events_by_entity.values())
+
+
+def _summarize_page(measurement, page):
+    measurement.rows = len(page[0])
+
+
+def _summarize_events_targets(measurement, event_pairs):
+    measurement.rows = len(event_pairs)
+    measurement.targets = sum(len(targets) for event, targets in event_pairs)
+
+
+def _summarize_claim(measurement, claim):
+    measurement.rows = len(claim[1])
+
+
+def _summarize_created_event(measurement, event):
+    measurement.rows = 0 if event is None else 1
+
 
 @python_2_unicode_compatible
 class Medium(models.Model):
@@ -34,6 +95,40 @@ class Medium(models.Model):
     :param description: A human readable description of the
         medium.
 
+    :type use_seen_watermark: (optional) Boolean
+    :param use_seen_watermark: If ``True``, which events have been
+        seen on this medium is tracked by a single "high water mark"
+        event id, ``seen_watermark``, rather than with an
+        ``EventSeen`` object for every event. Every event with an id
+        up to and including the watermark is considered seen. This
+        suits push-style mediums, such as email, which process every
+        unseen event in order, and keeps marking events as seen to a
+        single row update. Marking any events as seen advances the
+        watermark to the largest of their ids, so it also marks any
+        unseen events with smaller ids as seen.
+
+        Event ids are given out when events are inserted, not when
+        they are committed, so an event created in a long transaction
+        can become visible after events with larger ids. To keep the
+        watermark from passing such events before they are delivered,
+        it is only advanced past events created more than
+        ``ENTITY_EVENT_SEEN_WATERMARK_LAG`` seconds ago (defaulting to
+        60). Newer events are returned and marked as seen once they
+        are that old. The lag should be longer than any transaction
+        creating events, such as a batch of ``bulk_create_events`` or
+        ``import_events``, or the events of a longer transaction may
+        never be returned as unseen.
+
+    :type fan_out_on_write: (optional) Boolean
+    :param fan_out_on_write: If ``True``, the targets of each event
+        are resolved once, when the event is created with
+        ``Event.objects.create_event``, and stored as ``InboxEvent``
+        objects. ``entity_events`` then only has to look up the
+        entity's inbox, rather than resolving subscriptions every time
+        it is called. Subscriptions and relationships that change
+        after an event is created do not change the event's targets,
+        unless the inbox is rebuilt with ``backfill_inbox``.
+
     Encoding a ``Medium`` object in the database serves two
     purposes. First, it is referenced when subscriptions are
     created. Second the ``Medium`` objects provide an entry point to
@@ -56,11 +151,17 @@ class Medium(models.Model):
     name = models.CharField(max_length=64, unique=True)
     display_name = models.CharField(max_length=64)
     description = models.TextField()
+    use_seen_watermark = models.BooleanField(default=False)
+    # The id of the last event seen on this medium, when seen events are
+    # tracked with a watermark rather than ``EventSeen`` objects
+    seen_watermark = models.IntegerField(default=0)
+    fan_out_on_write = models.BooleanField(default=False)
 
     def __str__(self):
         """Readable representation of ``Medium`` objects."""
         return self.display_name
 
+    @instrumented('medium.events', medium=True)
     @transaction.atomic
     def events(self, **event_filters):
         """Return subscribed events, with basic filters.
@@ -99,7 +200,8 @@ class Medium(models.Model):
         :type start_time: datetime.datetime (optional)
         :param start_time: Only return events that occurred after the
             given time. If no time is given for this argument, no
-            filtering is done.
+            filtering is done, unless the ``ENTITY_EVENT_QUERY_WINDOW``
+            setting is set.
 
         :type end_time: datetime.datetime (optional)
         :param end_time: Only return events that occurred before the
@@ -134,21 +236,23 @@ class Medium(models.Model):
         :returns: A queryset of events.
         """
         events = self.get_filtered_events(**event_filters)
-        subscriptions = Subscription.objects.filter(medium=self)
+        with phase('subscription_load'):
+            subscriptions = subscription_index.for_medium(self.id)
 
         subscription_q_objects = [
             Q(
                 eventactor__entity__in=self.followed_by(sub.subscribed_entities()),
-                source=sub.source
+                source_id=sub.source_id
             )
             for sub in subscriptions if sub.only_following
         ]
         subscription_q_objects.append(
-            Q(source__in=[sub.source for sub in subscriptions if not sub.only_following]))
+            Q(source__in=[sub.source_id for sub in subscriptions if not sub.only_following]))
 
         events = events.filter(reduce(or_, subscription_q_objects))
         return events
 
+    @instrumented('medium.entity_events', medium=True)
     @transaction.atomic
     def entity_events(self, entity, **event_filters):
         """Return subscribed events for a given entity.
@@ -194,7 +298,8 @@ class Medium(models.Model):
         :type start_time: datetime.datetime (optional)
         :param start_time: Only return events that occurred after the
             given time. If no time is given for this argument, no
-            filtering is done.
+            filtering is done, unless the ``ENTITY_EVENT_QUERY_WINDOW``
+            setting is set.
 
         :type end_time: datetime.datetime (optional)
         :param end_time: Only return events that occurred before the
@@ -225,32 +330,260 @@ class Medium(models.Model):
             marks all the returned events as having been seen by this
             medium.
 
+        The events are returned as a lazy queryset, with the entity's
+        subscriptions and unsubscriptions applied in the database, so
+        it can be sliced, paginated and counted without loading every
+        matching event.
+
         :rtype: EventQuerySet
         :returns: A queryset of events.
         """
         events = self.get_filtered_events(**event_filters)
 
-        subscriptions = Subscription.objects.filter(medium=self)
-        subscriptions = self.subset_subscriptions(subscriptions, entity)
+        if self.fan_out_on_write:
+            events = events.filter(inboxevent__medium=self, inboxevent__entity=entity)
+        else:
+            events = events.filter(self._entity_subscriptions_query(entity))
 
+        unsubscribed_sources = Unsubscription.objects.filter(medium=self, entity=entity).values_list('source')
+        return events.exclude(source__in=unsubscribed_sources)
+
+    def _entity_subscriptions_query(self, entity):
+        """Return a Q object filtering events to those the entity is
+        subscribed to on this medium.
+
+        Events are matched to the entities they follow with a subquery
+        on the event actors, rather than a join, so an event with many
+        actors is still only returned once. The subscriptions of the
+        entity are found from the subscription index, in the same way
+        as ``subset_subscriptions``.
+        """
+        with phase('subscription_load'):
+            super_entity_ids = set(
+                EntityRelationship.objects.filter(sub_entity=entity).values_list('super_entity', flat=True))
+            subscriptions = [
+                sub for sub in subscription_index.for_medium(self.id)
+                if (sub.entity_id == entity.id and sub.sub_entity_kind_id is None) or
+                (sub.entity_id in super_entity_ids and sub.sub_entity_kind_id == entity.entity_kind_id)
+            ]
+
+        followed_actor_event_ids = EventActor.objects.filter(
+            entity__in=self.followed_by(entity)).values_list('event')
         subscription_q_objects = [
-            Q(
-                eventactor__entity__in=self.followed_by(entity),
-                source=sub.source
-            )
+            Q(id__in=followed_actor_event_ids, source_id=sub.source_id)
             for sub in subscriptions if sub.only_following
         ]
         subscription_q_objects.append(
-            Q(source__in=[sub.source for sub in subscriptions if not sub.only_following])
+            Q(source__in=[sub.source_id for sub in subscriptions if not sub.only_following])
         )
+        return reduce(or_, subscription_q_objects)
 
-        return [
-            event for event in events.filter(reduce(or_, subscription_q_objects))
-            if self.filter_source_targets_by_unsubscription(event.source_id, [entity])
-        ]
+    @instrumented('medium.entity_events_bulk', summarize=_summarize_events_by_entity, medium=True)
+    @transaction.atomic
+    def entity_events_bulk(self, entities, **event_filters):
+        """Return subscribed events for each of the given entities.
+
+        This returns the same events for each entity as
+        ``entity_events``, but the subscriptions, group memberships,
+        followed entities, unsubscriptions and events are each loaded
+        once for all of the entities and joined in memory, rather than
+        queried again for every entity. This makes it suitable for
+        rendering the feeds of many entities at once, such as in a
+        digest job:
+
+        .. code-block:: python
+
+            digest_medium = Medium.objects.get(name='digest')
+            entities = Entity.objects.filter(entity_kind__name='user')
+            events_by_entity = digest_medium.entity_events_bulk(entities, seen=False)
+
+            for entity in entities:
+                send_digest(entity, events_by_entity[entity.id])
+
+        The number of queries made does not depend on the number of
+        entities, until they exceed the ``_ID_CHUNK_SIZE`` ids that are
+        sent to the database at once. If a subclass redefines
+        ``followed_by``, it is called once per entity, so the
+        redefined semantics are still respected.
+
+        :type entities: EntityQuerySet or list
+        :param entities: The entities to get events for.
+
+        The event filters are the same as those taken by
+        ``entity_events``.
+
+        :rtype: Dictionary
+        :returns: A dictionary of the form ``{entity_id: events}``,
+            where ``events`` is a list of the events for that entity,
+            in order of id. Every given entity has an entry, even if
+            it has no events.
+        """
+        entities = list(entities)
+        events_by_entity = dict((entity.id, []) for entity in entities)
+        if not entities:
+            return events_by_entity
+
+        events = self.get_filtered_events(**event_filters)
+        if self.fan_out_on_write:
+            events, event_entities = self._inbox_events_by_entity(events, list(events_by_entity))
+        else:
+            events, event_entities = self._subscribed_events_by_entity(events, entities)
+
+        unsubscribed_sources = defaultdict(set)
+        with phase('unsubscription_load'):
+            for entity_ids in _chunked(list(events_by_entity)):
+                unsubscriptions = Unsubscription.objects.filter(
+                    medium=self, entity__in=entity_ids).values_list('entity', 'source')
+                for entity_id, source_id in unsubscriptions:
+                    unsubscribed_sources[entity_id].add(source_id)
+
+        with phase('target_resolution'):
+            for event in sorted(events, key=lambda event: event.id):
+                for entity_id in event_entities[event.id]:
+                    if event.source_id not in unsubscribed_sources[entity_id]:
+                        events_by_entity[entity_id].append(event)
+        return events_by_entity
+
+    def _inbox_events_by_entity(self, events, entity_ids):
+        """Return the events in the inboxes of the given entities, and
+        the ids of the entities whose inbox each event is in, keyed on
+        event id.
+        """
+        event_entities = defaultdict(set)
+        with phase('subscription_load'):
+            for chunk in _chunked(entity_ids):
+                inbox_events = InboxEvent.objects.filter(
+                    medium=self, entity__in=chunk).values_list('event', 'entity')
+                for event_id, entity_id in inbox_events:
+                    event_entities[event_id].add(entity_id)
+        with phase('event_scan'):
+            return _in_bulk(events, list(event_entities)).values(), event_entities
+
+    def _subscribed_events_by_entity(self, events, entities):
+        """Return the events of the sources the given entities are
+        subscribed to, and the ids of the subscribed entities of each
+        event, keyed on event id.
+
+        The subscriptions of every entity are found in memory from a
+        single load of the medium's subscriptions and the entities'
+        super-entities, in the same way as ``subset_subscriptions``.
+        """
+        super_entities = defaultdict(set)
+        subscriptions = defaultdict(list)
+        with phase('subscription_load'):
+            for entity_ids in _chunked([entity.id for entity in entities]):
+                relationships = EntityRelationship.objects.filter(
+                    sub_entity__in=entity_ids).values_list('sub_entity', 'super_entity', 'super_entity__is_active')
+                for sub_entity_id, super_entity_id, is_active in relationships:
+                    super_entities[sub_entity_id].add((super_entity_id, is_active))
+            followed = self._followed_by_entity(entities, super_entities)
+
+            for sub in subscription_index.for_medium(self.id):
+                subscriptions[(sub.entity_id, sub.sub_entity_kind_id)].append(sub)
+
+        # Index who is subscribed to every event of a source, and who is
+        # subscribed to the events of a source with a given actor.
+        source_subscribers = defaultdict(set)
+        actor_subscribers = defaultdict(set)
+        for entity in entities:
+            entity_subscriptions = chain(subscriptions[(entity.id, None)], *[
+                subscriptions[(super_entity_id, entity.entity_kind_id)]
+                for super_entity_id, is_active in super_entities[entity.id]
+            ])
+            for sub in entity_subscriptions:
+                if not sub.only_following:
+                    source_subscribers[sub.source_id].add(entity.id)
+                    continue
+                for followed_id in followed[entity.id]:
+                    actor_subscribers[(sub.source_id, followed_id)].add(entity.id)
+
+        following_source_ids = set(source_id for source_id, actor_id in actor_subscribers)
+        with phase('event_scan'):
+            events = list(events.filter(source__in=following_source_ids | set(source_subscribers)))
+
+        with phase('target_resolution'):
+            actors = _actors_by_event([event.id for event in events if event.source_id in following_source_ids])
+
+            event_entities = {}
+            for event in events:
+                event_entities[event.id] = source_subscribers[event.source_id].union(*[
+                    actor_subscribers[(event.source_id, actor_id)] for actor_id in actors[event.id]
+                ])
+        return events, event_entities
+
+    def _followed_by_entity(self, entities, super_entities):
+        """Return the ids of the entities followed by each of the given
+        entities, keyed on entity id.
+
+        The default definition of ``followed_by`` is resolved from the
+        already loaded super-entities of each entity. If a subclass
+        redefines ``followed_by``, it is called once per entity
+        instead.
+        """
+        if get_unbound_function(type(self).followed_by) is not get_unbound_function(Medium.followed_by):
+            return dict(
+                (entity.id, set(self.followed_by(entity).values_list('id', flat=True))) for entity in entities
+            )
 
+        # Only active entities are followed, as in ``followed_by``
+        followed = {}
+        for entity in entities:
+            followed[entity.id] = set(
+                super_entity_id for super_entity_id, is_active in super_entities[entity.id] if is_active)
+            if entity.is_active:
+                followed[entity.id].add(entity.id)
+        return followed
+
+    @instrumented('medium.events_page', summarize=_summarize_page, medium=True)
+    def events_page(self, cursor=None, page_size=20, entity=None, **event_filters):
+        """Return a page of subscribed events, newest first, and a cursor
+        for the next page.
+
+        Pages are found by their position in the events, rather than
+        by an offset, so fetching a page takes the same time however
+        far into the events it is. This is useful for feeds that can
+        be scrolled back indefinitely:
+
+        .. code-block:: python
+
+            def newsfeed_page(request):
+                newsfeed_medium = Medium.objects.get(name='newsfeed')
+                entity = Entity.objects.get_for_obj(request.user)
+                events, next_cursor = newsfeed_medium.events_page(
+                    cursor=request.GET.get('cursor'), entity=entity)
+                ...
+
+        :type cursor: str (optional)
+        :param cursor: The cursor returned with the previous page. If
+            no cursor is given, the first page is returned.
+
+        :type page_size: int (optional)
+        :param page_size: The most events to return.
+
+        :type entity: Entity (optional)
+        :param entity: If given, the events are those returned by
+            ``entity_events`` for this entity, otherwise they are those
+            returned by ``events``.
+
+        The remaining event filters are the same as those taken by
+        ``events`` and ``entity_events``.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(events, next_cursor)``, where
+            ``events`` is a list of events, and ``next_cursor`` is the
+            cursor for the next page, or ``None`` if this is the last
+            page.
+        """
+        if entity is None:
+            events = self.events(**event_filters)
+        else:
+            events = self.entity_events(entity, **event_filters)
+        with phase('event_scan'):
+            return events.page(cursor, page_size)
+
+    @instrumented('medium.events_targets', summarize=_summarize_events_targets, medium=True)
     @transaction.atomic
-    def events_targets(self, entity_kind=None, **event_filters):
+    def events_targets(self, entity_kind=None, batch=False, **event_filters):
         """Return all events for this medium, with who each event is for.
 
         This method is useful for individually notifying every
@@ -278,6 +611,10 @@ class Medium(models.Model):
         sort of processing should normally occur in a separate thread
         from any request/response cycle.
 
+        If the ``ENTITY_EVENT_QUERY_WINDOW`` setting is set, and no
+        ``start_time`` is given, unseen events older than the window
+        are never returned, and so are never delivered.
+
         Filtering based on the properties of the events themselves is
         supported, through the rest of the following arguments, which
         are optional.
@@ -286,10 +623,19 @@ class Medium(models.Model):
         :param entity_kind: Only include targets of the given kind in
             each targets list.
 
+        :type batch: Boolean (optional)
+        :param batch: If ``True``, the targets of every event are
+            resolved together, using a constant number of queries for
+            the subscriptions, group memberships, actors and
+            unsubscriptions involved, rather than querying them again
+            for every event. The returned tuples are the same either
+            way.
+
         :type start_time: datetime.datetime (optional)
         :param start_time: Only return events that occurred after the
             given time. If no time is given for this argument, no
-            filtering is done.
+            filtering is done, unless the ``ENTITY_EVENT_QUERY_WINDOW``
+            setting is set.
 
         :type end_time: datetime.datetime (optional)
         :param end_time: Only return events that occurred before the
@@ -325,36 +671,307 @@ class Medium(models.Model):
             where ``targets`` is a list of entities.
         """
         events = self.get_filtered_events(**event_filters)
-        subscriptions = Subscription.objects.filter(medium=self)
+        if batch:
+            return self.resolve_events_targets(events, entity_kind)
+
+        with phase('event_scan'):
+            events = list(events)
+
+        # The subscriptions and unsubscriptions are looked up once for all of the events
+        with phase('subscription_load'):
+            subscriptions = subscription_index.get_many(self.id, set(event.source_id for event in events))
+        unsubscriptions = self.unsubscriptions
 
         event_pairs = []
         for event in events:
             targets = []
-            for sub in subscriptions:
-                if event.source != sub.source:
-                    continue
+            with phase('target_resolution'):
+                for sub in subscriptions[event.source_id]:
+                    subscribed = sub.subscribed_entities()
+                    if sub.only_following:
+                        potential_targets = self.followers_of(
+                            event.eventactor_set.values_list('entity__id', flat=True)
+                        )
+                        subscription_targets = list(Entity.objects.filter(
+                            Q(id__in=subscribed), Q(id__in=potential_targets)))
+                    else:
+                        subscription_targets = list(subscribed)
+
+                    targets.extend(subscription_targets)
+
+            with phase('unsubscription_load'):
+                targets = self.filter_source_targets_by_unsubscription(event.source_id, targets, unsubscriptions)
+
+            if entity_kind:
+                targets = [t for t in targets if t.entity_kind == entity_kind]
+            if targets:
+                event_pairs.append((event, targets))
+
+        return event_pairs
+
+    @instrumented('medium.fan_out_events', medium=True)
+    def fan_out_events(self, events):
+        """Store the targets of the given events in their inboxes on this
+        medium, as ``InboxEvent`` objects.
+
+        This is called for every medium with ``fan_out_on_write`` set
+        when an event is created with ``Event.objects.create_event``.
+
+        :type events: EventQuerySet or list
+        :param events: The events to store in the inboxes of their
+            targets.
+        """
+        InboxEvent.objects.bulk_create([
+            inbox_event
+            for event, targets in self.resolve_events_targets(events)
+            for inbox_event in self._inbox_events(event, targets)
+        ])
+
+    @instrumented('medium.backfill_inbox', medium=True)
+    @transaction.atomic
+    def backfill_inbox(self, chunk_size=_ID_CHUNK_SIZE):
+        """Rebuild the inboxes on this medium from scratch.
+
+        All of the medium's ``InboxEvent`` objects are removed, and the
+        targets of every unexpired event are resolved again with the
+        current subscriptions. This is used to fill the inboxes when
+        ``fan_out_on_write`` is first turned on, or to bring them up to
+        date after subscriptions have changed. Events older than the
+        ``ENTITY_EVENT_QUERY_WINDOW`` are included, as the inboxes are
+        emptied of them too.
+
+        :type chunk_size: int
+        :param chunk_size: The number of events to resolve targets for
+            and store at a time.
+        """
+        InboxEvent.objects.filter(medium=self).delete()
+        inbox_events = []
+        # An explicit start time includes the events older than the query window
+        for event, targets in self.iter_events_targets(chunk_size=chunk_size, start_time=datetime.min):
+            inbox_events.extend(self._inbox_events(event, targets))
+            if len(inbox_events) >= chunk_size:
+                InboxEvent.objects.bulk_create(inbox_events)
+                inbox_events = []
+        InboxEvent.objects.bulk_create(inbox_events)
+
+    def _inbox_events(self, event, targets):
+        """Return the ``InboxEvent`` objects storing an event in the
+        inboxes of its targets on this medium, with one for each target,
+        as a target subscribed by several subscriptions, such as its own
+        and one of a group it is in, is listed once for each.
+        """
+        target_ids = set()
+        inbox_events = []
+        for target in targets:
+            if target.id not in target_ids:
+                target_ids.add(target.id)
+                inbox_events.append(InboxEvent(entity=target, medium=self, event=event, time=event.time))
+        return inbox_events
+
+    def iter_events_targets(self, entity_kind=None, chunk_size=_ID_CHUNK_SIZE, **event_filters):
+        """Yield all events for this medium, with who each event is for.
+
+        This is a streaming version of ``events_targets``, for
+        processing large numbers of events without holding all of them
+        in memory at once. Events are fetched in chunks of
+        ``chunk_size``, in order of their ids, and the targets for each
+        chunk are resolved together with ``resolve_events_targets``
+        before the ``(event, targets)`` tuples are yielded. Only a
+        single chunk of events and their targets is held in memory at
+        a time, regardless of how many events match the filters.
+
+        .. code-block:: python
+
+            email = Medium.objects.get(name='email')
+            for event, targets in email.iter_events_targets(seen=False, mark_seen=True):
+                send_email(event, targets)
+
+        Unlike ``events_targets``, the events are not all fetched in a
+        single transaction. If ``mark_seen`` is given, each chunk of
+        events is marked as seen as it is fetched. On a medium using a
+        seen watermark, only the events the watermark can be advanced
+        past are yielded, as with ``events_targets``, so events created
+        in the last ``ENTITY_EVENT_SEEN_WATERMARK_LAG`` seconds are left
+        for the next call.
 
-                subscribed = sub.subscribed_entities()
-                if sub.only_following:
-                    potential_targets = self.followers_of(
-                        event.eventactor_set.values_list('entity__id', flat=True)
-                    )
-                    subscription_targets = list(Entity.objects.filter(
-                        Q(id__in=subscribed), Q(id__in=potential_targets)))
-                else:
-                    subscription_targets = list(subscribed)
+        :type entity_kind: EntityKind
+        :param entity_kind: Only include targets of the given kind in
+            each targets list.
 
-                targets.extend(subscription_targets)
+        :type chunk_size: int
+        :param chunk_size: The number of events to fetch and resolve
+            targets for at a time.
 
-            targets = self.filter_source_targets_by_unsubscription(event.source_id, targets)
+        The remaining event filters are the same as those taken by
+        ``events_targets``.
+
+        :rtype: Generator of tuples
+        :returns: A generator of tuples in the form ``(event,
+            targets)`` where ``targets`` is a list of entities.
+        """
+        mark_seen = event_filters.pop('mark_seen', False) and event_filters.get('seen') is False
+        events = self.get_filtered_events(**event_filters).order_by('id')
+        if mark_seen and self.use_seen_watermark:
+            max_id = self._max_settled_event_id(events)
+            if max_id is None:
+                return
+            events = events.filter(id__lte=max_id)
+
+        last_id = None
+        while True:
+            chunk = events if last_id is None else events.filter(id__gt=last_id)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+            last_id = chunk[-1].id
+
+            if mark_seen and self.use_seen_watermark:
+                self.advance_seen_watermark(last_id)
+            elif mark_seen:
+                Event.objects.filter(id__in=[event.id for event in chunk]).mark_seen(self)
+
+            for event_pair in self.resolve_events_targets(chunk, entity_kind):
+                yield event_pair
+
+    @instrumented('medium.resolve_events_targets', summarize=_summarize_events_targets, medium=True)
+    def resolve_events_targets(self, events, entity_kind=None):
+        """Return ``(event, targets)`` tuples for the given events,
+        resolving the targets of all the events at once.
+
+        Rather than querying subscriptions, group memberships, actors
+        and followers separately for every event, each of these is
+        loaded once for the whole collection of events and joined in
+        memory. The number of queries made does not depend on the
+        number of subscriptions, and only grows with the number of
+        events, actors and targets once they exceed the
+        ``_ID_CHUNK_SIZE`` ids that are sent to the database at once.
+
+        :type events: EventQuerySet or list
+        :param events: The events to find targets for.
 
+        :type entity_kind: EntityKind
+        :param entity_kind: Only include targets of the given kind in
+            each targets list.
+
+        :rtype: List of tuples
+        :returns: A list of tuples in the form ``(event, targets)``
+            where ``targets`` is a list of entities, as returned by
+            ``events_targets``.
+        """
+        with phase('event_scan'):
+            events = list(events)
+        if not events:
+            return []
+
+        with phase('subscription_load'):
+            subscriptions = subscription_index.get_many(self.id, set(event.source_id for event in events))
+
+        with phase('unsubscription_load'):
+            unsubscriptions = self.unsubscriptions
+            unsubscriptions.preload(subscriptions)
+
+        with phase('target_resolution'):
+            target_ids = self._resolve_target_ids(events, subscriptions, unsubscriptions)
+
+            entities = Entity.objects.all()
             if entity_kind:
-                targets = [t for t in targets if t.entity_kind == entity_kind]
+                entities = entities.filter(entity_kind=entity_kind)
+            entities = _in_bulk(entities, set(chain(*target_ids.values())))
+
+        event_pairs = []
+        for event in events:
+            targets = [entities[entity_id] for entity_id in target_ids[event.id] if entity_id in entities]
             if targets:
                 event_pairs.append((event, targets))
 
         return event_pairs
 
+    def _resolve_target_ids(self, events, subscriptions, unsubscriptions):
+        """Return the ids of the targets of each of the given events,
+        keyed on event id, from the subscriptions and unsubscriptions
+        of their sources, keyed on source id.
+        """
+        members = self._subscription_members(
+            [sub for source_subs in subscriptions.values() for sub in source_subs])
+
+        following_event_ids = [
+            event.id for event in events
+            if any(sub.only_following for sub in subscriptions[event.source_id])
+        ]
+        actors = _actors_by_event(following_event_ids)
+        followers = self._followers_by_entity(set(chain(*actors.values())))
+
+        target_ids = defaultdict(list)
+        for event in events:
+            event_followers = set(chain(*[followers[actor] for actor in actors[event.id]]))
+            for sub in subscriptions[event.source_id]:
+                target_ids[event.id].extend(
+                    entity_id for entity_id in members[sub.id]
+                    if not sub.only_following or entity_id in event_followers
+                )
+            target_ids[event.id] = [
+                entity_id for entity_id in target_ids[event.id]
+                if entity_id not in unsubscriptions[event.source_id]
+            ]
+        return target_ids
+
+    def _subscription_members(self, subscriptions):
+        """Return the ids of the entities subscribed by each of the
+        given subscriptions, keyed on subscription id, in a single
+        query for all the group subscriptions.
+
+        If ``ENTITY_EVENT_SUBSCRIPTION_MEMBERS`` is set, the stored
+        ``SubscriptionMember`` objects are used instead, which already
+        exclude unsubscribed entities.
+        """
+        if getattr(settings, 'ENTITY_EVENT_SUBSCRIPTION_MEMBERS', False):
+            members = dict((sub.id, []) for sub in subscriptions)
+            for subscription_ids in _chunked(list(members)):
+                for subscription_id, entity_id in SubscriptionMember.objects.filter(
+                        subscription__in=subscription_ids).order_by('entity').values_list('subscription', 'entity'):
+                    members[subscription_id].append(entity_id)
+            return members
+
+        group_members = defaultdict(list)
+        group_entity_ids = set(sub.entity_id for sub in subscriptions if sub.sub_entity_kind_id is not None)
+        relationships = EntityRelationship.objects.filter(
+            super_entity__in=group_entity_ids
+        ).order_by('sub_entity').values_list('super_entity', 'sub_entity__entity_kind', 'sub_entity')
+        for super_entity_id, entity_kind_id, sub_entity_id in relationships:
+            group_members[(super_entity_id, entity_kind_id)].append(sub_entity_id)
+
+        members = {}
+        for sub in subscriptions:
+            if sub.sub_entity_kind_id is not None:
+                members[sub.id] = group_members[(sub.entity_id, sub.sub_entity_kind_id)]
+            else:
+                members[sub.id] = [sub.entity_id]
+        return members
+
+    def _followers_by_entity(self, entity_ids):
+        """Return the ids of the followers of each of the given
+        entities, keyed on entity id.
+
+        The default definition of ``followers_of`` is resolved for
+        every entity in a single query. If a subclass redefines
+        ``followers_of``, it is called once per entity instead, so the
+        redefined semantics are still respected.
+        """
+        followers = defaultdict(set)
+        if get_unbound_function(type(self).followers_of) is not get_unbound_function(Medium.followers_of):
+            for entity_id in entity_ids:
+                followers[entity_id] = set(self.followers_of([entity_id]).values_list('id', flat=True))
+            return followers
+
+        for entity_id in entity_ids:
+            followers[entity_id].add(entity_id)
+        for chunk in _chunked(entity_ids):
+            relationships = EntityRelationship.objects.filter(
+                super_entity__in=chunk).values_list('super_entity', 'sub_entity')
+            for super_entity_id, sub_entity_id in relationships:
+                followers[super_entity_id].add(sub_entity_id)
+        return followers
+
     def subset_subscriptions(self, subscriptions, entity=None):
         """Return only subscriptions the given entity is a part of.
 
@@ -388,26 +1005,32 @@ class Medium(models.Model):
 
         return subscriptions
 
-    @cached_property
+    @property
     def unsubscriptions(self):
-        """Returns the unsubscribed entity IDs for each source as a dict,
-        keyed on source_id.
+        """Returns the unsubscribed entity IDs for each source, keyed on
+        source_id.
 
-        :rtype: Dictionary
-        :returns: A dictionary of the form ``{source_id: entities}``
-            where ``entities`` is a list of entities unsubscribed from
-            that source for this medium.
+        The unsubscriptions of each source are loaded when they are
+        first looked up, from a cache shared by every medium instance
+        in the process. See ``entity_event.cache.UnsubscriptionCache``.
+
+        :rtype: MediumUnsubscriptions
+        :returns: A mapping of the form ``{source_id: entities}``
+            where ``entities`` is a frozenset of the ids of the
+            entities unsubscribed from that source for this medium.
         """
-        unsubscriptions = defaultdict(list)
-        for unsub in Unsubscription.objects.filter(medium=self).values('entity', 'source'):
-            unsubscriptions[unsub['source']].append(unsub['entity'])
-        return unsubscriptions
+        return unsubscription_cache.for_medium(self.id)
 
-    def filter_source_targets_by_unsubscription(self, source_id, targets):
+    def filter_source_targets_by_unsubscription(self, source_id, targets, unsubscriptions=None):
         """Given a source id and targets, filter the targets by
         unsubscriptions. Return the filtered list of targets.
+
+        :type unsubscriptions: MediumUnsubscriptions (optional)
+        :param unsubscriptions: The medium's ``unsubscriptions``, if
+            they have already been looked up for other sources.
         """
-        unsubscriptions = self.unsubscriptions
+        if unsubscriptions is None:
+            unsubscriptions = self.unsubscriptions
         return [t for t in targets if t.id not in unsubscriptions[source_id]]
 
     def get_filtered_events_queries(self, start_time, end_time, seen, include_expired, actor):
@@ -424,6 +1047,13 @@ class Medium(models.Model):
         """
         now = datetime.utcnow()
         filters = []
+
+        # Bounding the time of every query lets the database skip the
+        # events older than the window with the time indexes
+        query_window = getattr(settings, 'ENTITY_EVENT_QUERY_WINDOW', None)
+        if start_time is None and query_window is not None:
+            start_time = now - timedelta(seconds=query_window)
+
         if start_time is not None:
             filters.append(Q(time__gte=start_time))
         if end_time is not None:
@@ -434,11 +1064,18 @@ class Medium(models.Model):
         # Check explicitly for True and False as opposed to None
         #   - `seen==False` gets unseen notifications
         #   - `seen is None` does no seen/unseen filtering
-        if seen is True:
+        #   - Unseen events are excluded with a subquery on the seen
+        #     events, so the database applies it with the other filters
+        #   - Mediums using a watermark only need to compare event ids
+        if seen is True and self.use_seen_watermark:
+            filters.append(Q(id__lte=self.seen_watermark))
+        elif seen is True:
             filters.append(Q(eventseen__medium=self))
+        elif seen is False and self.use_seen_watermark:
+            filters.append(Q(id__gt=self.seen_watermark))
         elif seen is False:
-            unseen_ids = _unseen_event_ids(medium=self)
-            filters.append(Q(id__in=unseen_ids))
+            seen_event_ids = EventSeen.objects.filter(medium=self).values_list('event')
+            filters.append(~Q(id__in=seen_event_ids))
 
         # Filter by actor
         if actor is not None:
@@ -456,16 +1093,160 @@ class Medium(models.Model):
         """
         filtered_events_queries = self.get_filtered_events_queries(start_time, end_time, seen, include_expired, actor)
         events = Event.objects.filter(*filtered_events_queries)
-        if seen is False and mark_seen:
-            # Evaluate the event qset here and create a new queryset that is no longer filtered by
-            # if the events are marked as seen. We do this because we want to mark the events
-            # as seen in the next line of code. If we didn't evaluate the qset here first, it result
-            # in not returning unseen events since they are marked as seen.
-            events = Event.objects.filter(id__in=list(e.id for e in events))
-            events.mark_seen(self)
+        if seen is False and mark_seen and self.use_seen_watermark:
+            # The unseen events are bounded by the current watermark, so they can be
+            # kept as a range of ids after the watermark is advanced past them.
+            max_id = self._max_settled_event_id(events)
+            if max_id is None:
+                return events.none()
+            events = events.filter(id__lte=max_id)
+            self.advance_seen_watermark(max_id)
+        elif seen is False and mark_seen:
+            # The unseen events are marked in the database, and the events returned are those up
+            # to the largest unseen id that were marked by this call, found by the ids of the
+            # EventSeen objects it created, so the events are never loaded into Python.
+            with phase('event_scan'):
+                max_id = events.aggregate(max_id=Max('id'))['max_id']
+            if max_id is None:
+                return events.none()
+            max_seen_id = EventSeen.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+            events.filter(id__lte=max_id).mark_seen(self)
+            events = Event.objects.filter(
+                *self.get_filtered_events_queries(start_time, end_time, None, include_expired, actor)
+            ).filter(id__lte=max_id, eventseen__medium=self, eventseen__id__gt=max_seen_id)
 
         return events
 
+    @instrumented('medium.claim_events', summarize=_summarize_claim, medium=True)
+    def claim_events(self, batch_size=100, lease_seconds=300, **event_filters):
+        """Claim a batch of unseen events for processing by one of
+        several workers running in parallel.
+
+        Claimed events are leased to the caller until they are
+        completed with ``complete_claim``, released with
+        ``release_claim`` or the lease expires. While an event is
+        leased, it is not returned by ``claim_events`` to any other
+        caller, so workers can divide the unseen events of the medium
+        between them without delivering any event twice. Events whose
+        lease has expired, for example because their worker crashed,
+        can be claimed again.
+
+        .. code-block:: python
+
+            email = Medium.objects.get(name='email')
+            while True:
+                token, events = email.claim_events(batch_size=100, lease_seconds=300)
+                if not events:
+                    break
+                for event, targets in email.resolve_events_targets(events):
+                    send_email(event, targets)
+                email.complete_claim(token)
+
+        On PostgreSQL, the events are chosen with ``SELECT ... FOR
+        UPDATE SKIP LOCKED``, so workers claiming at the same time do
+        not wait for each other. On other databases, concurrent
+        claims are kept apart by the unique constraint on leased
+        events and mediums.
+
+        Claiming is not supported by mediums using a seen watermark,
+        since completing claims out of order would move the watermark
+        past events other workers have not finished with.
+
+        :type batch_size: int
+        :param batch_size: The most events to claim.
+
+        :type lease_seconds: int
+        :param lease_seconds: How long the events are leased for.
+
+        The remaining event filters, ``start_time``, ``end_time``,
+        ``include_expired`` and ``actor``, are the same as those taken
+        by ``events``. If the ``ENTITY_EVENT_QUERY_WINDOW`` setting is
+        set, and no ``start_time`` is given, unseen events older than
+        the window are never claimed, and so are never delivered.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(token, events)``, where
+            ``token`` identifies the claim, and ``events`` is a list of
+            the claimed events, ordered by id.
+        """
+        if self.use_seen_watermark:
+            raise ImproperlyConfigured('Events cannot be claimed on a medium using a seen watermark')
+
+        token = uuid4().hex
+        now = datetime.utcnow()
+        with transaction.atomic():
+            # Release expired leases, so their events can be claimed again
+            EventLease.objects.filter(medium=self, time_expires__lt=now).delete()
+
+            leased_event_ids = EventLease.objects.filter(medium=self).values_list('event')
+            events = self.get_filtered_events(seen=False, **event_filters).exclude(id__in=leased_event_ids)
+            _insert_event_rows(
+                EventLease, events.order_by('id').values_list('id', flat=True)[:batch_size], self,
+                skip_locked=True, token=token, time_expires=now + timedelta(seconds=lease_seconds))
+
+        with phase('event_scan'):
+            return token, list(Event.objects.filter(eventlease__medium=self, eventlease__token=token).order_by('id'))
+
+    @instrumented('medium.complete_claim', medium=True)
+    @transaction.atomic
+    def complete_claim(self, token, mark_seen=True):
+        """Finish processing the events claimed with ``claim_events``.
+
+        The events are marked as seen on this medium, and their leases
+        are removed. Events whose lease expired and that have since
+        been claimed again are left to the new claim.
+
+        :type token: str
+        :param token: The token returned by ``claim_events``.
+
+        :type mark_seen: Boolean (optional)
+        :param mark_seen: If ``False``, the leases are removed without
+            marking the events as seen.
+        """
+        if mark_seen:
+            Event.objects.filter(eventlease__medium=self, eventlease__token=token).mark_seen(self)
+        EventLease.objects.filter(medium=self, token=token).delete()
+
+    @instrumented('medium.release_claim', medium=True)
+    def release_claim(self, token):
+        """Give up the events claimed with ``claim_events`` without
+        marking them as seen, so they can be claimed again straight
+        away.
+
+        :type token: str
+        :param token: The token returned by ``claim_events``.
+        """
+        self.complete_claim(token, mark_seen=False)
+
+    def advance_seen_watermark(self, event_id):
+        """Mark every event with an id up to and including the given id
+        as seen, for a medium that uses a seen watermark.
+
+        The watermark is only ever moved forward, with a single
+        conditional update, so concurrent callers cannot move it back.
+
+        :type event_id: int
+        :param event_id: The id of the last event that has been seen.
+        """
+        with phase('mark_seen'):
+            Medium.objects.filter(id=self.id, seen_watermark__lt=event_id).update(seen_watermark=event_id)
+        self.seen_watermark = max(self.seen_watermark, event_id)
+
+    def _max_settled_event_id(self, events):
+        """Return the largest id of the given events that the seen
+        watermark can be advanced to, of those created more than
+        ``ENTITY_EVENT_SEEN_WATERMARK_LAG`` seconds ago, or ``None``
+        if there are none.
+        """
+        lag = getattr(settings, 'ENTITY_EVENT_SEEN_WATERMARK_LAG', 60)
+        if lag:
+            if events.query.low_mark or events.query.high_mark is not None:
+                # A sliced queryset cannot be filtered any further
+                events = Event.objects.filter(id__in=list(events.values_list('id', flat=True)))
+            # Event times are set with the same clock when events are created
+            events = events.filter(time__lt=timezone.now() - timedelta(seconds=lag))
+        return events.aggregate(max_id=Max('id'))['max_id']
+
     def followed_by(self, entities):
         """Define what entities are followed by the entities passed to this
         method.
@@ -580,6 +1361,11 @@ class Source(models.Model):
         take a dictionary of context, and populate it with more
         information from the database or other sources.
 
+    :type context_cache_ttl: (optional) int
+    :param context_cache_ttl: If given, the contexts loaded by the
+        context loader are cached for this many seconds. See
+        ``entity_event.cache.ContextCache``.
+
     Storing source objects in the database servers two purposes. The
     first is to provide an object that Subscriptions can reference,
     allowing different categories of events to be subscribed to over
@@ -602,11 +1388,14 @@ class Source(models.Model):
     # An optional function path that loads the context of an event and performs
     # any additional application-specific context fetching before rendering
     context_loader = models.CharField(max_length=256, default='', blank=True)
+    # How many seconds to cache the contexts loaded by the context loader for
+    context_cache_ttl = models.PositiveIntegerField(null=True, blank=True)
 
     def get_context_loader_function(self):
-        """Returns an imported, callable context loader function.
+        """Returns an imported, callable context loader function. Each
+        loader is only imported once per process.
         """
-        return import_by_path(self.context_loader)
+        return context_loaders.get(self.context_loader)
 
     def get_context(self, context):
         """Gets the context for this source by loading it through the source's
@@ -625,6 +1414,28 @@ class Source(models.Model):
         else:
             return context
 
+    def get_contexts(self, contexts):
+        """Gets the contexts of many events from this source at once.
+
+        If the context loader was made with
+        ``entity_event.loaders.batch_context_loader``, it is called
+        once with all of the contexts, otherwise it is called with
+        each context in turn.
+
+        :type contexts: List of dicts
+        :param contexts: The contexts of events from this source.
+
+        :rtype: List of dicts
+        :returns: The contexts provided, in the same order, with any
+            additional context loaded by the context loader function.
+        """
+        if not self.context_loader:
+            return list(contexts)
+        loader = self.get_context_loader_function()
+        if hasattr(loader, 'load_many'):
+            return list(loader.load_many(list(contexts)))
+        return [loader(context) for context in contexts]
+
     def clean(self):
         """Validation for the model.
 
@@ -825,19 +1636,80 @@ class Subscription(models.Model):
         :returns: A QuerySet of all the entities that are a part of
             this subscription.
         """
-        if self.sub_entity_kind is not None:
-            sub_entities = self.entity.sub_relationships.filter(
-                sub_entity__entity_kind=self.sub_entity_kind).values_list('sub_entity')
+        if self.sub_entity_kind_id is not None:
+            sub_entities = EntityRelationship.objects.filter(
+                super_entity=self.entity_id, sub_entity__entity_kind=self.sub_entity_kind_id).values_list('sub_entity')
             entities = Entity.objects.filter(id__in=sub_entities)
         else:
-            entities = Entity.objects.filter(id=self.entity.id)
+            entities = Entity.objects.filter(id=self.entity_id)
         return entities
 
 
 class EventQuerySet(QuerySet):
     """A custom QuerySet for Events.
     """
-    def mark_seen(self, medium):
+    def page(self, cursor=None, page_size=20):
+        """Return a page of the events, newest first, and a cursor for the
+        next page.
+
+        The events are ordered by time, and then id for events at the
+        same time. Each page starts after the time and id of the last
+        event on the previous page, which are stored in the cursor, so
+        finding the page is a range scan of the time index, however
+        deep into the events it is.
+
+        :type cursor: str (optional)
+        :param cursor: The cursor returned with the previous page. If
+            no cursor is given, the first page is returned.
+
+        :type page_size: int (optional)
+        :param page_size: The most events to return.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(events, next_cursor)``, where
+            ``next_cursor`` is ``None`` if this is the last page.
+
+        :raises ValueError: If the cursor is not valid.
+        """
+        events = self.order_by('-time', '-id')
+        if cursor is not None:
+            time, event_id = _decode_cursor(cursor)
+            events = events.filter(Q(time__lte=time), Q(time__lt=time) | Q(time=time, id__lt=event_id))
+
+        # Fetch an extra event to find out if there is another page
+        events = list(events[:page_size + 1])
+        if len(events) <= page_size:
+            return events, None
+        events = events[:page_size]
+        return events, _encode_cursor(events[-1].time, events[-1].id)
+
+    def load_contexts(self):
+        """Return the events with their contexts, loading the contexts of
+        the events of each source together with ``Source.get_contexts``.
+
+        Sources are looked up in the process-wide source cache, so
+        loading the contexts of a page of events costs one call of
+        each source's context loader, rather than one for every event
+        when ``Event.get_context`` is called on each event.
+
+        :rtype: List of tuples
+        :returns: A list of tuples in the form ``(event, context)``, in
+            the order of the queryset.
+        """
+        events = list(self)
+        positions_by_source = defaultdict(list)
+        for position, event in enumerate(events):
+            positions_by_source[event.source_id].append(position)
+
+        contexts = [None] * len(events)
+        for positions in positions_by_source.values():
+            source_contexts = _load_contexts(
+                events[positions[0]].get_source(), [events[position] for position in positions])
+            for position, context in zip(positions, source_contexts):
+                contexts[position] = context
+        return list(zip(events, contexts))
+
+    def mark_seen(self, medium, chunk_size=_MARK_SEEN_CHUNK_SIZE):
         """Creates EventSeen objects for the provided medium for every event
         in the queryset.
 
@@ -845,10 +1717,51 @@ class EventQuerySet(QuerySet):
         returned when passing ``seen=False`` to any of the medium
         event retrieval functions, ``events``, ``entity_events``, or
         ``events_targets``.
+
+        The ``EventSeen`` objects are created directly in the
+        database, with an ``INSERT ... SELECT`` statement for every
+        ``chunk_size`` events, so events are never loaded into
+        Python. Events that have already been seen on the medium are
+        skipped rather than causing an ``IntegrityError``, so workers
+        marking overlapping events as seen in parallel do not fail. On
+        PostgreSQL, SQLite and MySQL the database ignores the
+        conflicting rows itself, on other databases they are excluded
+        with a ``NOT EXISTS`` clause.
+
+        If the medium uses a seen watermark, no ``EventSeen`` objects
+        are created, and the watermark is advanced to the largest id
+        in the queryset instead, of the events created more than
+        ``ENTITY_EVENT_SEEN_WATERMARK_LAG`` seconds ago. See
+        ``Medium.use_seen_watermark``.
         """
-        EventSeen.objects.bulk_create([
-            EventSeen(event=event, medium=medium) for event in self
-        ])
+        with phase('mark_seen'):
+            self._mark_seen(medium, chunk_size)
+
+    def _mark_seen(self, medium, chunk_size):
+        """Mark the events as seen for ``mark_seen``.
+        """
+        if medium.use_seen_watermark:
+            max_id = medium._max_settled_event_id(self)
+            if max_id is not None:
+                medium.advance_seen_watermark(max_id)
+            return
+
+        event_ids = self.values_list('id', flat=True)
+        if self.query.low_mark or self.query.high_mark is not None:
+            # A sliced queryset is already bounded, and cannot be filtered any further
+            return _insert_event_rows(EventSeen, event_ids, medium, time_seen=datetime.utcnow())
+
+        event_ids = event_ids.order_by('id')
+        chunk_start = None
+        while True:
+            chunk = event_ids if chunk_start is None else event_ids.filter(id__gt=chunk_start)
+            chunk_end = list(chunk[chunk_size - 1:chunk_size])
+            if chunk_end:
+                chunk = chunk.filter(id__lte=chunk_end[0])
+            _insert_event_rows(EventSeen, chunk, medium, time_seen=datetime.utcnow())
+            if not chunk_end:
+                return
+            chunk_start = chunk_end[0]
 
 
 class EventManager(models.Manager):
@@ -859,7 +1772,7 @@ class EventManager(models.Manager):
         """
         return EventQuerySet(self.model)
 
-    def mark_seen(self, medium):
+    def mark_seen(self, medium, chunk_size=_MARK_SEEN_CHUNK_SIZE):
         """Creates EventSeen objects for the provided medium for every event
         in the queryset.
 
@@ -868,9 +1781,15 @@ class EventManager(models.Manager):
         event retrieval functions, ``events``, ``entity_events``, or
         ``events_targets``.
         """
-        return self.get_queryset().mark_seen(medium)
+        return self.get_queryset().mark_seen(medium, chunk_size)
 
-    @transaction.atomic
+    def page(self, cursor=None, page_size=20):
+        """Return a page of events, newest first, and a cursor for the
+        next page. See ``EventQuerySet.page``.
+        """
+        return self.get_queryset().page(cursor, page_size)
+
+    @instrumented('event_manager.create_event', summarize=_summarize_created_event)
     def create_event(self, actors=None, ignore_duplicates=False, **kwargs):
         """Create events with actors.
 
@@ -913,21 +1832,47 @@ class EventManager(models.Manager):
             appropriately.
 
         :type ignore_duplicates: (optional) Boolean
-        :param ignore_duplicates: If ``True``, a check will be made to
-            ensure that an event with the give ``uuid`` does not exist
-            before attempting to create the event. Setting this to
+        :param ignore_duplicates: If ``True``, no event is created if
+            an event with the given ``uuid`` exists. Setting this to
             ``True`` allows the creator of events to gracefully ensure
-            no duplicates are created.
+            no duplicates are created, even when the same event is
+            created concurrently. On PostgreSQL the event is inserted
+            with ``ON CONFLICT DO NOTHING``, on other databases it is
+            inserted in a savepoint that is rolled back if the
+            ``uuid`` is taken. On every database ``pre_save`` is sent
+            before the event is inserted, and ``post_save`` only if it
+            was created, as when the event is saved. The uuids of events created, or found to
+            exist, outside of a transaction are also kept in a bounded
+            in-process set if ``ENTITY_EVENT_RECENT_UUIDS_SIZE`` is
+            set, so that creating them again skips the database.
 
         :rtype: Event
         :returns: The created event. Alternatively if a duplicate
             event already exists and ``ignore_duplicates`` is
             ``True``, it will return ``None``.
         """
-        if ignore_duplicates and self.filter(uuid=kwargs.get('uuid', '')).exists():
+        uuid = kwargs.get('uuid', '')
+        if ignore_duplicates and uuid in recent_event_uuids:
             return None
 
-        event = self.create(**kwargs)
+        event = self._create_event(actors, ignore_duplicates, kwargs)
+
+        # Outside of a transaction, the event or its duplicate is committed
+        if ignore_duplicates and not connections[self.db].in_atomic_block:
+            recent_event_uuids.add(uuid)
+        return event
+
+    @transaction.atomic
+    def _create_event(self, actors, ignore_duplicates, kwargs):
+        """Create an event with actors for ``create_event``, returning
+        ``None`` if duplicates are ignored and the uuid is taken.
+        """
+        if ignore_duplicates:
+            event = self._insert_ignoring_duplicate(Event(**kwargs))
+            if event is None:
+                return None
+        else:
+            event = self.create(**kwargs)
 
         # Allow user to pass pks for actors
         actors = [
@@ -936,8 +1881,251 @@ class EventManager(models.Manager):
         ] if actors else []
 
         EventActor.objects.bulk_create([EventActor(entity_id=actor, event=event) for actor in actors])
+
+        self._fan_out([event])
+        return event
+
+    def _insert_ignoring_duplicate(self, event):
+        """Insert an event with a single statement that skips it if its
+        uuid is taken, returning the event, or ``None`` if it was
+        skipped.
+
+        The event is inserted with raw SQL on PostgreSQL, so the
+        ``pre_save`` and ``post_save`` signals that saving it would
+        send are sent around the insert.
+        """
+        if connections[self.db].vendor == 'postgresql':
+            pre_save.send(sender=Event, instance=event, raw=False, using=self.db, update_fields=None)
+            event_ids = self._insert_returning_ids([event], ignore_duplicates=True)
+            if not event_ids:
+                return None
+            event.id = event_ids[event.uuid]
+            event._state.adding = False
+            event._state.db = self.db
+            post_save.send(sender=Event, instance=event, created=True, raw=False, using=self.db, update_fields=None)
+            return event
+
+        try:
+            with transaction.atomic(using=self.db):
+                event.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            # Only a taken uuid makes the event a duplicate
+            if self.filter(uuid=event.uuid).exists():
+                return None
+            raise
         return event
 
+    def bulk_create_events(self, event_specs, batch_size=_BULK_CREATE_BATCH_SIZE, ignore_duplicates=False):
+        """Create many events, with their actors, in batches.
+
+        This method can be used in place of calling ``create_event``
+        for every event when importing large numbers of events. Each
+        batch of events is inserted in one transaction, with a single
+        statement for the events and one for their actors, rather
+        than several statements for every event.
+
+        .. code-block:: python
+
+            created, skipped = Event.objects.bulk_create_events(
+                ({
+                    'source': source,
+                    'context': {'activity_id': activity.id},
+                    'uuid': 'activity-{0}'.format(activity.id),
+                    'actors': [activity.user_entity_id],
+                } for activity in activities),
+                ignore_duplicates=True,
+            )
+
+        :type event_specs: iterable of dicts
+        :param event_specs: The events to create. Each is a dictionary
+            of the keyword arguments taken by ``create_event``,
+            including ``actors``, but not ``ignore_duplicates``. The
+            iterable is consumed one batch at a time, so it can be a
+            generator over more events than fit in memory.
+
+        :type batch_size: int (optional)
+        :param batch_size: The number of events inserted at a time.
+
+        :type ignore_duplicates: Boolean (optional)
+        :param ignore_duplicates: If ``True``, events with the same
+            ``uuid`` as an existing event, or an earlier event in the
+            same batch, are skipped. On PostgreSQL the events are
+            inserted with ``ON CONFLICT DO NOTHING``, so events created
+            concurrently by other processes are also skipped. On other
+            databases the existing uuids of each batch are queried
+            before it is inserted, so a batch can still fail if another
+            process creates one of its events in between. If
+            ``False``, a duplicate ``uuid`` raises an
+            ``IntegrityError``.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(created, skipped)``, with the
+            number of events created and the number skipped as
+            duplicates. Batches are committed as they are inserted, so
+            if a batch fails, the events of earlier batches remain
+            created unless the call is made inside a transaction.
+        """
+        created = skipped = 0
+        event_specs = iter(event_specs)
+        while True:
+            batch = list(islice(event_specs, batch_size))
+            if not batch:
+                return created, skipped
+            batch_created = self._bulk_create_batch(batch, ignore_duplicates)
+            created += batch_created
+            skipped += len(batch) - batch_created
+
+    @transaction.atomic
+    def _bulk_create_batch(self, event_specs, ignore_duplicates):
+        """Create a batch of events for ``bulk_create_events``, and return
+        the number created.
+        """
+        events, actors = self._events_from_specs(event_specs, ignore_duplicates)
+
+        if connections[self.db].vendor == 'postgresql':
+            event_ids = self._insert_returning_ids(events, ignore_duplicates)
+        else:
+            if ignore_duplicates:
+                existing_uuids = set(chain(*[
+                    self.filter(uuid__in=uuids).values_list('uuid', flat=True)
+                    for uuids in _chunked([event.uuid for event in events])
+                ]))
+                events = [event for event in events if event.uuid not in existing_uuids]
+            self.bulk_create(events)
+            event_ids = dict(chain(*[
+                self.filter(uuid__in=uuids).values_list('uuid', 'id')
+                for uuids in _chunked([event.uuid for event in events])
+            ]))
+
+        events = [event for event in events if event.uuid in event_ids]
+        for event in events:
+            event.id = event_ids[event.uuid]
+        EventActor.objects.bulk_create([
+            EventActor(entity_id=actor, event_id=event.id) for event in events for actor in actors[event.uuid]
+        ])
+
+        self._fan_out(events)
+        return len(events)
+
+    def _fan_out(self, events):
+        """Add newly created events to the inboxes of the mediums that
+        fan out events on write and are subscribed to their sources.
+        """
+        fan_out_mediums = {}
+        for source_id in set(event.source_id for event in events):
+            for sub in subscription_index.for_source(source_id):
+                if sub.medium.fan_out_on_write:
+                    fan_out_mediums[sub.medium_id] = sub.medium
+        for medium_id in sorted(fan_out_mediums):
+            fan_out_mediums[medium_id].fan_out_events(events)
+
+    def _events_from_specs(self, event_specs, ignore_duplicates):
+        """Return unsaved events for the given event specs, and the ids of
+        the actors of each, keyed on uuid. If duplicates are ignored,
+        only the first spec with each uuid is included.
+        """
+        events = []
+        actors = {}
+        for spec in event_specs:
+            spec = dict(spec)
+            event_actors = spec.pop('actors', None) or []
+            event = Event(**spec)
+            if ignore_duplicates and event.uuid in actors:
+                continue
+            actors[event.uuid] = [a.id if isinstance(a, Entity) else a for a in event_actors]
+            events.append(event)
+        return events, actors
+
+    def _insert_returning_ids(self, events, ignore_duplicates):
+        """Insert events on PostgreSQL with a single statement, and return
+        the ids of those inserted, keyed on uuid. If duplicates are
+        ignored, events with the uuid of an existing event are skipped.
+        """
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        fields = [field for field in Event._meta.local_fields if field is not Event._meta.pk]
+        row_sql = '({0})'.format(', '.join(['%s'] * len(fields)))
+        sql = 'INSERT INTO {table} ({columns}) VALUES {rows}{conflict} RETURNING {uuid}, {id}'.format(
+            table=quote_name(Event._meta.db_table),
+            columns=', '.join(quote_name(field.column) for field in fields),
+            rows=', '.join([row_sql] * len(events)),
+            conflict=' ON CONFLICT (uuid) DO NOTHING' if ignore_duplicates else '',
+            uuid=quote_name(Event._meta.get_field('uuid').column),
+            id=quote_name(Event._meta.pk.column),
+        )
+        params = [
+            field.get_db_prep_save(field.pre_save(event, True), connection=connection)
+            for event in events for field in fields
+        ]
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
+
+    def purge_expired_events(
+            self, older_than=None, batch_size=_PURGE_BATCH_SIZE, sleep=0, dry_run=False, progress=None):
+        """Delete expired events, with their actors, seen events, leases
+        and inbox events.
+
+        Events are deleted in batches, each in its own transaction, with
+        a ``DELETE`` statement for the rows of each table that refer to
+        the batch, and one for the events. Unlike deleting the events
+        through the ORM, which fetches and deletes the related rows of
+        each event, each batch holds its locks briefly, so a purge can
+        be run while events are being created and queried.
+
+        .. code-block:: python
+
+            # Delete expired events, and events more than a year old
+            Event.objects.purge_expired_events(older_than=timedelta(days=365), sleep=0.1)
+
+        :type older_than: timedelta (optional)
+        :param older_than: If given, events that occurred longer ago
+            than this are deleted, as well as expired events.
+
+        :type batch_size: int (optional)
+        :param batch_size: The most events deleted at a time.
+
+        :type sleep: float (optional)
+        :param sleep: The seconds to wait between batches, to limit the
+            load the purge puts on the database.
+
+        :type dry_run: Boolean (optional)
+        :param dry_run: If ``True``, the events that would be deleted
+            are counted, and nothing is deleted.
+
+        :type progress: callable (optional)
+        :param progress: A function called after each batch with the
+            number of events deleted so far.
+
+        :rtype: int
+        :returns: The number of events deleted, or that would be
+            deleted if ``dry_run`` is ``True``.
+        """
+        now = datetime.utcnow()
+        expired = Q(time_expires__lt=now)
+        if older_than is not None:
+            expired |= Q(time__lt=now - older_than)
+        if dry_run:
+            return self.filter(expired).count()
+
+        # Each batch starts after the last one, so the rows earlier batches walked past are not read again
+        deleted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                event_ids = list(self.filter(expired, id__gt=last_id).order_by('id').values_list(
+                    'id', flat=True)[:batch_size])
+                for chunk in _chunked(event_ids):
+                    _delete_events(connections[self.db], chunk)
+            deleted += len(event_ids)
+            if progress is not None and event_ids:
+                progress(deleted)
+            if len(event_ids) < batch_size:
+                return deleted
+            last_id = event_ids[-1]
+            if sleep:
+                time.sleep(sleep)
+
 
 @python_2_unicode_compatible
 class Event(models.Model):
@@ -972,6 +2160,10 @@ class Event(models.Model):
 
     objects = EventManager()
 
+    class Meta:
+        # Events of subscribed sources are fetched in order of time
+        index_together = [('source', 'time')]
+
     def get_context(self):
         """Retrieves and populates the context for this event.
 
@@ -980,11 +2172,25 @@ class Event(models.Model):
         ``context_loader``, any additional context created by that
         function will be included.
 
+        If the event's source has not been loaded, it is looked up in
+        the process-wide source cache rather than queried, so getting
+        the contexts of many events does not query their sources.
+
         :rtype: Dict
         :returns: A dictionary of the event's context, with any
             additional context loaded.
         """
-        return self.source.get_context(self.context)
+        return _load_contexts(self.get_source(), [self])[0]
+
+    def get_source(self):
+        """Returns the source of the event, looking it up in the
+        process-wide source cache if it has not been loaded.
+
+        :rtype: Source
+        """
+        if not hasattr(self, Event.source.cache_name):
+            self.source = source_cache.get(self.source_id)
+        return self.source
 
     def __str__(self):
         """Readable representation of ``Event`` objects."""
@@ -1016,6 +2222,10 @@ class EventActor(models.Model):
     event = models.ForeignKey('Event')
     entity = models.ForeignKey(Entity)
 
+    class Meta:
+        # Events are found by their actors for "only following" subscriptions
+        index_together = [('entity', 'event')]
+
     def __str__(self):
         """Readable representation of ``EventActor`` objects."""
         s = 'Event {eventid} - {entity}'
@@ -1042,6 +2252,8 @@ class EventSeen(models.Model):
 
     class Meta:
         unique_together = ('event', 'medium')
+        # The seen events of a medium are probed by medium first
+        index_together = [('medium', 'event')]
 
     def __str__(self):
         """Readable representation of ``EventSeen`` objects."""
@@ -1051,18 +2263,459 @@ class EventSeen(models.Model):
         return s.format(medium=medium, time=time)
 
 
-def _unseen_event_ids(medium):
-    """Return all events that have not been seen on this medium.
+@python_2_unicode_compatible
+class InboxEvent(models.Model):
+    """``InboxEvent`` objects store that an event is in an entity's
+    inbox on a medium. They are only used by mediums with
+    ``fan_out_on_write`` set, which resolve the targets of every event
+    when it is created and store one ``InboxEvent`` for each of them,
+    so the events for an entity can be looked up directly with
+    ``Medium.entity_events``. The event's time is copied, so an
+    entity's inbox can be read in time order from a single index.
+
+    ``InboxEvent`` objects should not be created directly, but are
+    created by ``Event.objects.create_event`` and
+    ``Medium.backfill_inbox``.
+    """
+    entity = models.ForeignKey(Entity, related_name='+')
+    medium = models.ForeignKey('Medium')
+    event = models.ForeignKey('Event')
+    time = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('entity', 'medium', 'event')
+        index_together = [('entity', 'medium', 'time')]
+
+    def __str__(self):
+        """Readable representation of ``InboxEvent`` objects."""
+        s = 'Event {eventid} for {entity} on {medium}'
+        eventid = self.event.id
+        entity = self.entity.__str__()
+        medium = self.medium.__str__()
+        return s.format(eventid=eventid, entity=entity, medium=medium)
+
+
+@python_2_unicode_compatible
+class EventLease(models.Model):
+    """``EventLease`` objects store that an event has been claimed for
+    processing on a medium, by a worker that has not yet finished
+    with it. They are used by ``Medium.claim_events`` to split the
+    unseen events of a medium between workers running in parallel,
+    without any event being given to more than one worker at a time.
+
+    Every lease has a ``token``, shared by all the events claimed
+    together, and a time it expires. Once a lease has expired, its
+    event can be claimed again, so events claimed by a worker that
+    stopped before finishing with them are not lost.
+
+    ``EventLease`` objects should not be created directly, but should
+    be created with ``Medium.claim_events``.
+    """
+    event = models.ForeignKey('Event')
+    medium = models.ForeignKey('Medium')
+    token = models.CharField(max_length=32, db_index=True)
+    time_expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('event', 'medium')
+
+    def __str__(self):
+        """Readable representation of ``EventLease`` objects."""
+        s = 'Leased on {medium} until {time}'
+        medium = self.medium.__str__()
+        time = self.time_expires.strftime('%Y-%m-%d::%H:%M:%S')
+        return s.format(medium=medium, time=time)
+
+
+class SubscriptionMemberManager(models.Manager):
+    """A custom Manager for SubscriptionMembers.
+    """
+    def sync(self, subscriptions, entity_ids=None):
+        """Make the stored members of the given subscriptions match their
+        current members.
+
+        :type subscriptions: QuerySet or list
+        :param subscriptions: The subscriptions to update the members
+            of.
+
+        :type entity_ids: list (optional)
+        :param entity_ids: If given, only the membership of these
+            entities is updated, which is all that can change when,
+            for example, a single unsubscription is created.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(created, deleted)`` with the
+            number of members created and deleted.
+        """
+        missing, extra = self.diff(subscriptions, entity_ids)
+        extra_entity_ids = defaultdict(list)
+        for subscription_id, entity_id in extra:
+            extra_entity_ids[subscription_id].append(entity_id)
+        for subscription_id, sub_entity_ids in extra_entity_ids.items():
+            for chunk in _chunked(sub_entity_ids):
+                self.filter(subscription=subscription_id, entity__in=chunk).delete()
+        self.bulk_create([
+            SubscriptionMember(subscription_id=subscription_id, entity_id=entity_id)
+            for subscription_id, entity_id in missing
+        ])
+        return len(missing), len(extra)
+
+    def rebuild(self):
+        """Make the stored members of every subscription match their
+        current members.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(created, deleted)`` with the
+            number of members created and deleted.
+        """
+        return self.sync(Subscription.objects.all())
+
+    def diff(self, subscriptions, entity_ids=None):
+        """Compare the stored members of the given subscriptions with
+        their current members, without changing them.
+
+        :rtype: Tuple
+        :returns: A tuple in the form ``(missing, extra)``, where
+            ``missing`` is a set of ``(subscription_id, entity_id)``
+            pairs that should be stored but are not, and ``extra`` is a
+            set of the pairs that are stored but should not be.
+        """
+        missing = set()
+        extra = set()
+        subscriptions = dict((sub.id, sub) for sub in subscriptions)
+        for subscription_ids in _chunked(list(subscriptions)):
+            members = self.filter(subscription__in=subscription_ids)
+            if entity_ids is not None:
+                members = members.filter(entity__in=entity_ids)
+            stored = set(members.values_list('subscription', 'entity'))
+            current = _current_subscription_members(
+                [subscriptions[subscription_id] for subscription_id in subscription_ids], entity_ids)
+            missing.update(current - stored)
+            extra.update(stored - current)
+        return missing, extra
+
+
+@python_2_unicode_compatible
+class SubscriptionMember(models.Model):
+    """``SubscriptionMember`` objects store that an entity receives the
+    events of a subscription. They are a denormalized copy of the
+    entities subscribed by each subscription, either directly or as a
+    member of its group, less any entities unsubscribed from its
+    source on its medium. Storing them allows the targets of events to
+    be found with a single indexed join, rather than by querying the
+    relationships of every group subscription.
+
+    The members are only stored if ``ENTITY_EVENT_SUBSCRIPTION_MEMBERS``
+    is set to ``True``, in which case they are kept up to date as
+    subscriptions, unsubscriptions and entity relationships are saved
+    and deleted, and are used by ``Medium.events_targets`` with
+    ``batch=True``. After enabling the setting, the stored members
+    should be created with the ``rebuild_subscription_members``
+    management command, which can also be used to verify them.
+    Changing the kind of an entity does not update the stored members
+    of the groups it is in, so the command should also be run after
+    that.
+
+    ``SubscriptionMember`` objects should not be created directly, but
+    are created by ``SubscriptionMember.objects.sync``.
+    """
+    subscription = models.ForeignKey('Subscription')
+    entity = models.ForeignKey(Entity, related_name='+')
+
+    objects = SubscriptionMemberManager()
+
+    class Meta:
+        unique_together = ('subscription', 'entity')
+
+    def __str__(self):
+        """Readable representation of ``SubscriptionMember`` objects."""
+        s = '{entity} subscribed by {subscription}'
+        entity = self.entity.__str__()
+        subscription = self.subscription.__str__()
+        return s.format(entity=entity, subscription=subscription)
+
+
+def _insert_event_rows(model, event_ids, medium, skip_locked=False, **values):
+    """Insert a row of ``model``, which must be unique on its ``event``
+    and ``medium``, for the medium and every event with the given ids,
+    in a single ``INSERT ... SELECT`` statement. Events that already
+    have a row for the medium are skipped.
+
+    :type model: Model
+    :param model: The model to insert rows of, either ``EventSeen`` or
+        ``EventLease``.
+
+    :type event_ids: ValuesListQuerySet
+    :param event_ids: A queryset of the ids of the events to insert
+        rows for.
+
+    :type skip_locked: Boolean
+    :param skip_locked: If ``True``, on PostgreSQL, the events are
+        locked for the rest of the transaction, skipping any events
+        already locked by another transaction.
+
+    The remaining keyword arguments are the values of the row's other
+    fields.
+    """
+    connection = connections[event_ids.db]
+    ids_sql, ids_params = event_ids.query.get_compiler(connection=connection).as_sql()
+    table = connection.ops.quote_name(model._meta.db_table)
+    event_table = connection.ops.quote_name(Event._meta.db_table)
+    fields = [model._meta.get_field(name) for name in sorted(values)]
+    if skip_locked and connection.vendor == 'postgresql':
+        ids_sql += ' FOR UPDATE OF {0} SKIP LOCKED'.format(event_table)
+
+    sql = (
+        '{insert} INTO {table} (event_id, medium_id, {columns}) '
+        'SELECT id, %s, {placeholders} FROM {event_table} WHERE id IN ({ids_sql})'
+    )
+    params = [medium.id] + [
+        field.get_db_prep_save(values[field.name], connection) for field in fields
+    ] + list(ids_params)
+    if connection.vendor in _INSERT_IGNORING_CONFLICTS:
+        insert, on_conflict = _INSERT_IGNORING_CONFLICTS[connection.vendor]
+        sql += on_conflict
+    else:
+        insert = 'INSERT'
+        sql += (
+            ' AND NOT EXISTS (SELECT 1 FROM {table} AS existing'
+            ' WHERE existing.event_id = {event_table}.id AND existing.medium_id = %s)'
+        )
+        params.append(medium.id)
+
+    sql = sql.format(
+        insert=insert, table=table, event_table=event_table, ids_sql=ids_sql,
+        columns=', '.join(connection.ops.quote_name(field.column) for field in fields),
+        placeholders=', '.join(['%s'] * len(fields)),
+    )
+    connection.cursor().execute(sql, params)
+
+
+def _encode_cursor(time, event_id):
+    """Return an opaque cursor for the position of an event.
+    """
+    position = '{0}|{1}'.format(time.strftime(_CURSOR_TIME_FORMAT), event_id)
+    return urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """Return the time and id of an event from a cursor created by
+    ``_encode_cursor``.
+
+    :raises ValueError: If the cursor is not valid.
+    """
+    try:
+        time, event_id = urlsafe_b64decode(str(cursor)).decode('ascii').split('|')
+        return datetime.strptime(time, _CURSOR_TIME_FORMAT), int(event_id)
+    except (TypeError, UnicodeError, binascii.Error, ValueError):
+        raise ValueError('Invalid cursor {0!r}'.format(cursor))
+
+
+def _current_subscription_members(subscriptions, entity_ids=None):
+    """Return the ``(subscription_id, entity_id)`` pairs of the current
+    members of the given subscriptions, as stored by
+    ``SubscriptionMember``, optionally only for the given entities.
+    """
+    group_subscriptions = defaultdict(list)
+    members = set()
+    for sub in subscriptions:
+        if sub.sub_entity_kind_id is not None:
+            group_subscriptions[sub.entity_id].append(sub)
+        elif entity_ids is None or sub.entity_id in entity_ids:
+            members.add((sub, sub.entity_id))
+
+    if group_subscriptions:
+        relationships = EntityRelationship.objects.filter(super_entity__in=list(group_subscriptions))
+        if entity_ids is not None:
+            relationships = relationships.filter(sub_entity__in=entity_ids)
+        relationships = relationships.values_list('super_entity', 'sub_entity__entity_kind', 'sub_entity')
+        for super_entity_id, entity_kind_id, sub_entity_id in relationships:
+            members.update(
+                (sub, sub_entity_id) for sub in group_subscriptions[super_entity_id]
+                if sub.sub_entity_kind_id == entity_kind_id
+            )
+
+    unsubscriptions = Unsubscription.objects.filter(
+        medium__in=set(sub.medium_id for sub in subscriptions), source__in=set(sub.source_id for sub in subscriptions))
+    if entity_ids is not None:
+        unsubscriptions = unsubscriptions.filter(entity__in=entity_ids)
+    unsubscriptions = set(unsubscriptions.values_list('medium', 'source', 'entity'))
+    return set(
+        (sub.id, entity_id) for sub, entity_id in members
+        if (sub.medium_id, sub.source_id, entity_id) not in unsubscriptions
+    )
+
+
+def _actors_by_event(event_ids):
+    """Return the ids of the actors of each of the given events, keyed
+    on event id.
+    """
+    actors = defaultdict(set)
+    for chunk in _chunked(event_ids):
+        for event_id, entity_id in EventActor.objects.filter(event_id__in=chunk).values_list('event', 'entity'):
+            actors[event_id].add(entity_id)
+    return actors
+
+
+def _chunked(ids, chunk_size=_ID_CHUNK_SIZE):
+    """Split a collection of ids into lists of at most ``chunk_size``.
+    """
+    ids = list(ids)
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i + chunk_size]
+
+
+def _in_bulk(queryset, ids):
+    """Return the objects in the queryset with the given ids as a dict
+    keyed on id, querying for at most ``_ID_CHUNK_SIZE`` ids at a time.
+    """
+    objs = {}
+    for chunk in _chunked(ids):
+        objs.update(queryset.in_bulk(chunk))
+    return objs
+
+
+def _delete_events(connection, event_ids):
+    """Delete events, and the rows of the tables that refer to them,
+    with one statement for each table.
+    """
+    quote_name = connection.ops.quote_name
+    cursor = connection.cursor()
+    id_params = ', '.join(['%s'] * len(event_ids))
+    for model in (EventActor, EventSeen, EventLease, InboxEvent):
+        cursor.execute('DELETE FROM {table} WHERE {column} IN ({ids})'.format(
+            table=quote_name(model._meta.db_table),
+            column=quote_name(model._meta.get_field('event').column),
+            ids=id_params,
+        ), event_ids)
+    cursor.execute('DELETE FROM {table} WHERE {column} IN ({ids})'.format(
+        table=quote_name(Event._meta.db_table), column=quote_name(Event._meta.pk.column), ids=id_params,
+    ), event_ids)
+
+
+def _load_contexts(source, events):
+    """Return the loaded contexts of events from a source, using the
+    context cache if the source's contexts are cached.
+    """
+    if not context_cache.caches(source):
+        return source.get_contexts([event.context for event in events])
+
+    version = context_cache.get_version(source.id)
+    contexts = context_cache.get_many(source, [event.id for event in events], version)
+    missing_events = [event for event in events if event.id not in contexts]
+    if missing_events:
+        loaded = dict(zip(
+            [event.id for event in missing_events],
+            source.get_contexts([event.context for event in missing_events])))
+        context_cache.set_many(source, loaded, version)
+        contexts.update(loaded)
+    return [contexts[event.id] for event in events]
+
+
+def _invalidate_subscription_index(sender, **kwargs):
+    """Discard the subscription index when a subscription, or a
+    source or medium loaded with the subscriptions, is changed.
+    """
+    subscription_index.invalidate()
+
+
+post_save.connect(_invalidate_subscription_index, sender=Subscription, dispatch_uid='subscription_index')
+post_delete.connect(_invalidate_subscription_index, sender=Subscription, dispatch_uid='subscription_index')
+post_save.connect(_invalidate_subscription_index, sender=Source, dispatch_uid='subscription_index')
+post_delete.connect(_invalidate_subscription_index, sender=Source, dispatch_uid='subscription_index')
+post_save.connect(_invalidate_subscription_index, sender=Medium, dispatch_uid='subscription_index')
+post_delete.connect(_invalidate_subscription_index, sender=Medium, dispatch_uid='subscription_index')
+
+
+def _invalidate_source_cache(sender, instance, **kwargs):
+    """Discard the cached sources, and the cached contexts of a source,
+    when a source is changed.
+    """
+    source_cache.invalidate()
+    context_cache.invalidate(instance.id)
+
+
+post_save.connect(_invalidate_source_cache, sender=Source, dispatch_uid='source_cache')
+post_delete.connect(_invalidate_source_cache, sender=Source, dispatch_uid='source_cache')
+
+
+def _invalidate_unsubscription_cache(sender, instance, **kwargs):
+    """Discard the cached unsubscriptions of the medium of a changed
+    unsubscription.
+    """
+    unsubscription_cache.invalidate(instance.medium_id)
+
+
+post_save.connect(_invalidate_unsubscription_cache, sender=Unsubscription, dispatch_uid='unsubscription_cache')
+post_delete.connect(_invalidate_unsubscription_cache, sender=Unsubscription, dispatch_uid='unsubscription_cache')
+
+
+def _subscription_members_enabled():
+    return getattr(settings, 'ENTITY_EVENT_SUBSCRIPTION_MEMBERS', False)
+
+
+def _store_previous(sender, instance, **kwargs):
+    """Keep the stored version of an unsubscription or entity
+    relationship that is about to be changed, so the members it
+    affected before the change can be updated after it.
+    """
+    if _subscription_members_enabled() and instance.pk is not None:
+        instance._previous = sender.objects.filter(pk=instance.pk).first()
+
+
+def _with_previous(instance):
+    """Return the instance, and its stored version before it was
+    changed, if it was changed.
+    """
+    previous = getattr(instance, '_previous', None)
+    return [instance, previous] if previous is not None else [instance]
+
+
+def _sync_subscription_members(sender, instance, **kwargs):
+    """Update the stored members of a saved subscription.
+    """
+    if _subscription_members_enabled():
+        SubscriptionMember.objects.sync([instance])
+
+
+def _sync_unsubscription_members(sender, instance, **kwargs):
+    """Update the stored membership of the entity of a changed
+    unsubscription, in the subscriptions of its medium and source.
+    """
+    if _subscription_members_enabled():
+        for unsubscription in _with_previous(instance):
+            subscriptions = Subscription.objects.filter(
+                medium=unsubscription.medium_id, source=unsubscription.source_id)
+            SubscriptionMember.objects.sync(subscriptions, [unsubscription.entity_id])
+
+
+def _sync_relationship_members(sender, instance, **kwargs):
+    """Update the stored membership of the sub-entity of a changed
+    entity relationship, in the group subscriptions of its
+    super-entity.
+    """
+    if _subscription_members_enabled():
+        for relationship in _with_previous(instance):
+            subscriptions = Subscription.objects.filter(
+                entity=relationship.super_entity_id, sub_entity_kind__isnull=False)
+            SubscriptionMember.objects.sync(subscriptions, [relationship.sub_entity_id])
+
+
+def _sync_bulk_relationship_members(sender, model, **kwargs):
+    """Update the stored members of every group subscription after
+    entity relationships are created or updated in bulk, such as when
+    entities are synced by django-entity, since the relationships that
+    changed are not known.
     """
-    query = '''
-    SELECT event.id
-    FROM entity_event_event AS event
-        LEFT OUTER JOIN (SELECT *
-                         FROM entity_event_eventseen AS seen
-                         WHERE seen.medium_id=%s) AS eventseen
-            ON event.id = eventseen.event_id
-    WHERE eventseen.medium_id IS NULL
-    '''
-    unseen_events = Event.objects.raw(query, params=[medium.id])
-    ids = [e.id for e in unseen_events]
-    return ids
+    if _subscription_members_enabled() and model is EntityRelationship:
+        SubscriptionMember.objects.sync(Subscription.objects.filter(sub_entity_kind__isnull=False))
+
+
+post_save.connect(_sync_subscription_members, sender=Subscription, dispatch_uid='subscription_members')
+pre_save.connect(_store_previous, sender=Unsubscription, dispatch_uid='subscription_members')
+post_save.connect(_sync_unsubscription_members, sender=Unsubscription, dispatch_uid='subscription_members')
+post_delete.connect(_sync_unsubscription_members, sender=Unsubscription, dispatch_uid='subscription_members')
+pre_save.connect(_store_previous, sender=EntityRelationship, dispatch_uid='subscription_members')
+post_save.connect(_sync_relationship_members, sender=EntityRelationship, dispatch_uid='subscription_members')
+post_delete.connect(_sync_relationship_members, sender=EntityRelationship, dispatch_uid='subscription_members')
+post_bulk_operation.connect(_sync_bulk_relationship_members, dispatch_uid='subscription_members')
@@ -0,0 +1,150 @@
+from datetime import datetime
+import os
+import shutil
+from tempfile import mkdtemp
+
+from django.test import TestCase
+from django_dynamic_fixture import G
+from entity.models import Entity
+from freezegun import freeze_time
+from mock import patch
+
+from entity_event.archive import EventArchive, _SegmentWriter, archive_events
+from entity_event.models import Event, EventActor, EventSeen, InboxEvent, Medium, Source, _chunked
+
+
+class ArchiveEventsTest(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = G(Source, name='photo_tag')
+        self.medium = G(Medium)
+        self.actor = G(Entity)
+        self.old_events = []
+        for day in range(1, 4):
+            with freeze_time(datetime(2014, 1, day)):
+                self.old_events.append(Event.objects.create_event(
+                    source=self.source, context={'day': day}, uuid='old-{0}'.format(day), actors=[self.actor]))
+        G(EventSeen, event=self.old_events[0], medium=self.medium, time_seen=datetime(2014, 1, 5))
+        G(InboxEvent, event=self.old_events[0], medium=self.medium)
+        self.event = Event.objects.create_event(source=self.source, context={}, uuid='new')
+
+    def test_archive(self):
+        archived, segments = archive_events(self.directory, datetime(2015, 1, 1))
+        self.assertEqual((archived, len(segments)), (3, 1))
+        self.assertEqual(list(Event.objects.all()), [self.event])
+        self.assertFalse(EventSeen.objects.exists())
+        self.assertFalse(InboxEvent.objects.exists())
+        self.assertEqual(EventActor.objects.count(), 0)
+
+        archive = EventArchive(self.directory)
+        self.assertEqual(archive.segments(), [{
+            'segment': segments[0],
+            'uuids': segments[0].replace('.ndjson.gz', '.uuids'),
+            'count': 3,
+            'min_time': datetime(2014, 1, 1),
+            'max_time': datetime(2014, 1, 3),
+            'min_uuid': 'old-1',
+            'max_uuid': 'old-3',
+        }])
+        self.assertEqual(list(archive.iter_events())[0], {
+            'id': self.old_events[0].id,
+            'uuid': 'old-1',
+            'source_id': self.source.id,
+            'source': 'photo_tag',
+            'time': datetime(2014, 1, 1),
+            'time_expires': datetime.max,
+            'context': {'day': 1},
+            'actors': [self.actor.id],
+            'seen': [{'medium_id': self.medium.id, 'time_seen': datetime(2014, 1, 5)}],
+        })
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith('.tmp')], [])
+
+    def test_creates_directory(self):
+        directory = os.path.join(self.directory, 'events')
+        self.assertEqual(archive_events(directory, datetime(2015, 1, 1))[0], 3)
+        self.assertEqual(len(EventArchive(directory).segments()), 1)
+
+    def test_lookups_chunked(self):
+        with patch('entity_event.archive._chunked', side_effect=lambda ids: _chunked(ids, 2)) as chunked:
+            archive_events(self.directory, datetime(2015, 1, 1))
+        self.assertEqual(chunked.call_args_list[0][0][0], [event.id for event in self.old_events])
+        events = list(EventArchive(self.directory).iter_events())
+        self.assertEqual([event['actors'] for event in events], [[self.actor.id]] * 3)
+        self.assertEqual([len(event['seen']) for event in events], [1, 0, 0])
+
+    def test_interrupted_archive(self):
+        with patch('entity_event.archive._delete_events', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                archive_events(self.directory, datetime(2015, 1, 1))
+        self.assertEqual(Event.objects.count(), 4)
+
+        archived, segments = archive_events(self.directory, datetime(2015, 1, 1))
+        self.assertEqual(archived, 3)
+        self.assertEqual([segment['segment'] for segment in EventArchive(self.directory).segments()], segments)
+
+    def test_segment_writers_use_own_files(self):
+        segments = [_SegmentWriter(self.directory), _SegmentWriter(self.directory)]
+        self.assertNotEqual(segments[0]._path, segments[1]._path)
+        for segment in segments:
+            segment.discard()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_events_out_of_time_order(self):
+        with freeze_time(datetime(2013, 6, 1)):
+            Event.objects.create_event(source=self.source, context={}, uuid='older')
+        archive_events(self.directory, datetime(2015, 1, 1))
+        segment = EventArchive(self.directory).segments()[0]
+        self.assertEqual((segment['min_time'], segment['max_time']), (datetime(2013, 6, 1), datetime(2014, 1, 3)))
+
+    def test_segment_size(self):
+        archived, segments = archive_events(self.directory, datetime(2015, 1, 1), segment_size=1, batch_size=2)
+        self.assertEqual((archived, len(segments)), (3, 2))
+        self.assertEqual([segment['count'] for segment in EventArchive(self.directory).segments()], [2, 1])
+
+        archived, segments = archive_events(self.directory, datetime(2015, 1, 1))
+        self.assertEqual((archived, segments), (0, []))
+        self.assertEqual(len(EventArchive(self.directory).segments()), 2)
+
+    def test_iter_events(self):
+        archive_events(self.directory, datetime(2015, 1, 1), segment_size=1, batch_size=1)
+        archive = EventArchive(self.directory)
+        with patch.object(EventArchive, '_read_segment', autospec=True, side_effect=EventArchive._read_segment) as read:
+            events = list(archive.iter_events(start_time=datetime(2014, 1, 2), end_time=datetime(2014, 1, 2, 12)))
+        self.assertEqual([event['uuid'] for event in events], ['old-2'])
+        self.assertEqual(read.call_count, 1)
+        self.assertEqual([event['uuid'] for event in archive.iter_events()], ['old-1', 'old-2', 'old-3'])
+
+    def test_iter_events_within_segment(self):
+        archive_events(self.directory, datetime(2015, 1, 1))
+        archive = EventArchive(self.directory)
+        events = archive.iter_events(start_time=datetime(2014, 1, 2), end_time=datetime(2014, 1, 2))
+        self.assertEqual([event['uuid'] for event in events], ['old-2'])
+
+    def test_get(self):
+        archive_events(self.directory, datetime(2015, 1, 1), segment_size=1, batch_size=1)
+        archive = EventArchive(self.directory)
+        with patch.object(EventArchive, '_read_segment', autospec=True, side_effect=EventArchive._read_segment) as read:
+            self.assertEqual(archive.get('old-3')['context'], {'day': 3})
+            self.assertIsNone(archive.get('old-4'))
+            self.assertIsNone(archive.get('new'))
+        self.assertEqual(read.call_count, 1)
+
+    def test_get_within_segment(self):
+        archive_events(self.directory, datetime(2015, 1, 1))
+        archive = EventArchive(self.directory)
+        self.assertEqual(archive.get('old-3')['context'], {'day': 3})
+        with patch.object(EventArchive, '_read_segment', autospec=True) as read:
+            self.assertIsNone(archive.get('old-2a'))
+        self.assertFalse(read.called)
+
+    def test_get_missing_from_segment(self):
+        archive_events(self.directory, datetime(2015, 1, 1))
+        archive = EventArchive(self.directory)
+        with patch.object(EventArchive, '_read_segment', autospec=True, return_value=iter([])):
+            self.assertIsNone(archive.get('old-3'))
+
+    def test_empty_archive(self):
+        archive = EventArchive(os.path.join(self.directory, 'missing'))
+        self.assertEqual(archive.segments(), [])
+        self.assertIsNone(archive.get('old-1'))
@@ -0,0 +1,147 @@
+from threading import Event as ThreadEvent
+
+from django.core.signals import request_finished
+from django.db import IntegrityError, close_old_connections
+from django.test import TestCase
+from django_dynamic_fixture import G
+from entity.models import Entity
+from mock import patch
+
+from entity_event.buffer import EventBuffer, _close_open_buffers
+from entity_event.models import Event, EventActor, Source
+
+
+class EventBufferTest(TestCase):
+    def setUp(self):
+        self.source = G(Source)
+        self.actor = G(Entity)
+
+    def event_buffer(self, **kwargs):
+        event_buffer = EventBuffer(background=False, **kwargs)
+        self.addCleanup(event_buffer.close)
+        return event_buffer
+
+    def add_events(self, event_buffer, uuids):
+        for uuid in uuids:
+            event_buffer.add(source=self.source, context={'uuid': uuid}, uuid=uuid, actors=[self.actor])
+
+    def test_flush(self):
+        event_buffer = self.event_buffer()
+        self.add_events(event_buffer, '12')
+        self.assertEqual(len(event_buffer), 2)
+        self.assertFalse(Event.objects.exists())
+
+        self.assertEqual(event_buffer.flush(), (2, 0))
+        self.assertEqual(len(event_buffer), 0)
+        self.assertEqual(set(Event.objects.values_list('uuid', flat=True)), set(['1', '2']))
+        self.assertEqual(EventActor.objects.filter(entity=self.actor).count(), 2)
+        self.assertEqual(event_buffer.flush(), (0, 0))
+
+    def test_written_when_full(self):
+        event_buffer = self.event_buffer(max_size=2)
+        self.add_events(event_buffer, '123')
+        self.assertEqual(set(Event.objects.values_list('uuid', flat=True)), set(['1', '2']))
+        self.assertEqual(len(event_buffer), 1)
+
+    def test_ignore_duplicates(self):
+        Event.objects.create_event(source=self.source, context={}, uuid='1')
+        event_buffer = self.event_buffer(ignore_duplicates=True)
+        self.add_events(event_buffer, '121')
+        self.assertEqual(event_buffer.flush(), (1, 2))
+
+    def test_batch_is_atomic(self):
+        Event.objects.create_event(source=self.source, context={}, uuid='2')
+        event_buffer = self.event_buffer()
+        self.add_events(event_buffer, '12')
+        with self.assertRaises(IntegrityError):
+            event_buffer.flush()
+        self.assertFalse(Event.objects.filter(uuid='1').exists())
+        self.assertEqual(len(event_buffer), 0)
+
+    def test_flush_on_request_finished(self):
+        # Keep the test's connection open, as the test client does
+        request_finished.disconnect(close_old_connections)
+        self.addCleanup(request_finished.connect, close_old_connections)
+        event_buffer = self.event_buffer(flush_on_request_finished=True)
+        self.add_events(event_buffer, '1')
+        request_finished.send(sender=self.__class__)
+        self.assertTrue(Event.objects.filter(uuid='1').exists())
+
+        event_buffer.close()
+        self.add_events(self.event_buffer(), '2')
+        request_finished.send(sender=self.__class__)
+        self.assertFalse(Event.objects.filter(uuid='2').exists())
+
+    def test_close(self):
+        event_buffer = self.event_buffer()
+        self.add_events(event_buffer, '1')
+        event_buffer.close()
+        self.assertTrue(Event.objects.filter(uuid='1').exists())
+        with self.assertRaises(RuntimeError):
+            self.add_events(event_buffer, '2')
+
+    def test_closed_at_exit(self):
+        event_buffer = self.event_buffer()
+        self.add_events(event_buffer, '1')
+        _close_open_buffers()
+        self.assertTrue(Event.objects.filter(uuid='1').exists())
+        with self.assertRaises(RuntimeError):
+            self.add_events(event_buffer, '2')
+
+
+class EventBufferBackgroundTest(TestCase):
+    """The background thread uses its own database connection, so these
+    tests check when batches are written without writing them.
+    """
+    def setUp(self):
+        self.written = []
+        self.batch_written = ThreadEvent()
+        self.write_error = None
+
+        def write(event_buffer, events):
+            if events and self.write_error:
+                raise self.write_error
+            if events:
+                self.written.append([event['uuid'] for event in events])
+                self.batch_written.set()
+            return len(events), 0
+
+        patcher = patch.object(EventBuffer, '_write', autospec=True, side_effect=write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def event_buffer(self, **kwargs):
+        event_buffer = EventBuffer(**kwargs)
+        self.addCleanup(event_buffer.close)
+        return event_buffer
+
+    def test_written_after_delay(self):
+        event_buffer = self.event_buffer(max_delay=0.01)
+        event_buffer.add(uuid='1')
+        self.assertTrue(self.batch_written.wait(5))
+        self.assertEqual(self.written, [['1']])
+        event_buffer.close()
+
+    def test_written_when_full(self):
+        event_buffer = self.event_buffer(max_size=2, max_delay=60)
+        event_buffer.add(uuid='1')
+        event_buffer.add(uuid='2')
+        self.assertTrue(self.batch_written.wait(5))
+        self.assertEqual(self.written, [['1', '2']])
+        event_buffer.close()
+
+    def test_close(self):
+        event_buffer = self.event_buffer(max_delay=60)
+        event_buffer.add(uuid='1')
+        event_buffer.close()
+        self.assertEqual(self.written, [['1']])
+        self.assertFalse(event_buffer._thread.is_alive())
+
+    def test_failed_batch_logged(self):
+        self.write_error = ValueError()
+        event_buffer = self.event_buffer(max_delay=60)
+        event_buffer.add(uuid='1')
+        with patch('entity_event.buffer.logger') as logger:
+            event_buffer.close()
+        logger.exception.assert_called_once_with('Failed to write 1 buffered events')
+        self.assertEqual(len(event_buffer), 0)
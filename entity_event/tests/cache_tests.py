@@ -0,0 +1,485 @@
+import time
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django_dynamic_fixture import G
+from entity.models import Entity
+from mock import patch
+
+from entity_event import cache as entity_event_cache
+from entity_event.cache import (
+    clear_local_caches, ContextLoaders, context_cache, RecentEventUuids, source_cache, subscription_index,
+    unsubscription_cache
+)
+from entity_event.models import Event, InboxEvent, Medium, Source, Subscription, Unsubscription
+from entity_event.tests.models_tests import batch_context_loader_calls
+
+
+@override_settings(ENTITY_EVENT_SUBSCRIPTION_INDEX=True)
+class SubscriptionIndexTest(TestCase):
+    def setUp(self):
+        self.medium = G(Medium)
+        self.source = G(Source)
+        self.subscriptions = [
+            G(
+                Subscription, medium=self.medium, source=self.source, entity=G(Entity), sub_entity_kind=None,
+                only_following=False)
+            for i in range(2)
+        ]
+        self.other_subscription = G(Subscription, medium=self.medium, entity=G(Entity), sub_entity_kind=None)
+        subscription_index.invalidate()
+        subscription_index.hits = subscription_index.misses = 0
+
+    def tearDown(self):
+        subscription_index.invalidate()
+
+    def test_get(self):
+        self.assertEqual(subscription_index.get(self.medium.id, self.source.id), tuple(self.subscriptions))
+        self.assertEqual(subscription_index.get(self.medium.id, self.other_subscription.source_id + 1), ())
+
+    def test_for_medium(self):
+        self.assertEqual(
+            subscription_index.for_medium(self.medium.id), tuple(self.subscriptions + [self.other_subscription]))
+        self.assertEqual(subscription_index.for_medium(self.medium.id + 1), ())
+
+    def test_get_many(self):
+        other_source_id = self.other_subscription.source_id
+        with self.assertNumQueries(1):
+            self.assertEqual(subscription_index.get_many(self.medium.id, [self.source.id, other_source_id + 1]), {
+                self.source.id: tuple(self.subscriptions),
+                other_source_id + 1: (),
+            })
+        with override_settings(ENTITY_EVENT_SUBSCRIPTION_INDEX=False):
+            with self.assertNumQueries(1):
+                self.assertEqual(subscription_index.get_many(self.medium.id, [self.source.id, other_source_id]), {
+                    self.source.id: tuple(self.subscriptions),
+                    other_source_id: (self.other_subscription,),
+                })
+
+    def test_events_targets_version_read_once(self):
+        for i in range(3):
+            G(Event, source=self.source, context={})
+        with patch.object(entity_event_cache, '_get_version', wraps=entity_event_cache._get_version) as get_version:
+            self.assertEqual(len(self.medium.events_targets()), 3)
+        self.assertEqual(get_version.call_count, 2)
+
+    def test_cleared(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        Subscription.objects.filter(id=self.subscriptions[0].id).update(source=self.other_subscription.source)
+        self.assertEqual(len(subscription_index.get(self.medium.id, self.source.id)), 2)
+        subscription_index.clear()
+        self.assertEqual(subscription_index.get(self.medium.id, self.source.id), (self.subscriptions[1],))
+
+    def test_built_once(self):
+        with self.assertNumQueries(1):
+            subscription_index.get(self.medium.id, self.source.id)
+            subscription_index.for_medium(self.medium.id)
+            subscription_index.get(self.medium.id, self.source.id)[0].source
+        self.assertEqual(subscription_index.stats(), {'hits': 2, 'misses': 1})
+
+    def test_invalidated_by_subscription_save(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        subscription = G(
+            Subscription, medium=self.medium, source=self.source, entity=G(Entity), sub_entity_kind=None,
+            only_following=False)
+        self.assertEqual(
+            subscription_index.get(self.medium.id, self.source.id), tuple(self.subscriptions + [subscription]))
+        self.assertEqual(subscription_index.stats(), {'hits': 0, 'misses': 2})
+
+    def test_invalidated_by_subscription_delete(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        self.subscriptions[0].delete()
+        self.assertEqual(subscription_index.get(self.medium.id, self.source.id), (self.subscriptions[1],))
+
+    def test_invalidated_by_source_save(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        self.source.display_name = 'Renamed'
+        self.source.save()
+        self.assertEqual(subscription_index.get(self.medium.id, self.source.id)[0].source.display_name, 'Renamed')
+
+    def test_for_source(self):
+        self.assertEqual(subscription_index.for_source(self.source.id), tuple(self.subscriptions))
+        self.assertEqual(subscription_index.for_source(self.other_subscription.source_id + 1), ())
+        with self.assertNumQueries(0):
+            self.assertEqual(subscription_index.for_source(self.source.id)[0].medium, self.medium)
+
+    def test_invalidated_by_medium_save(self):
+        subscription_index.for_source(self.source.id)
+        self.medium.fan_out_on_write = True
+        self.medium.save()
+        self.assertTrue(subscription_index.for_source(self.source.id)[0].medium.fan_out_on_write)
+
+    def test_fan_out_without_query(self):
+        event = G(Event, source=self.source, context={})
+        subscription_index.for_source(self.source.id)
+        with self.assertNumQueries(0):
+            Event.objects._fan_out([event])
+
+        self.medium.fan_out_on_write = True
+        self.medium.save()
+        event = Event.objects.create_event(source=self.source, context={}, uuid='fanned')
+        self.assertEqual(
+            set(InboxEvent.objects.filter(event=event).values_list('entity', flat=True)),
+            set(sub.entity_id for sub in self.subscriptions))
+
+    def test_invalidated_by_other_process(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        cache.incr(subscription_index.version_key)
+        subscription_index.get(self.medium.id, self.source.id)
+        self.assertEqual(subscription_index.stats(), {'hits': 0, 'misses': 2})
+
+    def test_version_evicted(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        cache.delete(subscription_index.version_key)
+        subscription_index.get(self.medium.id, self.source.id)
+        cache.delete(subscription_index.version_key)
+        subscription_index.invalidate()
+        subscription_index.get(self.medium.id, self.source.id)
+        self.assertEqual(subscription_index.stats(), {'hits': 0, 'misses': 3})
+
+    @override_settings(ENTITY_EVENT_SUBSCRIPTION_INDEX_MAX_AGE=0)
+    def test_max_age(self):
+        subscription_index.get(self.medium.id, self.source.id)
+        subscription_index.get(self.medium.id, self.source.id)
+        self.assertEqual(subscription_index.stats(), {'hits': 0, 'misses': 2})
+
+    def test_disabled(self):
+        with override_settings(ENTITY_EVENT_SUBSCRIPTION_INDEX=False):
+            with self.assertNumQueries(3):
+                self.assertEqual(
+                    subscription_index.get(self.medium.id, self.source.id), tuple(self.subscriptions))
+                self.assertEqual(subscription_index.for_medium(self.medium.id + 1), ())
+                self.assertEqual(subscription_index.for_source(self.source.id), tuple(self.subscriptions))
+        self.assertEqual(subscription_index.stats(), {'hits': 0, 'misses': 0})
+
+    def test_medium_events(self):
+        event = G(Event, source=self.source, context={})
+        G(Event, context={})
+        with CaptureQueriesContext(connection) as building:
+            self.assertEqual(list(self.medium.events()), [event])
+        with CaptureQueriesContext(connection) as built:
+            self.assertEqual(list(self.medium.events()), [event])
+        self.assertEqual(len(built), len(building) - 1)
+
+
+@override_settings(ENTITY_EVENT_UNSUBSCRIPTION_CACHE=True)
+class UnsubscriptionCacheTest(TestCase):
+    def setUp(self):
+        self.medium = G(Medium)
+        self.sources = [G(Source) for i in range(3)]
+        self.entities = [G(Entity) for i in range(2)]
+        for entity in self.entities:
+            G(Unsubscription, medium=self.medium, source=self.sources[0], entity=entity)
+        G(Unsubscription, medium=self.medium, source=self.sources[1], entity=self.entities[0])
+        G(Unsubscription, medium=G(Medium), source=self.sources[2], entity=self.entities[0])
+        unsubscription_cache.invalidate(self.medium.id)
+        unsubscription_cache.hits = unsubscription_cache.misses = 0
+
+    def tearDown(self):
+        unsubscription_cache.invalidate(self.medium.id)
+
+    def test_get_many(self):
+        self.assertEqual(unsubscription_cache.get_many(self.medium.id, [s.id for s in self.sources]), {
+            self.sources[0].id: frozenset(e.id for e in self.entities),
+            self.sources[1].id: frozenset([self.entities[0].id]),
+            self.sources[2].id: frozenset(),
+        })
+
+    def test_cached(self):
+        source_ids = [s.id for s in self.sources]
+        with self.assertNumQueries(1):
+            unsubscription_cache.get_many(self.medium.id, source_ids[:2])
+            unsubscription_cache.get_many(self.medium.id, source_ids[:2])
+        with self.assertNumQueries(1):
+            unsubscription_cache.get_many(self.medium.id, source_ids)
+        self.assertEqual(unsubscription_cache.stats(), {'hits': 4, 'misses': 3})
+
+    def test_cleared(self):
+        unsubscription_cache.get_many(self.medium.id, [self.sources[1].id])
+        Unsubscription.objects.filter(source=self.sources[1]).update(entity=self.entities[1])
+        unsubscription_cache.clear()
+        self.assertEqual(
+            unsubscription_cache.get_many(self.medium.id, [self.sources[1].id]),
+            {self.sources[1].id: frozenset([self.entities[1].id])})
+
+    def test_invalidated_by_unsubscription_save(self):
+        unsubscription_cache.get_many(self.medium.id, [self.sources[1].id])
+        G(Unsubscription, medium=self.medium, source=self.sources[1], entity=self.entities[1])
+        self.assertEqual(
+            unsubscription_cache.get_many(self.medium.id, [self.sources[1].id]),
+            {self.sources[1].id: frozenset(e.id for e in self.entities)})
+
+    def test_invalidated_by_unsubscription_delete(self):
+        unsubscription_cache.get_many(self.medium.id, [self.sources[1].id])
+        Unsubscription.objects.get(medium=self.medium, source=self.sources[1]).delete()
+        self.assertEqual(
+            unsubscription_cache.get_many(self.medium.id, [self.sources[1].id]), {self.sources[1].id: frozenset()})
+
+    def test_invalidated_by_other_process(self):
+        unsubscription_cache.get_many(self.medium.id, [self.sources[0].id])
+        cache.incr(unsubscription_cache.version_key.format(self.medium.id))
+        unsubscription_cache.get_many(self.medium.id, [self.sources[0].id])
+        self.assertEqual(unsubscription_cache.stats(), {'hits': 0, 'misses': 2})
+
+    @override_settings(ENTITY_EVENT_UNSUBSCRIPTION_CACHE_MAX_AGE=0)
+    def test_max_age(self):
+        unsubscription_cache.get_many(self.medium.id, [self.sources[0].id])
+        unsubscription_cache.get_many(self.medium.id, [self.sources[0].id])
+        self.assertEqual(unsubscription_cache.stats(), {'hits': 0, 'misses': 2})
+
+    @override_settings(ENTITY_EVENT_UNSUBSCRIPTION_CACHE_SIZE=2)
+    def test_least_recently_used_discarded(self):
+        source_ids = [s.id for s in self.sources]
+        unsubscription_cache.get_many(self.medium.id, source_ids[:2])
+        unsubscription_cache.get_many(self.medium.id, source_ids[:1])
+        unsubscription_cache.get_many(self.medium.id, source_ids[2:])
+        with self.assertNumQueries(0):
+            unsubscription_cache.get_many(self.medium.id, [source_ids[0], source_ids[2]])
+        with self.assertNumQueries(1):
+            unsubscription_cache.get_many(self.medium.id, source_ids[1:2])
+
+    def test_disabled(self):
+        with override_settings(ENTITY_EVENT_UNSUBSCRIPTION_CACHE=False):
+            with self.assertNumQueries(2):
+                unsubscription_cache.get_many(self.medium.id, [self.sources[1].id])
+                unsubscriptions = self.medium.unsubscriptions
+                self.assertEqual(unsubscriptions[self.sources[1].id], frozenset([self.entities[0].id]))
+                self.assertEqual(unsubscriptions[self.sources[1].id], frozenset([self.entities[0].id]))
+        self.assertEqual(unsubscription_cache.stats(), {'hits': 0, 'misses': 0})
+
+    def test_medium_unsubscriptions(self):
+        unsubscriptions = self.medium.unsubscriptions
+        with self.assertNumQueries(1):
+            unsubscriptions.preload([s.id for s in self.sources])
+            unsubscriptions.preload([s.id for s in self.sources])
+            self.assertEqual(unsubscriptions[self.sources[1].id], frozenset([self.entities[0].id]))
+            self.assertEqual(unsubscriptions[self.sources[2].id], frozenset())
+        medium = Medium.objects.get(id=self.medium.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(medium.unsubscriptions[self.sources[1].id], frozenset([self.entities[0].id]))
+
+    def test_medium_unsubscriptions_contains_and_get(self):
+        unsubscriptions = self.medium.unsubscriptions
+        with self.assertNumQueries(3):
+            self.assertTrue(self.sources[1].id in unsubscriptions)
+            self.assertFalse(self.sources[2].id in unsubscriptions)
+            self.assertFalse(0 in unsubscriptions)
+        with self.assertNumQueries(0):
+            self.assertEqual(unsubscriptions.get(self.sources[1].id), frozenset([self.entities[0].id]))
+            self.assertIsNone(unsubscriptions.get(self.sources[2].id))
+            self.assertEqual(unsubscriptions.get(self.sources[2].id, []), [])
+
+    def test_medium_unsubscriptions_iterated(self):
+        unsubscriptions = self.medium.unsubscriptions
+        with self.assertNumQueries(2):
+            self.assertEqual(dict(unsubscriptions.items()), {
+                self.sources[0].id: frozenset(e.id for e in self.entities),
+                self.sources[1].id: frozenset([self.entities[0].id]),
+            })
+        self.assertEqual(len(unsubscriptions), 2)
+        self.assertEqual(sorted(unsubscriptions), sorted([self.sources[0].id, self.sources[1].id]))
+
+
+@override_settings(ENTITY_EVENT_SOURCE_CACHE=True)
+class SourceCacheTest(TestCase):
+    def setUp(self):
+        self.sources = [G(Source, context_loader='entity_event.tests.models_tests.basic_context_loader'), G(Source)]
+        source_cache.invalidate()
+        source_cache.hits = source_cache.misses = 0
+
+    def tearDown(self):
+        source_cache.invalidate()
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(source_cache.get(self.sources[0].id), self.sources[0])
+            self.assertEqual(source_cache.get(self.sources[1].id), self.sources[1])
+        self.assertEqual(source_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_does_not_exist(self):
+        with self.assertRaises(Source.DoesNotExist):
+            source_cache.get(self.sources[1].id + 1)
+
+    def test_cleared(self):
+        source_cache.get(self.sources[0].id)
+        Source.objects.filter(id=self.sources[0].id).update(display_name='Renamed')
+        source_cache.clear()
+        self.assertEqual(source_cache.get(self.sources[0].id).display_name, 'Renamed')
+
+    def test_invalidated_by_source_save(self):
+        source_cache.get(self.sources[0].id)
+        self.sources[0].display_name = 'Renamed'
+        self.sources[0].save()
+        self.assertEqual(source_cache.get(self.sources[0].id).display_name, 'Renamed')
+
+    def test_invalidated_by_source_delete(self):
+        source_cache.get(self.sources[1].id)
+        self.sources[1].delete()
+        with self.assertRaises(Source.DoesNotExist):
+            source_cache.get(self.sources[1].id)
+
+    @override_settings(ENTITY_EVENT_SOURCE_CACHE_MAX_AGE=0)
+    def test_max_age(self):
+        source_cache.get(self.sources[0].id)
+        source_cache.get(self.sources[0].id)
+        self.assertEqual(source_cache.stats(), {'hits': 0, 'misses': 2})
+
+    def test_disabled(self):
+        with override_settings(ENTITY_EVENT_SOURCE_CACHE=False):
+            with self.assertNumQueries(2):
+                source_cache.get(self.sources[0].id)
+                source_cache.get(self.sources[0].id)
+        self.assertEqual(source_cache.stats(), {'hits': 0, 'misses': 0})
+
+    def test_event_get_context(self):
+        events = [G(Event, source=source, context={'hi': 'hi'}) for source in self.sources * 2]
+        events = list(Event.objects.filter(id__in=[event.id for event in events]).order_by('id'))
+        with self.assertNumQueries(1):
+            contexts = [event.get_context() for event in events]
+        self.assertEqual(contexts, [{'hello': 'hello'}, {'hi': 'hi'}] * 2)
+
+
+@override_settings(ENTITY_EVENT_CONTEXT_CACHE=True)
+class ContextCacheTest(TestCase):
+    def setUp(self):
+        self.source = G(
+            Source, context_loader='entity_event.tests.models_tests.batch_context_loader_with_calls',
+            context_cache_ttl=60)
+        self.events = [G(Event, source=self.source, context={'i': i}) for i in range(3)]
+        context_cache.invalidate(self.source.id)
+        context_cache.hits = context_cache.misses = 0
+        del batch_context_loader_calls[:]
+
+    def tearDown(self):
+        context_cache.invalidate(self.source.id)
+
+    def test_get_context(self):
+        self.assertEqual(self.events[0].get_context(), {'i': 0, 'loaded': True})
+        self.assertEqual(self.events[0].get_context(), {'i': 0, 'loaded': True})
+        self.assertEqual(batch_context_loader_calls, [1])
+        self.assertEqual(context_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_load_contexts(self):
+        self.events[1].get_context()
+        events = Event.objects.filter(id__in=[event.id for event in self.events]).order_by('id')
+        self.assertEqual(
+            [context for event, context in events.load_contexts()], [{'i': i, 'loaded': True} for i in range(3)])
+        self.assertEqual(batch_context_loader_calls, [1, 2])
+        events.load_contexts()
+        self.assertEqual(batch_context_loader_calls, [1, 2])
+
+    def test_shared_cache(self):
+        self.events[0].get_context()
+        context_cache._entries.clear()
+        self.assertEqual(self.events[0].get_context(), {'i': 0, 'loaded': True})
+        self.assertEqual(batch_context_loader_calls, [1])
+
+    @override_settings(ENTITY_EVENT_CONTEXT_CACHE_LOCAL_SIZE=1)
+    def test_local_size(self):
+        self.events[0].get_context()
+        self.events[1].get_context()
+        version = context_cache.get_version(self.source.id)
+        self.assertEqual(list(context_cache._entries), [(self.source.id, version, self.events[1].id)])
+
+    @override_settings(ENTITY_EVENT_CONTEXT_CACHE_LOCAL_SIZE=0)
+    def test_no_local_tier(self):
+        self.events[0].get_context()
+        self.assertEqual(self.events[0].get_context(), {'i': 0, 'loaded': True})
+        self.assertEqual(batch_context_loader_calls, [1])
+        self.assertEqual(list(context_cache._entries), [])
+
+    def test_current_version(self):
+        context_cache.set_many(self.source, {self.events[0].id: {'i': 0}})
+        self.assertEqual(
+            context_cache.get_many(self.source, [self.events[0].id, self.events[1].id]), {self.events[0].id: {'i': 0}})
+
+    def test_cleared(self):
+        self.events[0].get_context()
+        context_cache.clear()
+        self.assertEqual(list(context_cache._entries), [])
+        self.assertEqual(self.events[0].get_context(), {'i': 0, 'loaded': True})
+        self.assertEqual(batch_context_loader_calls, [1])
+
+    def test_expires(self):
+        self.events[0].get_context()
+        with patch('time.time', return_value=time.time() + 61):
+            self.events[0].get_context()
+        self.assertEqual(batch_context_loader_calls, [1, 1])
+
+    def test_invalidated_by_source_save(self):
+        self.events[0].get_context()
+        self.source.save()
+        self.events[0].get_context()
+        self.assertEqual(batch_context_loader_calls, [1, 1])
+
+    def test_invalidate_events(self):
+        self.events[0].get_context()
+        self.events[1].get_context()
+        context_cache.invalidate_events(self.source.id, [self.events[0].id])
+        self.events[0].get_context()
+        self.events[1].get_context()
+        self.assertEqual(batch_context_loader_calls, [1, 1, 1])
+
+    def test_not_cached_without_ttl(self):
+        self.source.context_cache_ttl = None
+        self.source.save()
+        self.events[0].source = self.source
+        self.events[0].get_context()
+        self.events[0].get_context()
+        self.assertEqual(batch_context_loader_calls, [1, 1])
+        self.assertEqual(context_cache.stats(), {'hits': 0, 'misses': 0})
+
+    def test_disabled(self):
+        with override_settings(ENTITY_EVENT_CONTEXT_CACHE=False):
+            self.events[0].get_context()
+            self.events[0].get_context()
+        self.assertEqual(batch_context_loader_calls, [1, 1])
+
+
+class ClearLocalCachesTest(SimpleTestCase):
+    def test_clears_each_cache(self):
+        with patch.object(subscription_index, 'clear') as subscription_index_clear, \
+                patch.object(unsubscription_cache, 'clear') as unsubscription_cache_clear, \
+                patch.object(source_cache, 'clear') as source_cache_clear, \
+                patch.object(context_cache, 'clear') as context_cache_clear:
+            clear_local_caches()
+        for clear in [subscription_index_clear, unsubscription_cache_clear, source_cache_clear, context_cache_clear]:
+            clear.assert_called_once_with()
+
+
+class ContextLoadersTest(SimpleTestCase):
+    def test_imported_once(self):
+        context_loaders = ContextLoaders()
+        path = 'entity_event.tests.models_tests.basic_context_loader'
+        loader = context_loaders.get(path)
+        with patch('entity_event.cache.import_by_path') as import_by_path:
+            self.assertIs(context_loaders.get(path), loader)
+        self.assertFalse(import_by_path.called)
+
+    def test_invalid_path(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ContextLoaders().get('entity_event.tests.models_tests.invalid_context_loader')
+
+
+class RecentEventUuidsTest(SimpleTestCase):
+    @override_settings(ENTITY_EVENT_RECENT_UUIDS_SIZE=2)
+    def test_least_recently_used_discarded(self):
+        recent_uuids = RecentEventUuids()
+        recent_uuids.add('1')
+        recent_uuids.add('2')
+        self.assertIn('1', recent_uuids)
+        recent_uuids.add('3')
+        self.assertIn('1', recent_uuids)
+        self.assertNotIn('2', recent_uuids)
+        self.assertIn('3', recent_uuids)
+
+        recent_uuids.clear()
+        self.assertNotIn('1', recent_uuids)
+
+    def test_disabled(self):
+        recent_uuids = RecentEventUuids()
+        recent_uuids.add('1')
+        self.assertNotIn('1', recent_uuids)
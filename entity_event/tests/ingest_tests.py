@@ -0,0 +1,85 @@
+from datetime import datetime
+
+from django.db import connection
+from django.test import TestCase
+from django_dynamic_fixture import G
+from entity.models import Entity
+from mock import patch
+
+from entity_event.ingest import import_events, read_ndjson
+from entity_event.models import Event, EventActor, InboxEvent, Medium, Source, Subscription
+
+
+class ImportEventsTest(TestCase):
+    def setUp(self):
+        self.source = G(Source)
+        self.actors = [G(Entity), G(Entity)]
+
+    def event_spec(self, uuid, **kwargs):
+        spec = {'source': self.source, 'context': {'uuid': uuid}, 'uuid': uuid}
+        spec.update(kwargs)
+        return spec
+
+    def test_import_events(self):
+        created, skipped = import_events([
+            self.event_spec('1', actors=self.actors, time_expires=datetime(2030, 1, 1)),
+            self.event_spec('2', actors=[self.actors[1].id], context={'text': u'caf\xe9, "quoted"\nline'}),
+            {'source_id': self.source.id, 'context': {}, 'uuid': ''},
+        ])
+        self.assertEqual((created, skipped), (3, 0))
+        events = dict((e.uuid, e) for e in Event.objects.all())
+        self.assertEqual(events['1'].time_expires, datetime(2030, 1, 1))
+        self.assertEqual(events['2'].context, {'text': u'caf\xe9, "quoted"\nline'})
+        self.assertEqual(events[''].source, self.source)
+        self.assertEqual(events[''].time_expires, datetime.max)
+        self.assertEqual(
+            set(EventActor.objects.values_list('event__uuid', 'entity')),
+            set([('1', self.actors[0].id), ('1', self.actors[1].id), ('2', self.actors[1].id)]))
+
+    def test_skips_duplicates(self):
+        Event.objects.create_event(uuid='1', source=self.source, context={})
+        created, skipped = import_events((self.event_spec(uuid, actors=self.actors) for uuid in '12324'), batch_size=2)
+        self.assertEqual((created, skipped), (3, 2))
+        self.assertEqual(sorted(Event.objects.values_list('uuid', flat=True)), ['1', '2', '3', '4'])
+        self.assertEqual(EventActor.objects.count(), 6)
+
+    def test_other_vendor(self):
+        Event.objects.create_event(uuid='1', source=self.source, context={})
+        with patch.object(connection, 'vendor', 'other'), patch('entity_event.ingest._copy_batch') as copy_batch:
+            created, skipped = import_events((self.event_spec(uuid, actors=self.actors) for uuid in '1232'))
+        self.assertFalse(copy_batch.called)
+        self.assertEqual((created, skipped), (2, 2))
+        self.assertEqual(sorted(Event.objects.values_list('uuid', flat=True)), ['1', '2', '3'])
+        self.assertEqual(EventActor.objects.count(), 4)
+
+    def test_fans_out(self):
+        medium = G(Medium, fan_out_on_write=True)
+        G(Subscription, medium=medium, source=self.source, entity=self.actors[0], sub_entity_kind=None,
+          only_following=False)
+        import_events([self.event_spec('1')])
+        self.assertEqual(
+            list(InboxEvent.objects.values_list('entity', 'event__uuid')), [(self.actors[0].id, '1')])
+
+
+class ReadNdjsonTest(TestCase):
+    def test_read_ndjson(self):
+        source = G(Source, name='photo_tag')
+        lines = [
+            '{"source": "photo_tag", "context": {"photo_id": 1}, "uuid": "1", "actors": [3, 4]}\n',
+            '\n',
+            '{"source_id": 2, "context": {}, "time_expires": "2030-01-01T00:00:00"}\n',
+            '{"source": "photo_tag", "context": {}, "time_expires": null}\n',
+        ]
+        self.assertEqual(list(read_ndjson(lines)), [
+            {'source_id': source.id, 'context': {'photo_id': 1}, 'uuid': '1', 'actors': [3, 4]},
+            {'source_id': 2, 'context': {}, 'time_expires': datetime(2030, 1, 1)},
+            {'source_id': source.id, 'context': {}, 'time_expires': None},
+        ])
+
+    def test_invalid_json(self):
+        with self.assertRaisesRegexp(ValueError, 'Invalid JSON on line 2'):
+            list(read_ndjson(['{"context": {}}', '{']))
+
+    def test_unknown_source(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown source u?'missing' on line 1"):
+            list(read_ndjson(['{"source": "missing"}']))
@@ -0,0 +1,229 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django_dynamic_fixture import G
+from entity.models import Entity
+from mock import call, MagicMock, patch
+
+from entity_event.instrumentation import (
+    add_sink, instrumented, log_sink, measured, Measurement, phase, remove_sink, StatsdSink
+)
+from entity_event.models import Event, Medium, Source, Subscription
+
+
+class InstrumentationTestMixin(object):
+    def add_sink(self, sink=None):
+        measurements = []
+        sink = sink or measurements.append
+        add_sink(sink)
+        self.addCleanup(remove_sink, sink)
+        return measurements
+
+
+class MediumInstrumentationTest(InstrumentationTestMixin, TestCase):
+    def setUp(self):
+        self.medium = G(Medium, name='email')
+        self.source = G(Source)
+        self.entities = [G(Entity), G(Entity)]
+        for entity in self.entities:
+            G(Subscription, medium=self.medium, source=self.source, entity=entity, sub_entity_kind=None,
+              only_following=False)
+        self.events = [
+            Event.objects.create_event(source=self.source, context={}, uuid=str(i)) for i in range(3)
+        ]
+
+    def test_not_measured_without_sinks(self):
+        with patch('entity_event.instrumentation._Measuring') as measuring:
+            self.medium.events_targets()
+        self.assertFalse(measuring.called)
+
+    def test_events_targets(self):
+        measurements = self.add_sink()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.medium.events_targets(seen=False, mark_seen=True)), 3)
+
+        self.assertEqual(len(measurements), 1)
+        measurement = measurements[0]
+        self.assertEqual(measurement.name, 'medium.events_targets')
+        self.assertEqual(measurement.medium, 'email')
+        self.assertEqual(measurement.rows, 3)
+        self.assertEqual(measurement.targets, 6)
+        self.assertEqual(measurement.queries, len(queries))
+        self.assertIsNone(measurement.error)
+        self.assertEqual(
+            set(measurement.phases),
+            set(['mark_seen', 'event_scan', 'subscription_load', 'target_resolution', 'unsubscription_load']))
+        self.assertTrue(sum(phase['queries'] for phase in measurement.phases.values()) <= measurement.queries)
+
+    def test_nested_measurements(self):
+        measurements = self.add_sink()
+        self.medium.events_targets(batch=True)
+
+        self.assertEqual(
+            [measurement.name for measurement in measurements],
+            ['medium.resolve_events_targets', 'medium.events_targets'])
+        inner, outer = measurements
+        self.assertEqual((outer.rows, outer.targets), (3, 6))
+        self.assertTrue(outer.queries >= inner.queries)
+        self.assertEqual(set(outer.phases), set(inner.phases))
+
+    def test_queryset_rows_not_counted(self):
+        measurements = self.add_sink()
+        self.medium.events()
+        self.assertEqual(measurements[0].name, 'medium.events')
+        self.assertIsNone(measurements[0].rows)
+        self.assertEqual(list(measurements[0].phases), ['subscription_load'])
+
+    def test_events_page(self):
+        measurements = self.add_sink()
+        self.medium.events_page(page_size=2)
+        self.assertEqual([m.name for m in measurements], ['medium.events', 'medium.events_page'])
+        self.assertEqual(measurements[1].rows, 2)
+        self.assertIn('event_scan', measurements[1].phases)
+
+    def test_entity_events_bulk(self):
+        measurements = self.add_sink()
+        self.medium.entity_events_bulk(self.entities)
+        self.assertEqual(measurements[0].rows, 6)
+
+    def test_create_event(self):
+        measurements = self.add_sink()
+        Event.objects.create_event(source=self.source, context={}, uuid='new')
+        Event.objects.create_event(source=self.source, context={}, uuid='new', ignore_duplicates=True)
+        self.assertEqual([m.name for m in measurements], ['event_manager.create_event'] * 2)
+        self.assertEqual([m.medium for m in measurements], [None, None])
+        self.assertEqual([m.rows for m in measurements], [1, 0])
+
+    def test_claim_events(self):
+        measurements = self.add_sink()
+        self.medium.claim_events(batch_size=2)
+        self.assertEqual(measurements[0].name, 'medium.claim_events')
+        self.assertEqual(measurements[0].rows, 2)
+
+    def test_error(self):
+        measurements = self.add_sink()
+        self.medium.use_seen_watermark = True
+        with self.assertRaises(ImproperlyConfigured):
+            self.medium.claim_events()
+        self.assertIsInstance(measurements[0].error, ImproperlyConfigured)
+        self.assertIsNone(measurements[0].rows)
+
+    def test_logged_queries_removed(self):
+        self.add_sink()
+        self.assertFalse(connection.use_debug_cursor)
+        queries = len(connection.queries)
+        self.medium.events_targets()
+        self.assertEqual(len(connection.queries), queries)
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_signal(self):
+        measurements = []
+
+        def receiver(sender, measurement, **kwargs):
+            measurements.append(measurement)
+
+        measured.connect(receiver)
+        self.addCleanup(measured.disconnect, receiver)
+        self.medium.events_targets()
+        self.assertEqual([m.name for m in measurements], ['medium.events_targets'])
+
+    def test_failing_receiver_logged(self):
+        def receiver(sender, measurement, **kwargs):
+            raise ValueError()
+
+        measured.connect(receiver)
+        self.addCleanup(measured.disconnect, receiver)
+        with patch('entity_event.instrumentation.logger') as logger:
+            self.assertEqual(len(self.medium.events_targets()), 3)
+        self.assertEqual(logger.error.call_count, 1)
+
+    def test_sink_added_once(self):
+        measurements = self.add_sink()
+        add_sink(measurements.append)
+        self.medium.events_targets()
+        self.assertEqual(len(measurements), 1)
+        remove_sink(measurements.append)
+        remove_sink(measurements.append)
+        self.medium.events_targets()
+        self.assertEqual(len(measurements), 1)
+
+    def test_failing_sink_logged(self):
+        def sink(measurement):
+            raise ValueError()
+
+        self.add_sink(sink)
+        with patch('entity_event.instrumentation.logger') as logger:
+            self.assertEqual(len(self.medium.events_targets()), 3)
+        self.assertEqual(logger.exception.call_count, 1)
+
+
+class PhaseTest(InstrumentationTestMixin, SimpleTestCase):
+    class Measured(object):
+        name = 'measured'
+
+        @instrumented('measured.run', medium=True)
+        def run(self, *phases):
+            for name in phases:
+                with phase(name):
+                    with phase('inner'):
+                        pass
+
+    def test_totalled(self):
+        measurements = self.add_sink()
+        self.Measured().run('load', 'scan', 'load')
+        self.assertEqual(list(measurements[0].phases), ['load', 'scan'])
+        self.assertEqual(measurements[0].medium, 'measured')
+        self.assertEqual(measurements[0].phases['load']['queries'], 0)
+
+    def test_outside_measurement(self):
+        self.add_sink()
+        with phase('load'):
+            pass
+
+
+class SinksTest(SimpleTestCase):
+    def setUp(self):
+        self.measurement = Measurement('medium.events_targets', 'email')
+        self.measurement.duration = 0.25
+        self.measurement.queries = 4
+        self.measurement.rows = 2
+        self.measurement.targets = 3
+        self.measurement.phases['event_scan'] = {'duration': 0.125, 'queries': 1}
+
+    def test_str(self):
+        self.assertEqual(
+            str(self.measurement),
+            'medium.events_targets on email took 250.0ms with 4 queries, 2 rows, 3 targets '
+            '(event_scan 125.0ms with 1 queries)')
+
+    def test_str_without_results(self):
+        measurement = Measurement('event_manager.create_event')
+        measurement.duration = 0.25
+        measurement.error = ValueError()
+        self.assertEqual(
+            str(measurement), 'event_manager.create_event took 250.0ms with 0 queries and raised ValueError()')
+
+    def test_log_sink(self):
+        with patch('entity_event.instrumentation.logger') as logger:
+            log_sink(self.measurement)
+        logger.info.assert_called_once_with('%s', self.measurement)
+
+    def test_statsd_sink(self):
+        client = MagicMock()
+        StatsdSink(client, prefix='app')(self.measurement)
+        self.assertEqual(client.timing.call_args_list, [
+            call('app.medium.events_targets', 250.0),
+            call('app.medium.events_targets.event_scan', 125.0),
+        ])
+        self.assertEqual(client.incr.call_args_list, [
+            call('app.medium.events_targets.queries', 4),
+            call('app.medium.events_targets.rows', 2),
+            call('app.medium.events_targets.targets', 3),
+        ])
+
+    def test_statsd_sink_without_results(self):
+        client = MagicMock()
+        self.measurement.rows = self.measurement.targets = None
+        StatsdSink(client)(self.measurement)
+        self.assertEqual(client.incr.call_args_list, [call('entity_event.medium.events_targets.queries', 4)])
@@ -0,0 +1,193 @@
+from datetime import datetime, timedelta
+import shutil
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import G
+from entity.models import Entity
+from freezegun import freeze_time
+from mock import patch
+from six import StringIO
+
+from entity_event.models import Medium, Source, Subscription, SubscriptionMember, Event, EventActor, InboxEvent
+
+
+class BackfillInboxEventsTest(TestCase):
+    def setUp(self):
+        self.entity = G(Entity)
+        self.source = G(Source)
+        self.event = G(Event, source=self.source, context={})
+        G(EventActor, event=self.event, entity=self.entity)
+
+    def subscribed_medium(self, **kwargs):
+        medium = G(Medium, **kwargs)
+        G(Subscription, medium=medium, source=self.source, entity=self.entity, sub_entity_kind=None)
+        return medium
+
+    def test_fan_out_on_write_mediums(self):
+        medium = self.subscribed_medium(fan_out_on_write=True)
+        self.subscribed_medium(fan_out_on_write=False)
+        stdout = StringIO()
+        call_command('backfill_inbox_events', stdout=stdout)
+        self.assertEqual(list(InboxEvent.objects.values_list('medium', 'entity')), [(medium.id, self.entity.id)])
+        self.assertEqual(stdout.getvalue(), 'Rebuilt inboxes for {0}\n'.format(medium.name))
+
+    def test_named_mediums(self):
+        self.subscribed_medium(fan_out_on_write=True)
+        medium = self.subscribed_medium(fan_out_on_write=False)
+        call_command('backfill_inbox_events', medium.name, stdout=StringIO())
+        self.assertEqual(list(InboxEvent.objects.values_list('medium', 'entity')), [(medium.id, self.entity.id)])
+
+    def test_unknown_medium(self):
+        with self.assertRaises(CommandError):
+            call_command('backfill_inbox_events', 'missing', stdout=StringIO())
+
+
+@override_settings(ENTITY_EVENT_SUBSCRIPTION_MEMBERS=True)
+class RebuildSubscriptionMembersTest(TestCase):
+    def setUp(self):
+        self.entity = G(Entity)
+        self.subscription = G(Subscription, entity=self.entity, sub_entity_kind=None)
+
+    def test_rebuild(self):
+        SubscriptionMember.objects.all().delete()
+        stdout = StringIO()
+        call_command('rebuild_subscription_members', stdout=stdout)
+        self.assertEqual(
+            list(SubscriptionMember.objects.values_list('subscription', 'entity')),
+            [(self.subscription.id, self.entity.id)])
+        self.assertEqual(stdout.getvalue(), 'Created 1 and deleted 0 subscription members\n')
+
+    def test_verify(self):
+        stdout = StringIO()
+        call_command('rebuild_subscription_members', verify=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Subscription members are up to date\n')
+
+    def test_verify_out_of_date(self):
+        SubscriptionMember.objects.all().delete()
+        with self.assertRaisesRegexp(CommandError, '1 subscription members are missing and 0 should not be stored'):
+            call_command('rebuild_subscription_members', verify=True, stdout=StringIO())
+        self.assertFalse(SubscriptionMember.objects.exists())
+
+
+class ImportEventsTest(TestCase):
+    def setUp(self):
+        self.source = G(Source, name='photo_tag')
+        self.events_file = NamedTemporaryFile(mode='w', suffix='.ndjson')
+        self.events_file.write('{"source": "photo_tag", "context": {}, "uuid": "1"}\n')
+        self.events_file.write('{"source": "photo_tag", "context": {}, "uuid": "1"}\n')
+        self.events_file.flush()
+
+    def tearDown(self):
+        self.events_file.close()
+
+    def test_import_file(self):
+        stdout = StringIO()
+        call_command('import_events', self.events_file.name, stdout=stdout)
+        self.assertEqual(list(Event.objects.values_list('uuid', 'source')), [('1', self.source.id)])
+        self.assertEqual(
+            stdout.getvalue(), 'Created 1 events and skipped 1 duplicates from {0}\n'.format(self.events_file.name))
+
+    def test_import_stdin(self):
+        stdout = StringIO()
+        with patch('sys.stdin', StringIO('{"source": "photo_tag", "context": {}, "uuid": "2"}\n')):
+            call_command('import_events', '-', batch_size=1, stdout=stdout)
+        self.assertEqual(list(Event.objects.values_list('uuid', flat=True)), ['2'])
+        self.assertEqual(stdout.getvalue(), 'Created 1 events and skipped 0 duplicates from -\n')
+
+    def test_no_files(self):
+        with self.assertRaisesRegexp(CommandError, 'At least one file must be given'):
+            call_command('import_events')
+
+    def test_invalid_file(self):
+        with self.assertRaisesRegexp(CommandError, 'Could not import missing.ndjson'):
+            call_command('import_events', 'missing.ndjson')
+
+
+class ExplainEventQueriesTest(TestCase):
+    def setUp(self):
+        self.medium = G(Medium, name='newsfeed')
+        self.entity = G(Entity)
+        G(Subscription, medium=self.medium, entity=self.entity, sub_entity_kind=None)
+
+    def test_explain(self):
+        stdout = StringIO()
+        call_command('explain_event_queries', 'newsfeed', stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(
+            [line for line in lines if not line.startswith('    ')], ['Events:', 'Unseen events:', 'Seen event probe:'])
+        self.assertTrue(len(lines) > 3)
+
+    def test_explain_entity(self):
+        stdout = StringIO()
+        call_command('explain_event_queries', 'newsfeed', entity_id=self.entity.id, analyze=True, stdout=stdout)
+        self.assertIn('Entity events:', stdout.getvalue())
+        self.assertIn('Actor events:', stdout.getvalue())
+
+    def test_no_subscriptions(self):
+        G(Medium, name='email')
+        stdout = StringIO()
+        call_command('explain_event_queries', 'email', stdout=stdout)
+        self.assertIn('Events:\n    No query is made, as there can be no results\n', stdout.getvalue())
+
+    def test_no_medium(self):
+        with self.assertRaisesRegexp(CommandError, 'A medium name must be given'):
+            call_command('explain_event_queries')
+
+    def test_unknown_medium(self):
+        with self.assertRaisesRegexp(CommandError, "Unknown medium 'email'"):
+            call_command('explain_event_queries', 'email')
+
+    def test_unknown_entity(self):
+        with self.assertRaisesRegexp(CommandError, 'Unknown entity'):
+            call_command('explain_event_queries', 'newsfeed', entity_id=self.entity.id + 1)
+
+
+class PurgeExpiredEventsTest(TestCase):
+    def setUp(self):
+        self.expired = [G(Event, context={}, time_expires=datetime(2014, 1, 1)) for i in range(3)]
+        self.event = G(Event, context={})
+
+    def test_purge(self):
+        stdout = StringIO()
+        call_command('purge_expired_events', batch_size=2, stdout=stdout)
+        self.assertEqual(list(Event.objects.all()), [self.event])
+        self.assertEqual(
+            stdout.getvalue(), 'Deleted 2 events so far\nDeleted 3 events so far\nDeleted 3 events\n')
+
+    def test_older_than_days(self):
+        with freeze_time(datetime.utcnow() + timedelta(days=31)):
+            call_command('purge_expired_events', older_than_days=30, stdout=StringIO())
+        self.assertFalse(Event.objects.exists())
+
+    def test_dry_run(self):
+        stdout = StringIO()
+        call_command('purge_expired_events', dry_run=True, stdout=stdout)
+        self.assertEqual(Event.objects.count(), 4)
+        self.assertEqual(stdout.getvalue(), '3 events would be deleted\n')
+
+
+class ArchiveEventsTest(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        with freeze_time('2014-01-01'):
+            G(Event, context={})
+        self.event = G(Event, context={})
+
+    def test_archive(self):
+        stdout = StringIO()
+        call_command('archive_events', self.directory, older_than_days=30, stdout=stdout)
+        self.assertEqual(list(Event.objects.all()), [self.event])
+        self.assertEqual(stdout.getvalue().splitlines()[-1], 'Archived 1 events in 1 segments')
+
+    def test_no_directory(self):
+        with self.assertRaisesRegexp(CommandError, 'An archive directory must be given'):
+            call_command('archive_events', older_than_days=30)
+
+    def test_no_age(self):
+        with self.assertRaisesRegexp(CommandError, '--older-than-days must be given'):
+            call_command('archive_events', self.directory)
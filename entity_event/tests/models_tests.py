@@ -1,14 +1,24 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from uuid import uuid1
 
 from django.core.exceptions import ValidationError, ImproperlyConfigured
-from django.test import TestCase, SimpleTestCase
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_save
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django_dynamic_fixture import N, G
 from entity.models import Entity, EntityKind, EntityRelationship
 from freezegun import freeze_time
+from manager_utils import post_bulk_operation
+from mock import patch
 from six import text_type
 
+from entity_event.cache import clear_local_caches, recent_event_uuids, source_cache
+from entity_event.loaders import batch_context_loader
 from entity_event.models import (
-    Medium, Source, SourceGroup, Unsubscription, Subscription, Event, EventActor, EventSeen, _unseen_event_ids
+    Medium, Source, SourceGroup, Unsubscription, Subscription, Event, EventActor, EventSeen, EventLease,
+    InboxEvent, SubscriptionMember
 )
 
 
@@ -58,11 +68,284 @@ class EventManagerCreateEventTest(TestCase):
         e = Event.objects.create_event(context={'hi': 'hi'}, source=source, ignore_duplicates=True)
         self.assertIsNone(e)
 
+    def test_ignore_duplicates_creates_actors(self):
+        actor = G(Entity)
+        e = Event.objects.create_event(
+            context={'hi': 'hi'}, source=G(Source), uuid='1', actors=[actor], ignore_duplicates=True)
+        self.assertEqual(Event.objects.get(uuid='1'), e)
+        self.assertEqual(Event.objects.get(uuid='1').time, e.time)
+        self.assertEqual(list(EventActor.objects.filter(event=e).values_list('entity', flat=True)), [actor.id])
+
+    def test_ignore_duplicates_in_transaction(self):
+        source = G(Source)
+        Event.objects.create_event(context={}, source=source, uuid='1')
+        with transaction.atomic():
+            self.assertIsNone(Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True))
+            self.assertEqual(Event.objects.count(), 1)
+
+    def test_ignore_duplicates_other_vendor(self):
+        source = G(Source)
+        Event.objects.create_event(context={}, source=source, uuid='1')
+        with patch.object(connection, 'vendor', 'other'):
+            self.assertIsNone(Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True))
+            e = Event.objects.create_event(context={}, source=source, uuid='2', ignore_duplicates=True)
+        self.assertEqual(Event.objects.get(uuid='2'), e)
+        self.assertEqual(Event.objects.count(), 2)
+
+    def check_ignore_duplicates_sends_save_signals(self):
+        signals = []
+
+        def pre_save_receiver(sender, instance, **kwargs):
+            signals.append(('pre_save', instance.uuid, instance.id))
+
+        def post_save_receiver(sender, instance, created, **kwargs):
+            signals.append(('post_save', instance.uuid, instance.id, created))
+
+        pre_save.connect(pre_save_receiver, sender=Event)
+        self.addCleanup(pre_save.disconnect, pre_save_receiver, sender=Event)
+        post_save.connect(post_save_receiver, sender=Event)
+        self.addCleanup(post_save.disconnect, post_save_receiver, sender=Event)
+
+        source = G(Source)
+        e = Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True)
+        Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True)
+        self.assertEqual(signals, [('pre_save', '1', None), ('post_save', '1', e.id, True), ('pre_save', '1', None)])
+
+    def test_ignore_duplicates_sends_save_signals(self):
+        self.check_ignore_duplicates_sends_save_signals()
+
+    def test_ignore_duplicates_sends_save_signals_other_vendor(self):
+        with patch.object(connection, 'vendor', 'other'):
+            self.check_ignore_duplicates_sends_save_signals()
+
+    def test_ignore_duplicates_reraises_other_errors(self):
+        source = G(Source)
+        with patch.object(connection, 'vendor', 'other'), patch.object(Event, 'save', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True)
+
+    @override_settings(ENTITY_EVENT_RECENT_UUIDS_SIZE=10)
+    def test_ignore_duplicates_recent_uuid(self):
+        source = G(Source)
+        recent_event_uuids.add('1')
+        self.addCleanup(recent_event_uuids.clear)
+        with self.assertNumQueries(0):
+            self.assertIsNone(Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True))
+
+    @override_settings(ENTITY_EVENT_RECENT_UUIDS_SIZE=10)
+    def test_uuids_not_recorded_in_transaction(self):
+        self.addCleanup(recent_event_uuids.clear)
+        Event.objects.create_event(context={}, source=G(Source), uuid='1', ignore_duplicates=True)
+        self.assertNotIn('1', recent_event_uuids)
+
+
+@override_settings(ENTITY_EVENT_RECENT_UUIDS_SIZE=10)
+class EventManagerCreateEventRecentUuidsTest(TransactionTestCase):
+    def tearDown(self):
+        recent_event_uuids.clear()
+
+    def test_uuids_recorded(self):
+        source = G(Source)
+        Event.objects.create_event(context={}, source=source, uuid='1', ignore_duplicates=True)
+        Event.objects.create_event(context={}, source=source, uuid='2')
+        self.assertIn('1', recent_event_uuids)
+        self.assertNotIn('2', recent_event_uuids)
+
+        recent_event_uuids.clear()
+        Event.objects.create_event(context={}, source=source, uuid='2', ignore_duplicates=True)
+        self.assertIn('2', recent_event_uuids)
+
+
+class EventManagerPurgeExpiredEventsTest(TestCase):
+    def setUp(self):
+        self.medium = G(Medium)
+        self.events = [G(Event, context={}, time_expires=datetime(2014, 1, 1)) for i in range(3)]
+        with freeze_time('2014-01-01'):
+            self.events.append(G(Event, context={}))
+        self.events.append(G(Event, context={}))
+        for event in self.events:
+            G(EventActor, event=event)
+            G(EventSeen, event=event, medium=self.medium)
+            G(EventLease, event=event, medium=self.medium)
+            G(InboxEvent, event=event, medium=self.medium)
+
+    def assert_remaining(self, events):
+        event_ids = set(event.id for event in events)
+        self.assertEqual(set(Event.objects.values_list('id', flat=True)), event_ids)
+        for model in (EventActor, EventSeen, EventLease, InboxEvent):
+            self.assertEqual(set(model.objects.values_list('event', flat=True)), event_ids)
+
+    def test_purge(self):
+        self.assertEqual(Event.objects.purge_expired_events(), 3)
+        self.assert_remaining(self.events[3:])
+
+    def test_older_than(self):
+        with freeze_time(datetime.utcnow() + timedelta(minutes=1)):
+            self.assertEqual(Event.objects.purge_expired_events(older_than=timedelta(days=1)), 4)
+        self.assert_remaining(self.events[4:])
+
+    def test_batches(self):
+        progress = []
+        with patch('entity_event.models.time.sleep') as sleep:
+            purged = Event.objects.purge_expired_events(batch_size=2, sleep=0.5, progress=progress.append)
+        self.assertEqual(purged, 3)
+        self.assertEqual(progress, [2, 3])
+        sleep.assert_called_once_with(0.5)
+        self.assert_remaining(self.events[3:])
+
+    def test_batches_start_after_last(self):
+        with patch('entity_event.models._delete_events') as delete_events:
+            self.assertEqual(Event.objects.purge_expired_events(batch_size=2), 3)
+        self.assertEqual(
+            [args[1] for args, kwargs in delete_events.call_args_list],
+            [[self.events[0].id, self.events[1].id], [self.events[2].id]])
+
+    def test_dry_run(self):
+        self.assertEqual(Event.objects.purge_expired_events(older_than=timedelta(days=1), dry_run=True), 4)
+        self.assert_remaining(self.events)
+
+    def test_nothing_expired(self):
+        Event.objects.purge_expired_events()
+        progress = []
+        self.assertEqual(Event.objects.purge_expired_events(progress=progress.append), 0)
+        self.assertEqual(progress, [])
+
+
+class EventManagerBulkCreateEventsTest(TestCase):
+    def setUp(self):
+        self.source = G(Source)
+        self.actors = [G(Entity), G(Entity)]
+
+    def event_spec(self, uuid, **kwargs):
+        spec = {'source': self.source, 'context': {'uuid': uuid}, 'uuid': uuid}
+        spec.update(kwargs)
+        return spec
+
+    def test_bulk_create_events(self):
+        created, skipped = Event.objects.bulk_create_events([
+            self.event_spec('1', actors=self.actors, time_expires=datetime(2030, 1, 1)),
+            self.event_spec('2', actors=[self.actors[1].id]),
+            self.event_spec('3'),
+        ])
+        self.assertEqual((created, skipped), (3, 0))
+        events = dict((e.uuid, e) for e in Event.objects.all())
+        self.assertEqual(events['1'].context, {'uuid': '1'})
+        self.assertEqual(events['1'].time_expires, datetime(2030, 1, 1))
+        self.assertIsNotNone(events['3'].time)
+        self.assertEqual(
+            set(EventActor.objects.values_list('event__uuid', 'entity')),
+            set([('1', self.actors[0].id), ('1', self.actors[1].id), ('2', self.actors[1].id)]))
+
+    def test_batches(self):
+        specs = (self.event_spec(text_type(i), actors=self.actors[:1]) for i in range(5))
+        self.assertEqual(Event.objects.bulk_create_events(specs, batch_size=2), (5, 0))
+        self.assertEqual(EventActor.objects.count(), 5)
+
+    def test_ignore_duplicates(self):
+        self.check_ignore_duplicates()
+
+    def test_ignore_duplicates_other_vendor(self):
+        with patch.object(connection, 'vendor', 'other'):
+            self.check_ignore_duplicates()
+
+    def check_ignore_duplicates(self):
+        Event.objects.create_event(uuid='1', source=self.source, context={})
+        created, skipped = Event.objects.bulk_create_events([
+            self.event_spec('1', actors=self.actors),
+            self.event_spec('2', actors=self.actors[:1]),
+            self.event_spec('2', actors=self.actors[1:]),
+            self.event_spec('3'),
+        ], batch_size=3, ignore_duplicates=True)
+        self.assertEqual((created, skipped), (2, 2))
+        self.assertEqual(sorted(Event.objects.values_list('uuid', flat=True)), ['1', '2', '3'])
+        self.assertEqual(list(EventActor.objects.values_list('event__uuid', 'entity')), [('2', self.actors[0].id)])
+
+    def test_all_duplicates(self):
+        Event.objects.create_event(uuid='1', source=self.source, context={})
+        self.assertEqual(Event.objects.bulk_create_events([self.event_spec('1')], ignore_duplicates=True), (0, 1))
+
+    def test_duplicate_raises(self):
+        self.check_duplicate_raises()
+
+    def test_duplicate_raises_other_vendor(self):
+        with patch.object(connection, 'vendor', 'other'):
+            self.check_duplicate_raises()
+
+    def check_duplicate_raises(self):
+        Event.objects.create_event(uuid='1', source=self.source, context={})
+        with self.assertRaises(IntegrityError):
+            Event.objects.bulk_create_events([self.event_spec('2'), self.event_spec('1')])
+        self.assertEqual(list(Event.objects.values_list('uuid', flat=True)), ['1'])
+
+    def test_fans_out(self):
+        medium = G(Medium, fan_out_on_write=True)
+        G(Subscription, medium=medium, source=self.source, entity=self.actors[0], sub_entity_kind=None,
+          only_following=False)
+        Event.objects.bulk_create_events([self.event_spec('1'), self.event_spec('2', source=G(Source))])
+        self.assertEqual(
+            list(InboxEvent.objects.values_list('entity', 'event__uuid')), [(self.actors[0].id, '1')])
+
 
 def basic_context_loader(context):
     return {'hello': 'hello'}
 
 
+batch_context_loader_calls = []
+
+
+@batch_context_loader
+def batch_context_loader_with_calls(contexts):
+    batch_context_loader_calls.append(len(contexts))
+    return [dict(context, loaded=True) for context in contexts]
+
+
+class SourceGetContextsTest(SimpleTestCase):
+    def setUp(self):
+        del batch_context_loader_calls[:]
+
+    def test_without_context_loader(self):
+        self.assertEqual(Source().get_contexts([{'hi': 'hi'}]), [{'hi': 'hi'}])
+        self.assertEqual(Source().get_context({'hi': 'hi'}), {'hi': 'hi'})
+
+    def test_with_context_loader(self):
+        source = Source(context_loader='entity_event.tests.models_tests.basic_context_loader')
+        self.assertEqual(source.get_contexts([{'hi': 'hi'}, {}]), [{'hello': 'hello'}, {'hello': 'hello'}])
+
+    def test_with_batch_context_loader(self):
+        source = Source(context_loader='entity_event.tests.models_tests.batch_context_loader_with_calls')
+        self.assertEqual(
+            source.get_contexts([{'a': 1}, {'a': 2}]), [{'a': 1, 'loaded': True}, {'a': 2, 'loaded': True}])
+        self.assertEqual(source.get_context({'a': 3}), {'a': 3, 'loaded': True})
+        self.assertEqual(batch_context_loader_calls, [2, 1])
+
+
+class EventQuerySetLoadContextsTest(TestCase):
+    def setUp(self):
+        del batch_context_loader_calls[:]
+
+    @override_settings(ENTITY_EVENT_SOURCE_CACHE=True)
+    def test_load_contexts(self):
+        batch_source = G(Source, context_loader='entity_event.tests.models_tests.batch_context_loader_with_calls')
+        sources = [batch_source, G(Source, context_loader='entity_event.tests.models_tests.basic_context_loader')]
+        events = [G(Event, source=sources[i % 2], context={'i': i}) for i in range(5)]
+        self.addCleanup(source_cache.invalidate)
+        source_cache.invalidate()
+
+        with self.assertNumQueries(2):
+            loaded = Event.objects.order_by('id').load_contexts()
+        self.assertEqual(loaded, [
+            (events[0], {'i': 0, 'loaded': True}),
+            (events[1], {'hello': 'hello'}),
+            (events[2], {'i': 2, 'loaded': True}),
+            (events[3], {'hello': 'hello'}),
+            (events[4], {'i': 4, 'loaded': True}),
+        ])
+        self.assertEqual(batch_context_loader_calls, [3])
+
+    def test_no_events(self):
+        self.assertEqual(Event.objects.all().load_contexts(), [])
+
+
 class SourceGetContextLoaderTest(SimpleTestCase):
     def test_loads_context_loader(self):
         template = Source(context_loader='entity_event.tests.models_tests.basic_context_loader')
@@ -102,6 +385,141 @@ class EventManagerTest(TestCase):
         self.assertEqual(EventSeen.objects.count(), 1)
         self.assertTrue(EventSeen.objects.filter(event=event, medium=medium).exists())
 
+    def test_mark_seen_already_seen(self):
+        event = G(Event, context={})
+        other_event = G(Event, context={})
+        medium = G(Medium)
+        G(EventSeen, event=event, medium=medium)
+        Event.objects.mark_seen(medium)
+        self.assertEqual(
+            set(EventSeen.objects.filter(medium=medium).values_list('event', flat=True)),
+            set([event.id, other_event.id]))
+
+    def test_mark_seen_other_medium(self):
+        event = G(Event, context={})
+        medium = G(Medium)
+        G(EventSeen, event=event)
+        Event.objects.mark_seen(medium)
+        self.assertEqual(EventSeen.objects.count(), 2)
+        self.assertTrue(EventSeen.objects.filter(event=event, medium=medium).exists())
+
+    def test_mark_seen_already_seen_other_vendor(self):
+        event = G(Event, context={})
+        other_event = G(Event, context={})
+        medium = G(Medium)
+        G(EventSeen, event=event, medium=medium)
+        with patch.object(connection, 'vendor', 'other'):
+            Event.objects.mark_seen(medium)
+        self.assertEqual(
+            set(EventSeen.objects.filter(medium=medium).values_list('event', flat=True)),
+            set([event.id, other_event.id]))
+
+    def test_mark_seen_chunked(self):
+        events = [G(Event, context={}) for i in range(5)]
+        medium = G(Medium)
+        with self.assertNumQueries(6):
+            Event.objects.mark_seen(medium, chunk_size=2)
+        self.assertEqual(
+            set(EventSeen.objects.filter(medium=medium).values_list('event', flat=True)), set(e.id for e in events))
+
+    def test_mark_seen_filtered(self):
+        event = G(Event, context={})
+        G(Event, context={})
+        medium = G(Medium)
+        Event.objects.filter(id=event.id).mark_seen(medium)
+        self.assertEqual(list(EventSeen.objects.values_list('event', flat=True)), [event.id])
+
+    def test_mark_seen_sliced(self):
+        events = [G(Event, context={}) for i in range(3)]
+        medium = G(Medium)
+        Event.objects.order_by('id')[:2].mark_seen(medium)
+        self.assertEqual(
+            set(EventSeen.objects.values_list('event', flat=True)), set([events[0].id, events[1].id]))
+
+    def test_mark_seen_watermark(self):
+        G(Event, context={})
+        event = G(Event, context={})
+        medium = G(Medium, use_seen_watermark=True)
+        Event.objects.mark_seen(medium)
+        self.assertFalse(EventSeen.objects.exists())
+        self.assertEqual(medium.seen_watermark, event.id)
+        self.assertEqual(Medium.objects.get(id=medium.id).seen_watermark, event.id)
+
+    def test_mark_seen_watermark_no_events(self):
+        medium = G(Medium, use_seen_watermark=True)
+        Event.objects.mark_seen(medium)
+        self.assertEqual(Medium.objects.get(id=medium.id).seen_watermark, 0)
+
+    def test_mark_seen_watermark_does_not_move_back(self):
+        event = G(Event, context={})
+        later_event = G(Event, context={})
+        medium = G(Medium, use_seen_watermark=True, seen_watermark=later_event.id)
+        Event.objects.filter(id=event.id).mark_seen(medium)
+        self.assertEqual(medium.seen_watermark, later_event.id)
+        self.assertEqual(Medium.objects.get(id=medium.id).seen_watermark, later_event.id)
+
+    @override_settings(ENTITY_EVENT_SEEN_WATERMARK_LAG=60)
+    def test_mark_seen_watermark_lag(self):
+        with freeze_time('2015-01-01 12:00:00'):
+            settled_event = G(Event, context={})
+        with freeze_time('2015-01-01 12:00:30'):
+            G(Event, context={})
+        medium = G(Medium, use_seen_watermark=True)
+        with freeze_time('2015-01-01 12:01:10'):
+            Event.objects.mark_seen(medium)
+            self.assertEqual(medium.seen_watermark, settled_event.id)
+            Event.objects.order_by('-id')[:1].mark_seen(medium)
+            self.assertEqual(medium.seen_watermark, settled_event.id)
+
+
+class EventQuerySetPageTest(TestCase):
+    def setUp(self):
+        self.source = G(Source)
+        self.events = [
+            G(Event, source=self.source, context={}, time=datetime(2014, 1, day, 12, 30, 15, 123456))
+            for day in [1, 2, 2, 2, 3]
+        ]
+
+    def test_first_page(self):
+        events, cursor = Event.objects.page(page_size=2)
+        self.assertEqual(events, [self.events[4], self.events[3]])
+        self.assertIsNotNone(cursor)
+
+    def test_all_pages(self):
+        pages = []
+        cursor = None
+        while True:
+            events, cursor = Event.objects.page(cursor, page_size=2)
+            pages.append(events)
+            if cursor is None:
+                break
+        self.assertEqual(pages, [
+            [self.events[4], self.events[3]],
+            [self.events[2], self.events[1]],
+            [self.events[0]],
+        ])
+
+    def test_last_page_exactly_full(self):
+        events, cursor = Event.objects.page(page_size=5)
+        self.assertEqual(len(events), 5)
+        self.assertIsNone(cursor)
+
+    def test_page_is_stable_after_new_events(self):
+        events, cursor = Event.objects.page(page_size=2)
+        G(Event, source=self.source, context={}, time=datetime(2014, 1, 4))
+        events, cursor = Event.objects.page(cursor, page_size=2)
+        self.assertEqual(events, [self.events[2], self.events[1]])
+
+    def test_page_filtered(self):
+        events, cursor = Event.objects.filter(id__in=[self.events[0].id, self.events[1].id]).page()
+        self.assertEqual(events, [self.events[1], self.events[0]])
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        for cursor in ['not a cursor', 'bm90IGEgY3Vyc29y', u'\xe9']:
+            with self.assertRaises(ValueError):
+                Event.objects.page(cursor)
+
 
 class MediumEventsInterfacesTest(TestCase):
     def setUp(self):
@@ -183,6 +601,22 @@ class MediumEventsInterfacesTest(TestCase):
         events = self.medium_z.entity_events(entity=self.p2)
         self.assertEqual(len(events), 1)
 
+    def test_entity_events_multiple_followed_actors(self):
+        event = Event.objects.get(source=self.source_c)
+        G(EventActor, event=event, entity=Subscription.objects.get(medium=self.medium_z).entity)
+        events = self.medium_z.entity_events(entity=self.p2)
+        self.assertEqual(list(events), [event])
+
+    def test_entity_events_queryset(self):
+        G(Unsubscription, entity=self.p1, source=self.source_b, medium=self.medium_x)
+        G(Subscription, source=self.source_b, medium=self.medium_x, only_following=False,
+          entity=self.p1, sub_entity_kind=None)
+        events = self.medium_x.entity_events(entity=self.p1)
+        with self.assertNumQueries(1):
+            self.assertEqual(events.count(), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(events[:1]), 1)
+
     def test_entity_targets_basic(self):
         events_targets = self.medium_x.events_targets()
         self.assertEqual(len(events_targets), 2)
@@ -195,6 +629,463 @@ class MediumEventsInterfacesTest(TestCase):
         events_targets = self.medium_z.events_targets(entity_kind=self.person_kind)
         self.assertEqual(len(events_targets[0][1]), 1)
 
+    def test_entity_targets_batch_matches_unbatched(self):
+        G(Unsubscription, entity=self.p2, source=self.source_a, medium=self.medium_x)
+        for medium in [self.medium_x, self.medium_y, self.medium_z]:
+            for entity_kind in [None, self.person_kind]:
+                expected = medium.events_targets(entity_kind=entity_kind)
+                batched = medium.events_targets(entity_kind=entity_kind, batch=True)
+                self.assertEqual(
+                    sorted((e.id, sorted(t.id for t in targets)) for e, targets in batched),
+                    sorted((e.id, sorted(t.id for t in targets)) for e, targets in expected))
+
+    def test_entity_targets_batch_only_following(self):
+        events_targets = self.medium_z.events_targets(entity_kind=self.person_kind, batch=True)
+        self.assertEqual(len(events_targets), 1)
+        self.assertEqual(events_targets[0][1], [self.p2])
+
+    def test_events_page(self):
+        events, cursor = self.medium_x.events_page(page_size=1)
+        self.assertEqual(len(events), 1)
+        next_events, cursor = self.medium_x.events_page(cursor, page_size=1)
+        self.assertEqual(len(next_events), 1)
+        self.assertIsNone(cursor)
+        self.assertEqual(set(events + next_events), set(self.medium_x.events()))
+
+    def test_events_page_entity(self):
+        G(Unsubscription, entity=self.p1, source=self.source_a, medium=self.medium_x)
+        events, cursor = self.medium_x.events_page(entity=self.p1)
+        self.assertEqual(events, [])
+        self.assertIsNone(cursor)
+        events, cursor = self.medium_x.events_page(entity=self.p2)
+        self.assertEqual(len(events), 2)
+
+    def assert_bulk_matches_entity_events(self, medium, entities, **event_filters):
+        events_by_entity = medium.entity_events_bulk(entities, **event_filters)
+        self.assertEqual(
+            dict((entity_id, [e.id for e in events]) for entity_id, events in events_by_entity.items()),
+            dict((entity.id, sorted(e.id for e in medium.entity_events(entity, **event_filters)))
+                 for entity in entities))
+
+    def test_entity_events_bulk(self):
+        G(Unsubscription, entity=self.p1, source=self.source_a, medium=self.medium_x)
+        G(Subscription, source=self.source_b, medium=self.medium_z, only_following=False,
+          entity=self.p3, sub_entity_kind=None)
+        entities = list(Entity.objects.all())
+        for medium in [self.medium_x, self.medium_y, self.medium_z]:
+            self.assert_bulk_matches_entity_events(medium, entities)
+            self.assert_bulk_matches_entity_events(medium, entities, actor=self.p2)
+
+    def test_entity_events_bulk_inactive_group(self):
+        Entity.objects.filter(entity_kind__name='group').update(is_active=False)
+        self.assert_bulk_matches_entity_events(self.medium_z, list(Entity.all_objects.all()))
+
+    def test_entity_events_bulk_followed_by_overridden(self):
+        G(Subscription, source=self.source_c, medium=self.medium_y, only_following=True,
+          entity=self.p2, sub_entity_kind=None)
+        medium = ReversedFollowingMedium.objects.get(id=self.medium_y.id)
+        self.assert_bulk_matches_entity_events(medium, list(Entity.objects.all()))
+
+    def test_entity_events_bulk_mark_seen(self):
+        events_by_entity = self.medium_x.entity_events_bulk([self.p1, self.p2], seen=False, mark_seen=True)
+        self.assertEqual(len(events_by_entity[self.p1.id]), 2)
+        self.assertEqual(EventSeen.objects.count(), 4)
+
+    def test_entity_events_bulk_no_entities(self):
+        self.assertEqual(self.medium_x.entity_events_bulk([]), {})
+
+    def test_entity_events_bulk_num_queries(self):
+        medium = Medium.objects.get(id=self.medium_z.id)
+        clear_local_caches()
+        with CaptureQueriesContext(connection) as one_entity:
+            medium.entity_events_bulk([self.p1])
+        clear_local_caches()
+        with CaptureQueriesContext(connection) as all_entities:
+            medium.entity_events_bulk(Entity.objects.all())
+        self.assertEqual(len(one_entity), len(all_entities) - 1)
+
+
+class ReversedFollowingMedium(Medium):
+    """A medium where entities follow their sub-entities, rather than
+    their super-entities.
+    """
+    class Meta:
+        proxy = True
+
+    def followed_by(self, entities):
+        if isinstance(entities, Entity):
+            entities = [entities.id]
+        sub_entities = EntityRelationship.objects.filter(super_entity__in=entities).values_list('sub_entity')
+        return Entity.objects.filter(Q(id__in=entities) | Q(id__in=sub_entities))
+
+    def followers_of(self, entities):
+        super_entities = EntityRelationship.objects.filter(sub_entity__in=entities).values_list('super_entity')
+        return Entity.objects.filter(Q(id__in=entities) | Q(id__in=super_entities))
+
+
+class MediumResolveEventsTargetsTest(TestCase):
+    def setUp(self):
+        self.person_kind = G(EntityKind, name='person', display_name='Person')
+        self.group = G(Entity)
+        self.people = [G(Entity, entity_kind=self.person_kind) for i in range(3)]
+        for person in self.people:
+            G(EntityRelationship, super_entity=self.group, sub_entity=person)
+
+        self.medium = G(Medium)
+        self.source = G(Source)
+        G(Subscription, medium=self.medium, source=self.source, entity=self.group,
+          sub_entity_kind=self.person_kind, only_following=True)
+        G(Subscription, medium=self.medium, source=self.source, entity=self.group,
+          sub_entity_kind=None, only_following=False)
+
+    def create_event(self, actors):
+        return Event.objects.create_event(source=self.source, context={}, actors=actors, uuid=text_type(uuid1()))
+
+    def test_no_events(self):
+        self.assertEqual(self.medium.resolve_events_targets(Event.objects.none()), [])
+
+    def test_targets(self):
+        e1 = self.create_event([self.people[0]])
+        e2 = self.create_event([self.group])
+        events_targets = dict(self.medium.resolve_events_targets(Event.objects.all()))
+        self.assertEqual(events_targets[e1], [self.people[0], self.group])
+        self.assertEqual(events_targets[e2], self.people + [self.group])
+
+    def test_entity_kind(self):
+        e1 = self.create_event([self.group])
+        events_targets = self.medium.resolve_events_targets(Event.objects.all(), entity_kind=self.person_kind)
+        self.assertEqual(events_targets, [(e1, self.people)])
+
+    def test_unsubscribed(self):
+        G(Unsubscription, entity=self.people[1], source=self.source, medium=self.medium)
+        e1 = self.create_event([self.group])
+        events_targets = self.medium.resolve_events_targets(Event.objects.all(), entity_kind=self.person_kind)
+        self.assertEqual(events_targets, [(e1, [self.people[0], self.people[2]])])
+
+    def test_filter_source_targets_by_unsubscription(self):
+        G(Unsubscription, entity=self.people[1], source=self.source, medium=self.medium)
+        self.assertEqual(
+            self.medium.filter_source_targets_by_unsubscription(self.source.id, self.people),
+            [self.people[0], self.people[2]])
+
+    def test_query_count_independent_of_event_count(self):
+        self.create_event([self.people[0]])
+        clear_local_caches()
+        with CaptureQueriesContext(connection) as few:
+            Medium.objects.get(id=self.medium.id).resolve_events_targets(Event.objects.all())
+        for person in self.people:
+            self.create_event([person])
+        clear_local_caches()
+        with CaptureQueriesContext(connection) as many:
+            Medium.objects.get(id=self.medium.id).resolve_events_targets(Event.objects.all())
+        self.assertEqual(len(few), len(many))
+
+    def test_iter_events_targets_matches_events_targets(self):
+        for person in self.people:
+            self.create_event([person])
+        self.assertEqual(
+            list(self.medium.iter_events_targets(chunk_size=2)), self.medium.events_targets(batch=True))
+
+    def test_iter_events_targets_chunks(self):
+        for person in self.people:
+            self.create_event([person])
+        events_targets = self.medium.iter_events_targets(entity_kind=self.person_kind, chunk_size=2)
+        self.assertEqual([targets for event, targets in events_targets], [[person] for person in self.people])
+
+    def test_iter_events_targets_mark_seen(self):
+        for person in self.people:
+            self.create_event([person])
+        events_targets = list(self.medium.iter_events_targets(chunk_size=2, seen=False, mark_seen=True))
+        self.assertEqual(len(events_targets), 3)
+        self.assertEqual(EventSeen.objects.filter(medium=self.medium).count(), 3)
+        self.assertEqual(list(self.medium.iter_events_targets(seen=False)), [])
+
+    @override_settings(ENTITY_EVENT_SEEN_WATERMARK_LAG=60)
+    def test_iter_events_targets_watermark_lag(self):
+        self.medium.use_seen_watermark = True
+        self.medium.save()
+        with freeze_time('2015-01-01 12:00:00'):
+            settled = [self.create_event([person]) for person in self.people]
+        with freeze_time('2015-01-01 12:00:30'):
+            recent = self.create_event([self.people[0]])
+
+        with freeze_time('2015-01-01 12:01:10'):
+            events_targets = self.medium.iter_events_targets(chunk_size=2, seen=False, mark_seen=True)
+            self.assertEqual([event for event, targets in events_targets], settled)
+            self.assertEqual(list(self.medium.iter_events_targets(seen=False, mark_seen=True)), [])
+        self.assertEqual(Medium.objects.get(id=self.medium.id).seen_watermark, settled[-1].id)
+        with freeze_time('2015-01-01 12:01:40'):
+            events_targets = self.medium.iter_events_targets(seen=False, mark_seen=True)
+            self.assertEqual([event for event, targets in events_targets], [recent])
+
+    def test_redefined_followers_of(self):
+        medium = ReversedFollowingMedium.objects.get(id=self.medium.id)
+        e1 = self.create_event([self.people[0]])
+        events_targets = medium.resolve_events_targets(Event.objects.all(), entity_kind=self.person_kind)
+        self.assertEqual(events_targets, [(e1, [self.people[0]])])
+
+
+class MediumClaimEventsTest(TestCase):
+    def setUp(self):
+        self.medium = G(Medium)
+        self.events = [G(Event, context={}) for i in range(5)]
+
+    def test_claim_events(self):
+        token, events = self.medium.claim_events(batch_size=2)
+        self.assertEqual(events, self.events[:2])
+        self.assertEqual(EventLease.objects.filter(medium=self.medium, token=token).count(), 2)
+
+    def test_claims_do_not_overlap(self):
+        token1, events1 = self.medium.claim_events(batch_size=2)
+        token2, events2 = self.medium.claim_events(batch_size=2)
+        token3, events3 = self.medium.claim_events(batch_size=2)
+        self.assertNotEqual(token1, token2)
+        self.assertEqual(events1, self.events[:2])
+        self.assertEqual(events2, self.events[2:4])
+        self.assertEqual(events3, self.events[4:])
+
+    def test_claim_other_medium_not_affected(self):
+        self.medium.claim_events(batch_size=2)
+        token, events = G(Medium).claim_events(batch_size=2)
+        self.assertEqual(events, self.events[:2])
+
+    def test_claim_skips_seen(self):
+        Event.objects.filter(id=self.events[0].id).mark_seen(self.medium)
+        token, events = self.medium.claim_events(batch_size=2)
+        self.assertEqual(events, self.events[1:3])
+
+    def test_claim_filters(self):
+        actor = G(Entity)
+        G(EventActor, event=self.events[3], entity=actor)
+        token, events = self.medium.claim_events(actor=actor)
+        self.assertEqual(events, [self.events[3]])
+
+    def test_claim_expired_lease(self):
+        with freeze_time(datetime(2014, 1, 1)):
+            self.medium.claim_events(batch_size=2, lease_seconds=60)
+        with freeze_time(datetime(2014, 1, 1, 0, 2)):
+            token, events = self.medium.claim_events(batch_size=2)
+        self.assertEqual(events, self.events[:2])
+        self.assertEqual(EventLease.objects.count(), 2)
+
+    def test_complete_claim(self):
+        token, events = self.medium.claim_events(batch_size=2)
+        self.medium.complete_claim(token)
+        self.assertFalse(EventLease.objects.exists())
+        self.assertEqual(set(EventSeen.objects.values_list('event', flat=True)), set(e.id for e in events))
+        token, events = self.medium.claim_events(batch_size=2)
+        self.assertEqual(events, self.events[2:4])
+
+    def test_complete_reclaimed(self):
+        with freeze_time(datetime(2014, 1, 1)):
+            token, events = self.medium.claim_events(batch_size=2, lease_seconds=60)
+        with freeze_time(datetime(2014, 1, 1, 0, 2)):
+            other_token, other_events = self.medium.claim_events(batch_size=2)
+        self.medium.complete_claim(token)
+        self.assertFalse(EventSeen.objects.exists())
+        self.assertEqual(EventLease.objects.filter(token=other_token).count(), 2)
+
+    def test_release_claim(self):
+        token, events = self.medium.claim_events(batch_size=2)
+        self.medium.release_claim(token)
+        self.assertFalse(EventLease.objects.exists())
+        self.assertFalse(EventSeen.objects.exists())
+        token, events = self.medium.claim_events(batch_size=2)
+        self.assertEqual(events, self.events[:2])
+
+    def test_claim_watermark_medium(self):
+        medium = G(Medium, use_seen_watermark=True)
+        with self.assertRaises(ImproperlyConfigured):
+            medium.claim_events()
+
+
+class MediumFanOutOnWriteTest(TestCase):
+    def setUp(self):
+        self.person_kind = G(EntityKind, name='person', display_name='Person')
+        self.group = G(Entity)
+        self.people = [G(Entity, entity_kind=self.person_kind) for i in range(3)]
+        for person in self.people:
+            G(EntityRelationship, super_entity=self.group, sub_entity=person)
+
+        self.medium = G(Medium, fan_out_on_write=True)
+        self.source = G(Source)
+        G(Subscription, medium=self.medium, source=self.source, entity=self.group,
+          sub_entity_kind=self.person_kind, only_following=True)
+
+    def create_event(self, actors):
+        return Event.objects.create_event(source=self.source, context={}, actors=actors, uuid=text_type(uuid1()))
+
+    def test_create_event_fans_out(self):
+        event = self.create_event([self.people[0]])
+        self.assertEqual(
+            list(InboxEvent.objects.values_list('entity', 'medium', 'event')),
+            [(self.people[0].id, self.medium.id, event.id)])
+        self.assertEqual(InboxEvent.objects.get().time, event.time)
+
+    def test_create_event_fan_out_on_read(self):
+        medium = G(Medium, fan_out_on_write=False)
+        G(Subscription, medium=medium, source=self.source, entity=self.people[1], sub_entity_kind=None,
+          only_following=False)
+        self.create_event([self.people[0]])
+        self.assertFalse(InboxEvent.objects.filter(medium=medium).exists())
+
+    def test_create_event_unsubscribed_source(self):
+        Event.objects.create_event(source=G(Source), context={}, actors=[self.people[0]])
+        self.assertFalse(InboxEvent.objects.exists())
+
+    def test_entity_events(self):
+        event = self.create_event([self.people[0]])
+        self.create_event([self.people[1]])
+        self.assertEqual(list(self.medium.entity_events(self.people[0])), [event])
+        self.assertEqual(list(self.medium.entity_events(self.people[2])), [])
+
+    def test_entity_events_matches_fan_out_on_read(self):
+        for person in self.people:
+            self.create_event([person, self.people[0]])
+        fan_out_on_read = Medium.objects.get(id=self.medium.id)
+        fan_out_on_read.fan_out_on_write = False
+        for person in self.people:
+            self.assertEqual(
+                set(self.medium.entity_events(person, seen=False)), set(fan_out_on_read.entity_events(person)))
+
+    def test_entity_events_bulk(self):
+        events = [self.create_event([person, self.people[0]]) for person in self.people]
+        G(Unsubscription, entity=self.people[1], source=self.source, medium=self.medium)
+        self.assertEqual(self.medium.entity_events_bulk(self.people), {
+            self.people[0].id: events,
+            self.people[1].id: [],
+            self.people[2].id: [events[2]],
+        })
+
+    def test_backfill_inbox(self):
+        event = G(Event, source=self.source, context={})
+        G(EventActor, event=event, entity=self.people[1])
+        expired = G(Event, source=self.source, context={}, time_expires=datetime(2014, 1, 1))
+        G(EventActor, event=expired, entity=self.people[1])
+        G(InboxEvent, entity=self.people[2], medium=self.medium, event=event, time=event.time)
+
+        self.medium.backfill_inbox(chunk_size=1)
+        self.assertEqual(
+            list(InboxEvent.objects.values_list('entity', 'event')), [(self.people[1].id, event.id)])
+
+    @override_settings(ENTITY_EVENT_QUERY_WINDOW=60)
+    def test_backfill_inbox_query_window(self):
+        old = G(Event, source=self.source, context={}, time=datetime(2014, 1, 1), time_expires=datetime.max)
+        G(EventActor, event=old, entity=self.people[1])
+        G(InboxEvent, entity=self.people[1], medium=self.medium, event=old, time=old.time)
+
+        self.medium.backfill_inbox()
+        self.assertEqual(list(InboxEvent.objects.values_list('entity', 'event')), [(self.people[1].id, old.id)])
+        self.assertEqual(list(self.medium.entity_events(self.people[1])), [])
+        self.assertEqual(list(self.medium.entity_events(self.people[1], start_time=datetime(2013, 1, 1))), [old])
+
+    def test_overlapping_subscriptions(self):
+        G(Subscription, medium=self.medium, source=self.source, entity=self.people[0], sub_entity_kind=None,
+          only_following=False)
+        other_group = G(Entity)
+        G(EntityRelationship, super_entity=other_group, sub_entity=self.people[0])
+        G(Subscription, medium=self.medium, source=self.source, entity=other_group,
+          sub_entity_kind=self.person_kind, only_following=False)
+
+        event = self.create_event([self.people[0]])
+        self.assertEqual(
+            list(InboxEvent.objects.values_list('entity', 'event')), [(self.people[0].id, event.id)])
+        self.medium.backfill_inbox()
+        self.assertEqual(
+            list(InboxEvent.objects.values_list('entity', 'event')), [(self.people[0].id, event.id)])
+
+
+@override_settings(ENTITY_EVENT_SUBSCRIPTION_MEMBERS=True)
+class SubscriptionMemberTest(TestCase):
+    def setUp(self):
+        self.person_kind = G(EntityKind, name='person', display_name='Person')
+        self.group = G(Entity)
+        self.people = [G(Entity, entity_kind=self.person_kind) for i in range(3)]
+        for person in self.people[:2]:
+            G(EntityRelationship, super_entity=self.group, sub_entity=person)
+        G(EntityRelationship, super_entity=self.group, sub_entity=G(Entity))
+
+        self.medium = G(Medium)
+        self.source = G(Source)
+        self.group_subscription = G(
+            Subscription, medium=self.medium, source=self.source, entity=self.group,
+            sub_entity_kind=self.person_kind, only_following=False)
+        self.subscription = G(
+            Subscription, medium=self.medium, source=self.source, entity=self.people[2], sub_entity_kind=None,
+            only_following=False)
+
+    def assert_members(self, subscription, entities):
+        self.assertEqual(
+            set(SubscriptionMember.objects.filter(subscription=subscription).values_list('entity', flat=True)),
+            set(entity.id for entity in entities))
+        self.assertEqual(SubscriptionMember.objects.diff(Subscription.objects.all()), (set(), set()))
+
+    def test_subscription_created(self):
+        self.assert_members(self.group_subscription, self.people[:2])
+        self.assert_members(self.subscription, self.people[2:])
+
+    def test_subscription_changed(self):
+        self.group_subscription.sub_entity_kind = None
+        self.group_subscription.save()
+        self.assert_members(self.group_subscription, [self.group])
+
+    def test_relationship_created(self):
+        G(EntityRelationship, super_entity=self.group, sub_entity=self.people[2])
+        self.assert_members(self.group_subscription, self.people)
+
+    def test_relationship_changed(self):
+        relationship = EntityRelationship.objects.get(sub_entity=self.people[0])
+        relationship.sub_entity = self.people[2]
+        relationship.save()
+        self.assert_members(self.group_subscription, self.people[1:])
+
+    def test_relationship_deleted(self):
+        EntityRelationship.objects.filter(sub_entity=self.people[0]).delete()
+        self.assert_members(self.group_subscription, self.people[1:2])
+
+    def test_relationships_created_in_bulk(self):
+        EntityRelationship.objects.bulk_create([EntityRelationship(super_entity=self.group, sub_entity=self.people[2])])
+        post_bulk_operation.send(sender=EntityRelationship.objects, model=EntityRelationship)
+        self.assert_members(self.group_subscription, self.people)
+
+    def test_unsubscription_created(self):
+        G(Unsubscription, medium=self.medium, source=self.source, entity=self.people[0])
+        self.assert_members(self.group_subscription, self.people[1:2])
+
+    def test_unsubscription_changed(self):
+        unsubscription = G(Unsubscription, medium=self.medium, source=self.source, entity=self.people[0])
+        unsubscription.entity = self.people[2]
+        unsubscription.save()
+        self.assert_members(self.group_subscription, self.people[:2])
+        self.assert_members(self.subscription, [])
+
+    def test_unsubscription_deleted(self):
+        G(Unsubscription, medium=self.medium, source=self.source, entity=self.people[0]).delete()
+        self.assert_members(self.group_subscription, self.people[:2])
+
+    def test_rebuild(self):
+        SubscriptionMember.objects.filter(subscription=self.group_subscription).delete()
+        G(SubscriptionMember, subscription=self.subscription, entity=self.group)
+        self.assertEqual(SubscriptionMember.objects.rebuild(), (2, 1))
+        self.assert_members(self.group_subscription, self.people[:2])
+        self.assert_members(self.subscription, self.people[2:])
+
+    def test_events_targets(self):
+        event = G(Event, source=self.source, context={})
+        G(Unsubscription, medium=self.medium, source=self.source, entity=self.people[1])
+        with override_settings(ENTITY_EVENT_SUBSCRIPTION_MEMBERS=False):
+            expected = self.medium.events_targets(batch=True)
+        self.assertEqual(self.medium.events_targets(batch=True), expected)
+        self.assertEqual(expected, [(event, [self.people[0], self.people[2]])])
+
+    def test_disabled(self):
+        with override_settings(ENTITY_EVENT_SUBSCRIPTION_MEMBERS=False):
+            G(Subscription, medium=self.medium, source=G(Source), entity=self.group, sub_entity_kind=None)
+            relationship = G(EntityRelationship, super_entity=self.group, sub_entity=self.people[2])
+            relationship.save()
+            G(Unsubscription, medium=self.medium, source=self.source, entity=self.people[0]).save()
+        self.assertEqual(SubscriptionMember.objects.count(), 3)
+
 
 class MediumSubsetSubscriptionsTest(TestCase):
     def setUp(self):
@@ -245,6 +1136,87 @@ class MediumGetFilteredEventsTest(TestCase):
         events = self.medium.get_filtered_events(seen=False)
         self.assertEquals(set(events), set([unseen_e, seen_from_other_medium_e]))
 
+    def test_get_unseen_events_watermark(self):
+        seen_e = G(Event, context={})
+        unseen_e = G(Event, context={})
+        medium = G(Medium, use_seen_watermark=True, seen_watermark=seen_e.id)
+
+        self.assertEquals(list(medium.get_filtered_events(seen=False)), [unseen_e])
+        self.assertEquals(list(medium.get_filtered_events(seen=True)), [seen_e])
+
+    def test_get_unseen_events_watermark_mark_seen(self):
+        seen_e = G(Event, context={})
+        unseen_e = G(Event, context={})
+        medium = G(Medium, use_seen_watermark=True, seen_watermark=seen_e.id)
+
+        events = medium.get_filtered_events(seen=False, mark_seen=True)
+        G(Event, context={})
+        self.assertEquals(list(events), [unseen_e])
+        self.assertEquals(Medium.objects.get(id=medium.id).seen_watermark, unseen_e.id)
+        self.assertFalse(EventSeen.objects.exists())
+
+    @override_settings(ENTITY_EVENT_SEEN_WATERMARK_LAG=60)
+    def test_get_unseen_events_watermark_mark_seen_lag(self):
+        with freeze_time('2015-01-01 12:00:00'):
+            settled_e = G(Event, context={}, time_expires=datetime.max)
+        with freeze_time('2015-01-01 12:00:30'):
+            recent_e = G(Event, context={}, time_expires=datetime.max)
+        medium = G(Medium, use_seen_watermark=True)
+
+        with freeze_time('2015-01-01 12:01:10'):
+            self.assertEquals(list(medium.get_filtered_events(seen=False, mark_seen=True)), [settled_e])
+            self.assertEquals(list(medium.get_filtered_events(seen=False, mark_seen=True)), [])
+        self.assertEquals(Medium.objects.get(id=medium.id).seen_watermark, settled_e.id)
+        with freeze_time('2015-01-01 12:01:40'):
+            self.assertEquals(list(medium.get_filtered_events(seen=False, mark_seen=True)), [recent_e])
+
+    def test_get_unseen_events_watermark_mark_seen_none_unseen(self):
+        seen_e = G(Event, context={})
+        medium = G(Medium, use_seen_watermark=True, seen_watermark=seen_e.id)
+
+        events = medium.get_filtered_events(seen=False, mark_seen=True)
+        self.assertEquals(list(events), [])
+        self.assertEquals(Medium.objects.get(id=medium.id).seen_watermark, seen_e.id)
+
+    def test_get_unseen_events_single_query(self):
+        seen_e = G(Event, context={})
+        G(EventSeen, event=seen_e, medium=self.medium)
+        unseen_e = G(Event, context={})
+
+        with self.assertNumQueries(1):
+            events = list(self.medium.get_filtered_events(seen=False))
+        self.assertEquals(events, [unseen_e])
+
+    def test_get_unseen_events_mark_seen(self):
+        seen_e = G(Event, context={})
+        G(EventSeen, event=seen_e, medium=self.medium)
+        unseen_events = [G(Event, context={}) for i in range(3)]
+        G(EventSeen, event=unseen_events[0])
+
+        events = self.medium.get_filtered_events(seen=False, mark_seen=True)
+        new_e = G(Event, context={})
+        self.assertEquals(list(events), unseen_events)
+        self.assertEquals(EventSeen.objects.filter(medium=self.medium).count(), 4)
+        self.assertEquals(list(self.medium.get_filtered_events(seen=False, mark_seen=True)), [new_e])
+
+    def test_get_unseen_events_mark_seen_none_unseen(self):
+        G(EventSeen, event=G(Event, context={}), medium=self.medium)
+        with self.assertNumQueries(1):
+            events = self.medium.get_filtered_events(seen=False, mark_seen=True)
+        self.assertEquals(list(events), [])
+
+    def test_get_unseen_events_with_other_filters(self):
+        actor = G(Entity)
+        seen_e = G(Event, context={})
+        G(EventSeen, event=seen_e, medium=self.medium)
+        G(EventActor, event=seen_e, entity=actor)
+        unseen_e = G(Event, context={})
+        G(EventActor, event=unseen_e, entity=actor)
+        G(Event, context={})
+
+        events = self.medium.get_filtered_events(seen=False, actor=actor)
+        self.assertEquals(list(events), [unseen_e])
+
 
 class MediumGetEventFiltersTest(TestCase):
     def setUp(self):
@@ -265,6 +1237,14 @@ class MediumGetEventFiltersTest(TestCase):
         events = Event.objects.filter(*filters)
         self.assertEqual(events.count(), 3)
 
+    @override_settings(ENTITY_EVENT_QUERY_WINDOW=2 * 24 * 60 * 60)
+    def test_query_window(self):
+        with freeze_time('2014-01-18'):
+            filters = self.medium.get_filtered_events_queries(None, None, None, True, None)
+            self.assertEqual(Event.objects.filter(*filters).count(), 3)
+            filters = self.medium.get_filtered_events_queries(datetime(2014, 1, 1), None, None, True, None)
+            self.assertEqual(Event.objects.filter(*filters).count(), 5)
+
     def test_end_time(self):
         filters = self.medium.get_filtered_events_queries(None, datetime(2014, 1, 16), None, True, None)
         events = Event.objects.filter(*filters)
@@ -388,28 +1368,6 @@ class SubscriptionSubscribedEntitiesTest(TestCase):
         self.assertEqual(indiv_qs.count(), 1)
 
 
-class UnseenEventIdsTest(TestCase):
-    def test_filters_seen(self):
-        m = G(Medium)
-        e1 = G(Event, context={})
-        e2 = G(Event, context={})
-        Event.objects.filter(id=e2.id).mark_seen(m)
-        unseen_ids = _unseen_event_ids(m)
-        self.assertEqual(unseen_ids, [e1.id])
-
-    def test_multiple_mediums(self):
-        m1 = G(Medium)
-        m2 = G(Medium)
-        e1 = G(Event, context={})
-        e2 = G(Event, context={})
-        e3 = G(Event, context={})
-        e4 = G(Event, context={})
-        Event.objects.filter(id=e2.id).mark_seen(m1)
-        Event.objects.filter(id=e3.id).mark_seen(m2)
-        unseen_ids = _unseen_event_ids(m1)
-        self.assertEqual(set(unseen_ids), set([e1.id, e3.id, e4.id]))
-
-
 # Note: The following freeze_time a few more minutes than what we
 # want, in order to work around a strange off by a few seconds bug in
 # freezegun. I'm not sure what other way to fix it. Since we're only
@@ -427,6 +1385,9 @@ class UnicodeTest(TestCase):
         self.event = N(Event, source=self.source, context={}, id=1)
         self.event_actor = N(EventActor, event=self.event, entity=self.entity)
         self.event_seen = N(EventSeen, event=self.event, medium=self.medium, time_seen=datetime(2014, 1, 2))
+        self.event_lease = N(EventLease, event=self.event, medium=self.medium, time_expires=datetime(2014, 1, 2))
+        self.inbox_event = N(InboxEvent, event=self.event, entity=self.entity, medium=self.medium)
+        self.subscription_member = N(SubscriptionMember, subscription=self.subscription, entity=self.entity)
 
     def test_medium_formats(self):
         s = text_type(self.medium)
@@ -459,3 +1420,15 @@ class UnicodeTest(TestCase):
     def test_event_seenformats(self):
         s = text_type(self.event_seen)
         self.assertEqual(s, 'Seen on Test Medium at 2014-01-02::00:00:00')
+
+    def test_event_lease_formats(self):
+        s = text_type(self.event_lease)
+        self.assertEqual(s, 'Leased on Test Medium until 2014-01-02::00:00:00')
+
+    def test_inbox_event_formats(self):
+        s = text_type(self.inbox_event)
+        self.assertEqual(s, 'Event 1 for {0} on Test Medium'.format(self.entity_string))
+
+    def test_subscription_member_formats(self):
+        s = text_type(self.subscription_member)
+        self.assertEqual(s, '{0} subscribed by {0} to Test Source by Test Medium'.format(self.entity_string))
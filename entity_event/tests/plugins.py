@@ -0,0 +1,18 @@
+from django.core.cache import cache
+from django_nose.plugin import AlwaysOnPlugin
+
+from entity_event.cache import clear_local_caches
+
+
+class ClearCachesPlugin(AlwaysOnPlugin):
+    """Clears the caches of ``entity_event.cache`` before each test.
+
+    Test cases roll back their changes without sending the signals
+    that invalidate the caches, so the rows cached by one test would
+    otherwise be used by the next.
+    """
+    name = 'clear-entity-event-caches'
+
+    def beforeTest(self, test):
+        cache.clear()
+        clear_local_caches()
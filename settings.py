@@ -48,4 +48,10 @@ def configure_settings():
             ),
             ROOT_URLCONF='entity_event.urls',
             DEBUG=False,
+            # Test cases roll back their changes without sending signals, so the caches are
+            # cleared before each test instead
+            NOSE_PLUGINS=['entity_event.tests.plugins.ClearCachesPlugin'],
+            # Events are marked as seen by a watermark as soon as they are created, except by the
+            # tests of the watermark's lag.
+            ENTITY_EVENT_SEEN_WATERMARK_LAG=0,
         )
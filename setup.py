@@ -39,9 +39,9 @@ setup(
     ],
     license='MIT',
     install_requires=[
-        'cached-property>=0.1.5',
         'django>=1.6,<1.7',
         'django-entity>=1.7.1',
+        'django-manager-utils>=0.6.3',
         'jsonfield>=0.9.20',
         'six'
     ],